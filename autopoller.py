@@ -0,0 +1,131 @@
+########################################################
+# Control Design GUI: autopoller.py
+# Keeps parameters marked "Auto" in the GUI up to date from a background thread.
+#
+# Ben Weiss, University of Washington
+# Summer 2014
+#
+# Each polled parameter has its own rate (the "pollrate" attribute in
+# machine.xml, in Hz). Once per cycle, every parameter that is due is read in
+# a single pipelined batch (Machine.readFromDevice). If a batch takes too long
+# compared to the fastest rate asked for, the link is saturated and all rates
+# are scaled back until it keeps up again. The poll thread doesn't touch the
+# Params themselves (the GUI thread is using them): the values it reads are
+# handed to the GUI thread with a Qt signal, and put in the Params there.
+#
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+########################################################
+
+from PyQt4 import QtCore
+import threading, time
+
+from comm import *
+import machineInterface as mach
+
+
+MIN_SLEEP = 0.005       # s, shortest the poll thread will sleep between cycles
+SATURATION = 0.5        # a batch taking longer than this fraction of the fastest period means we're saturated
+BACKOFF = 1.5           # period multiplier applied each saturated cycle
+MAX_BACKOFF = 10.0      # never slow down more than this
+RECOVER = 0.9           # period multiplier applied each cycle that keeps up (down to 1.0)
+IDLE_PERIOD = 0.5       # s, how often due parameters are looked at again while there's no connection
+
+
+class AutoPoller(QtCore.QObject) :
+
+    # emitted with each Param read and the value read for it. Connected widgets
+    # get it on the GUI thread, which is where the value is put in the Param.
+    valueUpdated = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, parent=None) :
+        QtCore.QObject.__init__(self, parent)
+        self.lock = threading.Lock()
+        self.due = {}           # Param -> time it's next due to be read
+        self.backoff = 1.0      # current multiplier on every period
+        self.quit = False
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self) :
+        self.thread.start()
+
+    def stop(self) :
+        self.quit = True
+        self.wake.set()
+        if self.thread.is_alive() :
+            self.thread.join(1.0)
+
+    # Starts polling param at its pollrate.
+    def add(self, param) :
+        with self.lock :
+            self.due[param] = time.time()
+        self.wake.set()
+
+    def remove(self, param) :
+        with self.lock :
+            self.due.pop(param, None)
+
+    # Poll thread main loop.
+    def run(self) :
+        while not self.quit :
+            now = time.time()
+            with self.lock :
+                due = [p for p in self.due if self.due[p] <= now]
+            if len(due) > 0 and comm.IsOpen() and mach.machine != None :
+                start = time.time()
+                values, failed = mach.machine.readFromDevice(due, quiet=True)
+                elapsed = time.time() - start
+                self.adapt(elapsed, min([self.period(p) for p in due]))
+                with self.lock :
+                    for p in due :
+                        if p in self.due :
+                            self.due[p] = now + self.period(p) * self.backoff
+                for p in due :
+                    if p in values :
+                        self.valueUpdated.emit(p, values[p])
+            elif len(due) > 0 :
+                # nothing to read from yet; look again in a while rather than
+                # spinning on due times that are already past
+                with self.lock :
+                    for p in due :
+                        if p in self.due :
+                            self.due[p] = now + max(self.period(p), IDLE_PERIOD)
+            # sleep until the next parameter is due (or something's added)
+            with self.lock :
+                nxt = min(self.due.values()) if len(self.due) > 0 else time.time() + 1.0
+            self.wake.wait(max(MIN_SLEEP, nxt - time.time()))
+            self.wake.clear()
+
+    # seconds between reads of param, before backoff
+    def period(self, param) :
+        return 1.0 / max(param.pollRate, 0.1)
+
+    # adjusts the backoff after a batch that took elapsed seconds, when the
+    # fastest parameter in it wants reading every period seconds.
+    def adapt(self, elapsed, period) :
+        if elapsed > SATURATION * period * self.backoff :
+            self.backoff = min(MAX_BACKOFF, self.backoff * BACKOFF)
+        else :
+            self.backoff = max(1.0, self.backoff * RECOVER)
@@ -0,0 +1,393 @@
+########################################################
+# Control Design GUI: batch.py
+# Converts or summarizes lots of captures at once, on all cores.
+#
+# Ben Weiss, University of Washington
+# Summer 2014
+#
+# usage: dumpreader.py --batch [--csv | --summary] [options] path...
+#        (or run this file directly)
+#
+# Each path is a file, a glob (quoted, so it works on Windows too) or a
+# directory, meaning every .bin/.cap/.csv in it. By default stream .bins are
+# packed into .caps, and history .csvs get the binary copy histdata.loadCsv
+# keeps next to them (csv + SIDECAR_EXT). With
+#   --csv      stream .bin/.cap captures are converted to .csv instead
+#   --summary  nothing is converted; there's one line per file (records,
+#              duration, rate, tracking error) in a csv, summary.csv by default
+# Files whose output is already newer than they are are skipped, as are files
+# already in the summary with the same size and modification time (--force
+# redoes everything).
+#
+# Work is handed to a pool of processes a piece at a time. Binary captures are
+# split on record boundaries (whole capfile chunks, in fact) so a single huge
+# file is spread over every worker too; the pieces are put back together in
+# order as they come in. History csvs are done whole. Each file's time and
+# throughput are printed as it finishes.
+#
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+########################################################
+
+import sys, os, glob, time, argparse, traceback, multiprocessing
+import numpy as np
+import histdata
+import capfile
+
+
+PIECE_RECORDS = 16 * capfile.CHUNK_RECORDS     # records per piece of work (~30 MB)
+INPUT_EXTS = ('.bin', '.cap', '.csv')
+SOURCE_PREFERENCE = ('.cap', '.csv', '.bin')    # which input to use when two make the same output
+SUMMARY_CSV = 'summary.csv'
+SUMMARY_HEADER = "File, Bytes, Modified, Records, Duration (s), Record Rate (Hz), RMS Error (tics), Max Error (tics)\n"
+
+
+# Expands the command line's files, directories and globs into a sorted list of
+# inputs, leaving out those in exclude (e.g. the summary file) and csvs that
+# aren't control histories.
+def findInputs(paths, exclude=()) :
+    exclude = set([os.path.normcase(os.path.abspath(f)) for f in exclude])
+    found = set()
+    for path in paths :
+        if os.path.isdir(path) :
+            names = [os.path.join(path, f) for f in os.listdir(path)]
+        else :
+            names = glob.glob(path)
+            if len(names) == 0 :
+                print("%s: no such file" % path)
+        for name in names :
+            if not os.path.isfile(name) or not os.path.splitext(name)[1].lower() in INPUT_EXTS :
+                continue
+            if os.path.normcase(os.path.abspath(name)) in exclude :
+                continue
+            if name.lower().endswith('.csv') and not isHistoryCsv(name) :
+                print("%s: skipped, not a history csv" % name)
+                continue
+            found.add(os.path.normpath(name))
+    return sorted(found)
+
+
+# checks the header line, as histdata.loadCsv does
+def isHistoryCsv(fname) :
+    with open(fname, "r") as fin :
+        return fin.readline().startswith('Time')
+
+
+# where a conversion of fname goes (None if there's nothing to convert it to)
+def outputName(fname, csv=False) :
+    base, ext = os.path.splitext(fname)
+    ext = ext.lower()
+    if csv :
+        return base + '.csv' if ext in ('.bin', '.cap') else None
+    if ext == '.bin' :
+        return base + capfile.CAPTURE_EXT
+    if ext == '.csv' :
+        return fname + histdata.SIDECAR_EXT
+    return None
+
+
+def upToDate(fname, outname) :
+    return (os.path.exists(outname) and os.path.getsize(outname) > 0 and
+            os.path.getmtime(outname) >= os.path.getmtime(fname))
+
+
+# records in a binary capture (None for csvs, which can't be split up front)
+def countRecords(fname) :
+    ext = os.path.splitext(fname)[1].lower()
+    if ext == '.bin' :
+        return os.path.getsize(fname) // histdata.HIST_DTYPE.itemsize
+    if ext == '.cap' :
+        cap = capfile.CaptureFile(fname)
+        n = len(cap)
+        cap.close()
+        return n
+    return None
+
+
+def readRecords(fname, start, stop) :
+    ext = os.path.splitext(fname)[1].lower()
+    if ext == '.bin' :
+        return np.memmap(fname, histdata.HIST_DTYPE, 'r', start * histdata.HIST_DTYPE.itemsize, (stop - start,))
+    cap = capfile.CaptureFile(fname)
+    try :
+        return cap.records(start, stop)
+    finally :
+        cap.close()
+
+
+# Summary statistics of some records, in a form that adds up across pieces
+def summarize(recs) :
+    if len(recs) == 0 :
+        return {'n' : 0}
+    err = recs['target_pos'].astype(np.float64) - recs['position']
+    return {'n' : len(recs), 't0' : int(recs['time'][0]), 't1' : int(recs['time'][-1]),
+            'sumsq' : float(np.dot(err, err)), 'maxabs' : float(np.abs(err).max())}
+
+def mergeSummaries(parts) :
+    parts = [p for p in parts if p['n'] > 0]
+    if len(parts) == 0 :
+        return {'n' : 0}
+    return {'n' : sum([p['n'] for p in parts]), 't0' : parts[0]['t0'], 't1' : parts[-1]['t1'],
+            'sumsq' : sum([p['sumsq'] for p in parts]), 'maxabs' : max([p['maxabs'] for p in parts])}
+
+
+# Does one piece of work, in a worker process:
+#   (mode, fname, outname, index, start, stop) -> (fname, index, result, error, started, finished)
+# start/stop are None for a whole csv.
+def runPiece(task) :
+    mode, fname, outname, index, start, stop = task
+    started = time.time()
+    try :
+        if mode == 'npy' :
+            histdata.loadCsv(fname)         # (which saves the binary copy)
+            result = None
+        else :
+            recs = histdata.loadCsv(fname) if start == None else readRecords(fname, start, stop)
+            if mode == 'summary' :
+                result = summarize(recs)
+            elif mode == 'cap' :
+                result = [capfile.encodeChunk(recs[i:i + capfile.CHUNK_RECORDS])
+                          for i in range(0, len(recs), capfile.CHUNK_RECORDS)]
+            else :
+                result = '%s.part%i' % (fname, index)     # (named for the input; outputs can be shared)
+                with open(result, "w") as fout :
+                    histdata.writeCsv([recs], fout)
+        return fname, index, result, None, started, time.time()
+    except Exception :
+        return fname, index, None, traceback.format_exc(), started, time.time()
+
+
+# Keeps track of one file's pieces as they come back and puts the output together.
+class FileJob :
+
+    def __init__(self, mode, fname, outname, npieces, nrecords) :
+        self.mode = mode
+        self.fname = fname
+        self.outname = outname
+        self.npieces = npieces
+        self.nrecords = nrecords
+        self.nbytes = os.path.getsize(fname)
+        self.results = {}       # piece index -> result, until it's used
+        self.next = 0           # next piece to write out
+        self.writer = None
+        self.summary = None
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.reported = False
+
+    def done(self) :
+        return self.next == self.npieces or self.error != None
+
+    def add(self, index, result, error, started, finished) :
+        self.started = started if self.started == None else min(self.started, started)
+        self.finished = finished if self.finished == None else max(self.finished, finished)
+        if error != None :
+            self.fail(error)
+        if self.error != None :
+            if self.mode == 'csv' and result != None and os.path.exists(result) :
+                os.remove(result)       # (a part that finished after something failed)
+            return
+        self.results[index] = result
+        try :
+            while self.next in self.results :
+                self.use(self.results.pop(self.next))
+                self.next += 1
+            if self.next == self.npieces :
+                self.finish()
+        except Exception :
+            self.fail(traceback.format_exc())
+
+    # handles piece self.next (they're used strictly in order)
+    def use(self, result) :
+        if self.mode == 'cap' :
+            if self.writer == None :
+                self.writer = capfile.CaptureWriter(self.outname, info={'source' : os.path.basename(self.fname)})
+            for desc, blocks in result :
+                self.writer.appendEncoded(desc, blocks)
+        elif self.mode == 'csv' :
+            if self.next == 0 :
+                with open(self.outname, "w") as fout :
+                    fout.write(histdata.STREAM_CSV_HEADER)
+            with open(self.outname, "a") as fout :
+                with open(result, "r") as fin :
+                    while True :
+                        buf = fin.read(1 << 20)
+                        if len(buf) == 0 :
+                            break
+                        fout.write(buf)
+            os.remove(result)
+        elif self.mode == 'summary' :
+            self.summary = mergeSummaries([self.summary or {'n' : 0}, result])
+
+    def finish(self) :
+        if self.writer != None :
+            self.writer.close()
+
+    def fail(self, error) :
+        if self.error == None :
+            self.error = error
+            if self.writer != None :
+                self.writer.close()
+            if self.outname != None and self.mode != 'summary' and os.path.exists(self.outname) :
+                os.remove(self.outname)
+        for result in self.results.values() :
+            if self.mode == 'csv' and result != None and os.path.exists(result) :
+                os.remove(result)
+        self.results = {}
+        self.summary = None     # (just the pieces before the failure)
+
+    def report(self) :
+        secs = max(self.finished - self.started, 1e-6) if self.started != None else 0.0
+        name = os.path.basename(self.fname)
+        if self.error != None :
+            return "%-40s FAILED:\n%s" % (name, self.error)
+        recs = "%10i recs" % self.nrecords if self.nrecords != None else " " * 15
+        return "%-40s %s %9.1f MB %8.2f s %8.1f MB/s" % (name, recs, self.nbytes / 1e6, secs,
+                                                          self.nbytes / 1e6 / max(secs, 1e-6))
+
+
+# The summary csv's rows, by file: (size, mtime, line)
+def readSummaries(fname) :
+    rows = {}
+    if os.path.exists(fname) :
+        with open(fname, "r") as fin :
+            fin.readline()
+            for line in fin :
+                fields = [f.strip() for f in line.split(',')]
+                if len(fields) >= 3 :
+                    rows[fields[0]] = (int(fields[1]), float(fields[2]), line)
+    return rows
+
+def summaryLine(fname, s) :
+    if s['n'] == 0 :
+        return "%s, %i, %.3f, 0, 0, 0, 0, 0\n" % (fname, os.path.getsize(fname), os.path.getmtime(fname))
+    secs = (s['t1'] - s['t0']) * histdata.HIST_TICK
+    return "%s, %i, %.3f, %i, %f, %f, %f, %f\n" % (fname, os.path.getsize(fname), os.path.getmtime(fname),
+            s['n'], secs, (s['n'] - 1) / secs if secs > 0 else 0.0,
+            np.sqrt(s['sumsq'] / s['n']), s['maxabs'])
+
+
+# Splits the files up into pieces of work and runs them. Returns the FileJobs.
+def run(mode, fnames, outnames, processes=None) :
+    jobs = {}
+    tasks = []
+    for fname, outname in zip(fnames, outnames) :
+        n = countRecords(fname) if mode != 'npy' else None
+        if n == 0 :
+            print("%-40s (empty)" % os.path.basename(fname))
+            jobs[fname] = FileJob(mode, fname, outname, 0, 0)
+            jobs[fname].summary = {'n' : 0}
+            continue
+        if n == None :
+            jobs[fname] = FileJob(mode, fname, outname, 1, None)
+            tasks.append((mode, fname, outname, 0, None, None))
+            continue
+        starts = range(0, n, PIECE_RECORDS)
+        jobs[fname] = FileJob(mode, fname, outname, len(starts), n)
+        for i, start in enumerate(starts) :
+            tasks.append((mode, fname, outname, i, start, min(start + PIECE_RECORDS, n)))
+
+    start = time.time()
+    nbytes = 0
+    pool = multiprocessing.Pool(processes)
+    try :
+        for fname, index, result, error, t0, t1 in pool.imap_unordered(runPiece, tasks) :
+            job = jobs[fname]
+            job.add(index, result, error, t0, t1)
+            if job.done() and not job.reported :
+                print(job.report())
+                nbytes += job.nbytes
+                job.reported = True
+        pool.close()
+    except :
+        pool.terminate()
+        raise
+    finally :
+        pool.join()
+    secs = max(time.time() - start, 1e-6)
+    print("%i files, %.1f MB in %.2f s (%.1f MB/s)" % (len(jobs), nbytes / 1e6, secs, nbytes / 1e6 / secs))
+    return [jobs[f] for f in fnames if f in jobs]
+
+
+def main(argv) :
+    parser = argparse.ArgumentParser(prog='dumpreader.py --batch', description='Converts or summarizes captures in parallel.')
+    parser.add_argument('paths', nargs='+', help='files, directories or (quoted) globs')
+    parser.add_argument('--csv', action='store_true', help='convert .bin/.cap captures to .csv')
+    parser.add_argument('--summary', action='store_true', help='summarize the files instead of converting them')
+    parser.add_argument('--out', default=SUMMARY_CSV, help='summary file (default %s)' % SUMMARY_CSV)
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--force', action='store_true', help='redo files that are up to date')
+    args = parser.parse_args(argv)
+
+    fnames = findInputs(args.paths, [args.out] if args.summary else [])
+    if args.summary :
+        old = readSummaries(args.out) if not args.force else {}
+        todo = [f for f in fnames if not (f in old and old[f][0] == os.path.getsize(f) and
+                                          abs(old[f][1] - os.path.getmtime(f)) < 0.01)]
+        print("Summarizing %i files (%i up to date)" % (len(todo), len(fnames) - len(todo)))
+        jobs = run('summary', todo, [None] * len(todo), args.jobs)
+        lines = dict([(f, old[f][2]) for f in fnames if f in old])
+        for job in jobs :
+            if job.error != None :
+                lines.pop(job.fname, None)      # (so it's tried again next time)
+            elif job.summary != None :
+                lines[job.fname] = summaryLine(job.fname, job.summary)
+        with open(args.out, "w") as fout :
+            fout.write(SUMMARY_HEADER)
+            for f in fnames :
+                if f in lines :
+                    fout.write(lines[f])
+        print("Wrote %s" % args.out)
+    else :
+        # one input per output: a .bin that's been packed into a .cap makes the
+        # same csv as the .cap, so only the .cap is used (as catalog.captureFiles does)
+        sources = {}
+        for f in fnames :
+            outname = outputName(f, args.csv)
+            if outname == None :
+                continue
+            if outname in sources :
+                keep = min(sources[outname], f, key=lambda name : SOURCE_PREFERENCE.index(os.path.splitext(name)[1].lower()))
+                print("%s: skipped, %s makes the same %s" % (f if keep != f else sources[outname], keep, outname))
+                sources[outname] = keep
+            else :
+                sources[outname] = f
+        todo = []
+        for f in fnames :
+            outname = outputName(f, args.csv)
+            if outname != None and sources[outname] == f and (args.force or not upToDate(f, outname)) :
+                todo.append((f, outname))
+        print("Converting %i files (%i up to date or nothing to do)" % (len(todo), len(fnames) - len(todo)))
+        csvs = [t for t in todo if t[0].lower().endswith('.csv')]
+        caps = [t for t in todo if not t[0].lower().endswith('.csv')]
+        jobs = []
+        if len(caps) > 0 :
+            jobs += run('csv' if args.csv else 'cap', [t[0] for t in caps], [t[1] for t in caps], args.jobs)
+        if len(csvs) > 0 :
+            jobs += run('npy', [t[0] for t in csvs], [t[1] for t in csvs], args.jobs)
+    return 1 if any([job.error != None for job in jobs]) else 0
+
+
+if __name__ == "__main__" :
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,169 @@
+########################################################
+# Control Design GUI: capcache.py
+# Keeps recently viewed captures decoded, and loads the next ones ahead of time.
+#
+# Ben Weiss, University of Washington
+# Summer 2014
+#
+# Flipping between captures in the dump reader used to mean reading and
+# decoding each one from scratch every time it was selected. A CaptureCache
+# holds whatever a load function makes of a file (the dump reader's: the decoded
+# channels and their min/max decimation pyramids), keyed by path, modification
+# time and size so an edited file is loaded again. It's bounded by bytes rather
+# than entries; the least recently used entries go first when it's over budget.
+#
+# prefetch() loads files on a background thread -- the neighbours of the one
+# being looked at, say -- so that by the time they're selected they're already
+# here. If a file that's being prefetched is asked for, get() waits for that
+# load rather than starting another.
+#
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+########################################################
+
+import os, threading, traceback
+from collections import OrderedDict
+import numpy as np
+
+
+CACHE_BYTES = 512 << 20     # default budget
+
+
+# bytes used by the numpy arrays in (nested lists/tuples/dicts/objects of) value,
+# each array counted once however many times it turns up
+def sizeOf(value, seen=None) :
+    if seen == None :
+        seen = set()
+    if id(value) in seen :
+        return 0
+    seen.add(id(value))
+    if isinstance(value, np.ndarray) :
+        base = value
+        while isinstance(base.base, np.ndarray) :
+            base = base.base
+        if base is not value :
+            return sizeOf(base, seen)
+        return value.nbytes
+    if isinstance(value, dict) :
+        return sum([sizeOf(v, seen) for v in value.values()])
+    if isinstance(value, (list, tuple)) :
+        return sum([sizeOf(v, seen) for v in value])
+    if hasattr(value, '__dict__') :
+        return sizeOf(value.__dict__, seen)
+    return 0
+
+
+def cacheKey(path) :
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_mtime, st.st_size)
+
+
+class CaptureCache :
+
+    def __init__(self, load, budget=CACHE_BYTES) :
+        self.load = load            # load(path) -> whatever's kept for it
+        self.budget = budget
+        self.entries = OrderedDict()    # key -> (value, bytes), oldest first
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.loading = {}           # key -> threading.Event, while the prefetcher loads it
+        self.queue = []             # paths waiting to be prefetched
+        self.wake = threading.Condition(self.lock)
+        self.thread = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) :
+        return len(self.entries)
+
+    def __contains__(self, path) :
+        return cacheKey(path) in self.entries
+
+    # the loaded form of path, from the cache if possible
+    def get(self, path) :
+        key = cacheKey(path)
+        with self.lock :
+            pending = self.loading.get(key)
+        if pending != None :
+            pending.wait()
+        with self.lock :
+            if key in self.entries :
+                self.hits += 1
+                value, size = self.entries.pop(key)
+                self.entries[key] = (value, size)       # (now the newest)
+                return value
+            self.misses += 1
+        value = self.load(path)
+        self._put(key, value)
+        return value
+
+    # Loads paths in the background, in order, dropping whatever was asked for
+    # before (it's presumably not wanted any more).
+    def prefetch(self, paths) :
+        with self.lock :
+            self.queue = list(paths)
+            if self.thread == None :
+                self.thread = threading.Thread(target=self._prefetcher, name='CaptureCache prefetch')
+                self.thread.daemon = True
+                self.thread.start()
+            self.wake.notify()
+
+    def clear(self) :
+        with self.lock :
+            self.entries.clear()
+            self.nbytes = 0
+
+    def _put(self, key, value) :
+        size = sizeOf(value)
+        with self.lock :
+            # an older version of the same file isn't any use now
+            for old in [k for k in self.entries if k[0] == key[0]] :
+                self.nbytes -= self.entries.pop(old)[1]
+            if size > self.budget :
+                return
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.budget :
+                self.nbytes -= self.entries.popitem(last=False)[1][1]
+
+    def _prefetcher(self) :
+        while True :
+            with self.lock :
+                while len(self.queue) == 0 :
+                    self.wake.wait()
+                path = self.queue.pop(0)
+                try :
+                    key = cacheKey(path)
+                except OSError :
+                    continue
+                if key in self.entries or key in self.loading :
+                    continue
+                done = self.loading[key] = threading.Event()
+            try :
+                self._put(key, self.load(path))
+            except Exception :
+                traceback.print_exc()
+            finally :
+                with self.lock :
+                    del self.loading[key]
+                done.set()
@@ -0,0 +1,372 @@
+########################################################
+# Control Design GUI: capfile.py
+# Single-file stream captures: records, machine snapshot and index together.
+#
+# Ben Weiss, University of Washington
+# Summer 2014
+#
+# A .cap file is laid out as
+#   FILE_MAGIC, header length (uint32), header (json: record schema, the
+#       machine.xml snapshot, and any other info)
+#   chunks, each one:
+#       CHUNK_MAGIC, descriptor length (uint32), descriptor (json: record count,
+#       first/last time, codec, and the encoded length of each column),
+#       then each column's block, encoded with the chunk's codec
+#   footer (json: every chunk descriptor plus its file offset), footer offset
+#       (uint64), END_MAGIC
+# All integers are little-endian. A reader only needs the footer to find any
+# chunk, and any one channel of a chunk can be read without the others. If the
+# footer is missing (the capture was never closed), the chunks are found by
+# walking them from the start instead.
+#
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+########################################################
+
+import bisect, json, os, struct, time, zlib
+import numpy as np
+
+import histdata
+import histcodec
+
+
+FILE_MAGIC = 'IMCCAP01'
+CHUNK_MAGIC = 'CHNK'
+END_MAGIC = 'IMCEND01'
+CAPTURE_EXT = '.cap'
+CHUNK_RECORDS = histdata.CHUNK_RECORDS
+DEFAULT_CODEC = 'delta-zlib'
+CACHE_CHUNKS = 4            # decoded chunks a CaptureFile keeps around
+
+lenStruct = struct.Struct('<I')
+endStruct = struct.Struct('<Q8s')
+
+
+# Column block codecs: name -> (encode(array) -> str, decode(str, dtype, n) -> array)
+CODECS = {
+    'none' : (lambda col : col.tostring(),
+              lambda data, dtype, n : np.frombuffer(data, dtype, n)),
+    'zlib' : (lambda col : zlib.compress(col.tostring(), 1),
+              lambda data, dtype, n : np.frombuffer(zlib.decompress(data), dtype, n)),
+}
+CODECS.update(histcodec.CODECS)     # delta-zlib, and delta-lzma if lzma is installed
+
+
+def _schema(dtype) :
+    return [[name, dtype[name].str] for name in dtype.names]
+
+def _dtype(schema) :
+    return np.dtype([(str(name), str(t)) for name, t in schema])
+
+
+# Writes a .cap file. Records can be added as HIST_DTYPE arrays or as raw bytes
+# straight from a data stream (a partial record is held until the rest arrives).
+# Nothing is readable as a finished capture until close() writes the footer.
+class CaptureWriter :
+
+    def __init__(self, fname, machine='', info=None, codec=DEFAULT_CODEC,
+                 chunk_records=CHUNK_RECORDS, dtype=histdata.HIST_DTYPE) :
+        if not codec in CODECS :
+            raise ValueError("Unknown capture codec '%s'" % codec)
+        self.fname = fname
+        self.dtype = dtype
+        self.codec = codec
+        self.chunk_records = chunk_records
+        self.chunks = []        # descriptors of the chunks written so far
+        self.pending = []       # record arrays not yet written
+        self.npending = 0
+        self.partial = ''       # bytes of an incomplete record
+        self.count = 0
+        self.stats = histcodec.CodecStats()
+
+        header = {'version' : 1, 'schema' : _schema(dtype), 'machine' : machine,
+                  'info' : info or {}}
+        self.fout = open(fname, "wb")
+        self.fout.write(FILE_MAGIC)
+        self._writeBlob(json.dumps(header))
+
+    def __len__(self) :
+        return self.count + self.npending
+
+    def append(self, recs) :
+        if isinstance(recs, str) :
+            data = self.partial + recs
+            n = len(data) // self.dtype.itemsize
+            self.partial = data[n * self.dtype.itemsize:]
+            if n == 0 :
+                return
+            recs = np.frombuffer(data, self.dtype, n)
+        if len(recs) == 0 :
+            return
+        self.pending.append(recs)
+        self.npending += len(recs)
+        while self.npending >= self.chunk_records :
+            self._writeChunk(self.chunk_records)
+
+    # writes out everything appended so far (as a short chunk if need be)
+    def flush(self) :
+        if self.npending > 0 :
+            self._writeChunk(self.npending)
+        self.fout.flush()
+
+    def close(self) :
+        if self.fout == None :
+            return
+        self.flush()
+        footer_pos = self.fout.tell()
+        self.fout.write(json.dumps({'chunks' : self.chunks}))
+        self.fout.write(endStruct.pack(footer_pos, END_MAGIC))
+        self.fout.close()
+        self.fout = None
+
+    def _writeBlob(self, txt) :
+        self.fout.write(lenStruct.pack(len(txt)))
+        self.fout.write(txt)
+
+    # writes a chunk made by encodeChunk (e.g. on another process). Anything
+    # appended before it is flushed first, so the records stay in order.
+    def appendEncoded(self, desc, blocks) :
+        self.flush()
+        self._putChunk(desc, blocks)
+
+    def _putChunk(self, desc, blocks) :
+        desc = dict(desc)
+        txt = json.dumps(desc)
+        self.fout.write(CHUNK_MAGIC)
+        self._writeBlob(txt)
+        desc['offset'] = self.fout.tell()       # where the column blocks start
+        for b in blocks :
+            self.fout.write(b)
+        self.chunks.append(desc)
+        self.count += desc['n']
+
+    def _writeChunk(self, n) :
+        recs = np.concatenate(self.pending) if len(self.pending) > 1 else self.pending[0]
+        rest = recs[n:]
+        recs = recs[:n]
+        self.pending = [rest] if len(rest) > 0 else []
+        self.npending = len(rest)
+
+        desc, blocks = encodeChunk(recs, self.codec, self.stats)
+        self._putChunk(desc, blocks)
+
+
+# Encodes one chunk's worth of records: returns its descriptor and the encoded
+# column blocks, ready for CaptureWriter.appendEncoded.
+def encodeChunk(recs, codec=DEFAULT_CODEC, stats=None) :
+    encode = CODECS[codec][0]
+    start = time.time()
+    blocks = [encode(np.ascontiguousarray(recs[name])) for name in recs.dtype.names]
+    if stats != None :
+        stats.addEncode(recs.nbytes, sum([len(b) for b in blocks]), time.time() - start)
+    desc = {'n' : len(recs), 't0' : int(recs['time'][0]), 't1' : int(recs['time'][-1]),
+            'codec' : codec,
+            'columns' : [[name, len(b)] for name, b in zip(recs.dtype.names, blocks)]}
+    return desc, blocks
+
+
+# Reads a .cap file. Offers the same interface as histdata.CaptureReader
+# (capture['channel'], capture[i:j], seconds, indexAt, timeSlice, timeRange), so
+# either can be plotted the same way. Only the chunks (and the channels in them)
+# that are asked for get read and decoded.
+class CaptureFile :
+
+    def __init__(self, fname) :
+        self.fname = fname
+        self.fin = open(fname, "rb")
+        if self.fin.read(len(FILE_MAGIC)) != FILE_MAGIC :
+            self.fin.close()
+            raise ValueError("%s is not a capture file" % fname)
+        header = json.loads(self._readBlob())
+        self.dtype = _dtype(header['schema'])
+        self.machine = header.get('machine', '')
+        self.info = header.get('info', {})
+        self.chunks = self._readFooter()
+        self.complete = self.chunks != None     # False if it was never closed
+        if not self.complete :
+            self.chunks = self._scanChunks()
+
+        # first record number of each chunk, and each chunk's last time
+        self.starts = [0]
+        for c in self.chunks :
+            self.starts.append(self.starts[-1] + c['n'])
+        self.t1s = [c['t1'] for c in self.chunks]
+        self.cache = {}         # (chunk #, channel) -> decoded column
+        self.cache_order = []
+        self.stats = histcodec.CodecStats()
+
+    def __len__(self) :
+        return self.starts[-1]
+
+    def __getitem__(self, key) :
+        if isinstance(key, slice) :
+            start, stop, step = key.indices(len(self))
+            return self.records(start, stop)[::step]
+        return self.channel(key)
+
+    # the named channel for records start to stop
+    def channel(self, name, start=0, stop=None) :
+        start, stop = self._range(start, stop)
+        parts = []
+        for ci in range(self._chunkOf(start), len(self.chunks)) :
+            if self.starts[ci] >= stop :
+                break
+            col = self._column(ci, name)
+            parts.append(col[max(0, start - self.starts[ci]):stop - self.starts[ci]])
+        if len(parts) == 0 :
+            return np.zeros(0, self.dtype[name])
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+    # records start to stop, as an array of the capture's record dtype
+    def records(self, start=0, stop=None) :
+        start, stop = self._range(start, stop)
+        recs = np.zeros(max(0, stop - start), self.dtype)
+        for name in self.dtype.names :
+            recs[name] = self.channel(name, start, stop)
+        return recs
+
+    def seconds(self, start=0, stop=None) :
+        return self.channel('time', start, stop) * histdata.HIST_TICK
+
+    # index of the first record at or after t seconds
+    def indexAt(self, t) :
+        tick = int(np.ceil(t / histdata.HIST_TICK))
+        ci = bisect.bisect_left(self.t1s, tick)
+        if ci >= len(self.chunks) :
+            return len(self)
+        return self.starts[ci] + int(np.searchsorted(self._column(ci, 'time'), tick))
+
+    def timeSlice(self, t0, t1) :
+        return self.records(self.indexAt(t0), self.indexAt(t1))
+
+    def timeRange(self) :
+        if len(self.chunks) == 0 :
+            return (0.0, 0.0)
+        return (self.chunks[0]['t0'] * histdata.HIST_TICK, self.chunks[-1]['t1'] * histdata.HIST_TICK)
+
+    def close(self) :
+        self.fin.close()
+        self.cache = {}
+        self.cache_order = []
+
+    def _range(self, start, stop) :
+        if stop == None or stop > len(self) :
+            stop = len(self)
+        return max(0, start), stop
+
+    def _chunkOf(self, i) :
+        return max(0, bisect.bisect_right(self.starts, i) - 1)
+
+    def _column(self, ci, name) :
+        key = (ci, name)
+        if key in self.cache :
+            return self.cache[key]
+        c = self.chunks[ci]
+        offset = c['offset']
+        for cname, length in c['columns'] :
+            if cname == name :
+                break
+            offset += length
+        else :
+            raise KeyError(name)
+        if not c['codec'] in CODECS :
+            raise ValueError("%s: no codec '%s' (is lzma installed?)" % (self.fname, c['codec']))
+        self.fin.seek(offset)
+        data = self.fin.read(length)
+        start = time.time()
+        col = CODECS[c['codec']][1](data, self.dtype[str(name)], c['n'])
+        self.stats.addDecode(col.nbytes, length, time.time() - start)
+        self.cache[key] = col
+        self.cache_order.append(key)
+        if len(self.cache_order) > CACHE_CHUNKS * len(self.dtype.names) :
+            del self.cache[self.cache_order.pop(0)]
+        return col
+
+    def _readBlob(self) :
+        n = lenStruct.unpack(self.fin.read(lenStruct.size))[0]
+        return self.fin.read(n)
+
+    # returns the chunk list from the footer, or None if there isn't one
+    def _readFooter(self) :
+        self.fin.seek(0, os.SEEK_END)
+        end = self.fin.tell()
+        if end < endStruct.size :
+            return None
+        self.fin.seek(end - endStruct.size)
+        footer_pos, magic = endStruct.unpack(self.fin.read(endStruct.size))
+        if magic != END_MAGIC or footer_pos >= end :
+            return None
+        self.fin.seek(footer_pos)
+        try :
+            return json.loads(self.fin.read(end - endStruct.size - footer_pos))['chunks']
+        except ValueError :
+            return None
+
+    # finds the chunks by walking them from the start (for unclosed captures)
+    def _scanChunks(self) :
+        chunks = []
+        self.fin.seek(len(FILE_MAGIC))
+        self._readBlob()
+        while self.fin.read(len(CHUNK_MAGIC)) == CHUNK_MAGIC :
+            try :
+                desc = json.loads(self._readBlob())
+            except (ValueError, struct.error) :
+                break
+            desc['offset'] = self.fin.tell()
+            size = sum([length for name, length in desc['columns']])
+            self.fin.seek(size, os.SEEK_CUR)
+            if self.fin.tell() > os.fstat(self.fin.fileno()).st_size :
+                break       # last chunk was cut off
+            chunks.append(desc)
+        return chunks
+
+
+# Packs a raw stream capture (.bin) into a .cap file. Returns the number of records.
+def convertCapture(binfname, capfname, machine='', info=None, codec=DEFAULT_CODEC) :
+    w = CaptureWriter(capfname, machine, info, codec)
+    try :
+        for recs in histdata.iterRawRecords(binfname) :
+            w.append(recs)
+    finally :
+        w.close()
+    return len(w)
+
+
+# True if capfname opens as a complete capture holding as many records as the
+# raw capture binfname -- checked before the .bin is thrown away.
+def packedComplete(capfname, binfname) :
+    try :
+        cap = CaptureFile(capfname)
+    except (IOError, ValueError, KeyError, struct.error) :
+        return False
+    try :
+        return cap.complete and len(cap) == os.path.getsize(binfname) // histdata.HIST_DTYPE.itemsize
+    finally :
+        cap.close()
+
+
+# Opens a capture of either kind: a .cap file, or a raw .bin stream capture.
+def openCapture(fname) :
+    if fname[-len(CAPTURE_EXT):].lower() == CAPTURE_EXT :
+        return CaptureFile(fname)
+    return histdata.CaptureReader(fname)
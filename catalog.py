@@ -0,0 +1,284 @@
+########################################################
+# Control Design GUI: catalog.py
+# A searchable index of the captures in a directory.
+#
+# Ben Weiss, University of Washington
+# Summer 2014
+#
+# Listing a directory of captures is easy, but finding the one you want means
+# opening them. So a Catalog keeps an SQLite database (catalog.sqlite, in the
+# directory itself) with a row per capture: its size and modification time (to
+# tell when it needs indexing again), record count, duration, record rate,
+# tracking error, a small min/max preview of the position and tracking error,
+# and the machine settings it was taken with -- from a .cap's own snapshot, or
+# from the machine xml saved alongside a control history or stream. Those
+# settings also go in a params table so captures can be found by them.
+#
+# update() only indexes files that are new or have changed (and forgets ones
+# that are gone); stale() and index() do the same a file at a time, so a GUI can
+# do a big first indexing on another thread (with a Catalog of its own there: an
+# SQLite connection only works on the thread that opened it).
+#
+# find() takes a filter string of space-separated terms:
+#   word            the file name contains word
+#   records>1e6     a summary column compared with a number (records, duration,
+#                   rate, err_rms, err_max, size); < <= = != >= > all work
+#   kpp=0.5         a machine parameter, by command (or name, if it has no
+#                   spaces) -- compared as numbers if both sides are
+#
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+########################################################
+
+import os, re, sqlite3
+import xml.etree.cElementTree as ET
+import numpy as np
+
+import histdata
+import capfile
+import decimate
+import batch
+
+
+CATALOG_NAME = 'catalog.sqlite'
+SCHEMA_VERSION = 1
+PREVIEW_COLUMNS = 300       # min/max pairs in each preview
+NUMERIC_COLUMNS = ('records', 'duration', 'rate', 'err_rms', 'err_max', 'size')
+MACHINE_SUFFIX = 'machine.xml'
+CAPTURE_KINDS = ('ctrlHistory', 'ctrlStream', 'stream')    # what capture names end in, before the extension
+
+SCHEMA = """
+CREATE TABLE captures (name TEXT PRIMARY KEY, size INTEGER, mtime REAL,
+                       records INTEGER, duration REAL, rate REAL,
+                       err_rms REAL, err_max REAL, machine TEXT,
+                       preview_pos BLOB, preview_err BLOB, error TEXT);
+CREATE TABLE params (capture TEXT, cmd TEXT, name TEXT, value TEXT);
+CREATE INDEX params_capture ON params (capture);
+CREATE INDEX params_cmd ON params (cmd, value);
+"""
+
+_TERM = re.compile(r'^([^<>=!]+)(<=|>=|!=|=|<|>)(.+)$')
+_KIND = re.compile(r'^(.*_.*?)(%s)$' % '|'.join(CAPTURE_KINDS))
+
+
+# The captures in a file list, as the dump reader shows them: .cap and .csv
+# files, and .bins that haven't been converted to either.
+def captureFiles(files) :
+    names = set(files)
+    found = []
+    for f in files :
+        base, ext = os.path.splitext(f)
+        ext = ext.lower()
+        if ext in ('.csv', capfile.CAPTURE_EXT) or (ext == '.bin' and not base + '.csv' in names
+                                                    and not base + capfile.CAPTURE_EXT in names) :
+            found.append(f)
+    return sorted(found)
+
+
+# The settings (non-volatile, writable parameters) in a machine xml: [(cmd, name, value), ...]
+def machineParams(xmltext) :
+    params = []
+    try :
+        root = ET.fromstring(xmltext)
+    except (SyntaxError, ValueError) :
+        return params
+    for child in root :
+        if child.tag != 'Parameters' :
+            continue
+        for p in child :
+            if p.attrib.get('volatile') == '1' or p.attrib.get('readonly') == '1' :
+                continue
+            params.append((p.attrib.get('cmd', ''), p.attrib.get('name', ''), (p.text or '').strip()))
+    return params
+
+
+def _blob(x, y) :
+    return sqlite3.Binary(np.vstack((x, y)).astype('<f4').tostring())
+
+def _unblob(data) :
+    if data == None :
+        return np.zeros(0, np.float32), np.zeros(0, np.float32)
+    xy = np.frombuffer(str(data), '<f4').reshape(2, -1)
+    return xy[0], xy[1]
+
+
+class Catalog :
+
+    def __init__(self, dirname, fname=CATALOG_NAME) :
+        self.dirname = dirname
+        self.db = sqlite3.connect(os.path.join(dirname, fname))
+        self.db.row_factory = sqlite3.Row
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION :
+            # new (or from an older version of this file): start over
+            self.db.executescript("DROP TABLE IF EXISTS captures; DROP TABLE IF EXISTS params;" + SCHEMA +
+                                  "PRAGMA user_version = %i;" % SCHEMA_VERSION)
+            self.db.commit()
+
+    def close(self) :
+        self.db.close()
+
+    # Captures that are new or changed since they were indexed. Rows for files
+    # that no longer exist are dropped along the way.
+    def stale(self) :
+        files = captureFiles(os.listdir(self.dirname))
+        known = dict([(r['name'], (r['size'], r['mtime'])) for r in
+                      self.db.execute("SELECT name, size, mtime FROM captures")])
+        gone = [name for name in known if not name in files]
+        for name in gone :
+            self._forget(name)
+        if len(gone) > 0 :
+            self.db.commit()
+        todo = []
+        for f in files :
+            st = os.stat(os.path.join(self.dirname, f))
+            if known.get(f) != (st.st_size, st.st_mtime) :
+                todo.append(f)
+        return todo
+
+    # indexes everything that's stale; returns how many files that was
+    def update(self) :
+        todo = self.stale()
+        for f in todo :
+            self.index(f)
+        return len(todo)
+
+    # (re)indexes one capture. A file that can't be read still gets a row (with
+    # the error), so it isn't tried again until it changes.
+    def index(self, name) :
+        path = os.path.join(self.dirname, name)
+        st = os.stat(path)
+        row = {'name' : name, 'size' : st.st_size, 'mtime' : st.st_mtime, 'records' : None,
+               'duration' : None, 'rate' : None, 'err_rms' : None, 'err_max' : None,
+               'machine' : None, 'preview_pos' : None, 'preview_err' : None, 'error' : None}
+        params = []
+        recs = None
+        try :
+            recs, machine = self._open(path)
+            row['machine'] = machine
+            if machine :
+                params = machineParams(machine)
+            s = batch.summarize(recs)
+            row['records'] = s['n']
+            if s['n'] > 0 :
+                row['duration'] = (s['t1'] - s['t0']) * histdata.HIST_TICK
+                row['rate'] = (s['n'] - 1) / row['duration'] if row['duration'] > 0 else 0.0
+                row['err_rms'] = np.sqrt(s['sumsq'] / s['n'])
+                row['err_max'] = s['maxabs']
+                ts = recs['time'] * histdata.HIST_TICK
+                ps = recs['position']
+                err = recs['target_pos'] - ps
+                for key, y in (('preview_pos', ps), ('preview_err', err)) :
+                    x, y = decimate.MinMaxLOD(ts, y).envelope(ts[0], ts[-1], PREVIEW_COLUMNS)
+                    row[key] = _blob(x, y)
+        except Exception as e :
+            row['error'] = '%s: %s' % (type(e).__name__, e)
+        finally :
+            if hasattr(recs, 'close') :
+                recs.close()
+        self._forget(name)
+        cols = sorted(row.keys())
+        self.db.execute("INSERT INTO captures (%s) VALUES (%s)" % (', '.join(cols), ', '.join(['?'] * len(cols))),
+                        [row[c] for c in cols])
+        self.db.executemany("INSERT INTO params (capture, cmd, name, value) VALUES (?, ?, ?, ?)",
+                            [(name,) + p for p in params])
+        self.db.commit()
+
+    # Catalog rows (name, records, duration, rate, err_rms, err_max, error...)
+    # matching a filter string (see the top of the file), by name.
+    def find(self, text='') :
+        where = []
+        args = []
+        for term in text.split() :
+            m = _TERM.match(term)
+            if m == None :
+                where.append("name LIKE ? ESCAPE '\\'")
+                args.append('%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+                continue
+            key, op, value = m.groups()
+            op = '<>' if op == '!=' else op
+            try :
+                num = float(value)
+            except ValueError :
+                num = None
+            if key in NUMERIC_COLUMNS :
+                if num == None :
+                    raise ValueError("%s needs a number" % key)
+                where.append("%s %s ?" % (key, op))
+                args.append(num)
+            elif num != None :
+                where.append("name IN (SELECT capture FROM params WHERE (cmd = ? OR name = ?) AND "
+                             "CAST(value AS REAL) %s ?)" % op)
+                args += [key, key, num]
+            else :
+                where.append("name IN (SELECT capture FROM params WHERE (cmd = ? OR name = ?) AND value %s ?)" % op)
+                args += [key, key, value]
+        sql = "SELECT name, size, mtime, records, duration, rate, err_rms, err_max, error FROM captures"
+        if len(where) > 0 :
+            sql += " WHERE " + " AND ".join(where)
+        return self.db.execute(sql + " ORDER BY name", args).fetchall()
+
+    def get(self, name) :
+        return self.db.execute("SELECT * FROM captures WHERE name = ?", (name,)).fetchone()
+
+    # the machine settings a capture was taken with: [(cmd, name, value), ...]
+    def params(self, name) :
+        return [tuple(r) for r in self.db.execute("SELECT cmd, name, value FROM params WHERE capture = ?", (name,))]
+
+    # ((t, position), (t, tracking error)) previews, as min/max envelopes
+    def preview(self, name) :
+        r = self.db.execute("SELECT preview_pos, preview_err FROM captures WHERE name = ?", (name,)).fetchone()
+        if r == None :
+            return None
+        return _unblob(r[0]), _unblob(r[1])
+
+    def _forget(self, name) :
+        self.db.execute("DELETE FROM captures WHERE name = ?", (name,))
+        self.db.execute("DELETE FROM params WHERE capture = ?", (name,))
+
+    # (records, machine xml or None) for a capture file. The records are the
+    # capture object itself where possible, so only the channels used get read.
+    def _open(self, path) :
+        ext = os.path.splitext(path)[1].lower()
+        if ext == capfile.CAPTURE_EXT :
+            cap = capfile.CaptureFile(path)
+            return cap, cap.machine
+        if ext == '.bin' :
+            recs = histdata.CaptureReader(path)
+        else :
+            recs = histdata.loadCsv(path)
+        return recs, self._pairedMachine(path)
+
+    # A capture is saved next to the machine settings it was taken with, under
+    # the same name with its kind replaced: <timestamp>_ctrlHistory.csv with
+    # <timestamp>_machine.xml, <timestamp>_<port>stream.bin with
+    # <timestamp>_<port>machine.xml, and so on (see CAPTURE_KINDS).
+    def _pairedMachine(self, path) :
+        dirname, name = os.path.split(path)
+        m = _KIND.match(os.path.splitext(name)[0])
+        if m == None :
+            return None
+        mfile = os.path.join(dirname, m.group(1) + MACHINE_SUFFIX)
+        if not os.path.exists(mfile) :
+            return None
+        with open(mfile, "r") as fin :
+            return fin.read()
@@ -6,8 +6,9 @@
 # Ben Weiss, University of Washington
 # Spring 2014
 #
-# This module creates a common comm object that impelements either comm_rawhid.py
-# or comm_serial.py. This would be a good place for some subclassing when I 
+# This module creates a common comm object that impelements either comm_rawhid.py,
+# comm_hidraw.py or comm_serial.py (or the simulated device in comm_sim.py),
+# running on its own I/O thread (comm_thread.py). This would be a good place for some subclassing when I 
 # next rewrite things...
 #
 # This software is distributed under the following license:
@@ -37,17 +38,38 @@
 #
 ########################################################
 
+import sys, os
 from comm_serial import *
 from comm_rawhid import *
+from comm_hidraw import *
+from comm_sim import *
+from comm_thread import *
 
 
 CM_SERIAL = 1
 CM_RAWHID = 2
-COMM_MODE = CM_RAWHID      # or CM_SERIAL
+CM_HIDRAW = 3
+CM_SIM = 4
+# rawhid_listener.exe only builds for Windows; on Linux talk to /dev/hidraw* directly.
+if sys.platform.startswith('linux') :
+    COMM_MODE = CM_HIDRAW
+else :
+    COMM_MODE = CM_RAWHID      # or CM_SERIAL
+# set IMC_SIMULATE=1 in the environment to run against a simulated device
+if os.environ.get('IMC_SIMULATE', '') not in ('', '0') :
+    COMM_MODE = CM_SIM
 
 if COMM_MODE == CM_SERIAL :
     comm = Serobj()
 elif COMM_MODE == CM_RAWHID :
     comm = Rawhid()
+elif COMM_MODE == CM_HIDRAW :
+    comm = Hidraw()
+elif COMM_MODE == CM_SIM :
+    comm = Simobj()
 else :
-    comm = None
\ No newline at end of file
+    comm = None
+
+# the transport is only ever touched from the I/O thread from here on.
+if comm != None :
+    comm = CommThread(comm)
\ No newline at end of file
@@ -0,0 +1,375 @@
+########################################################
+# Control Design GUI: comm_hidraw.py
+# Talks to the Teensy directly through the Linux hidraw driver.
+#
+# Ben Weiss, University of Washington
+# Summer 2014
+#
+# This module is an in-process replacement for comm_rawhid.py on Linux. Instead
+# of piping every command and line of text through rawhid_listener.exe, it
+# reads and writes the 64-byte RawHID reports straight from /dev/hidraw* using
+# non-blocking I/O, and decodes the packet headers (see rawhid_listener/main.cpp
+# and rawhid_msg.h in the firmware) itself.
+#
+# Any file descriptor that behaves like a hidraw node (a socketpair or pty
+# carrying 64-byte reports) can be used in place of a real device with Attach().
+#
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+########################################################
+
+import os, sys, time, glob, errno, select, fcntl
+from ringbuffer import LineBuffer
+
+
+HID_PACKET_SIZE = 64        # every RawHID report is exactly this long
+TX_TIMEOUT = 100            # ms
+RX_TIMEOUT = 100            # ms
+HIDRAW_BUF_SIZE = 1 << 20   # bytes of unread text we'll hold on to
+
+# Message flags. These mirror the constants in rawhid_listener/main.cpp, which are
+# in turn identical to rawhid_msg.h with RX and TX switched.
+TX_HEAD_DEVID = 0x08        # this is backspace, and shouldn't appear in a normal text transmission...
+RX_HEAD_DEVID = 0xFC        # for querying the deviceid, this is the entire header
+
+RX_PACK_TYPE_TEXT = 0x00
+RX_PACK_TYPE_DATA0 = 0x01
+RX_PACK_TYPE_DATA1 = 0x02
+RX_PACK_TYPE_DATA2 = 0x03
+RX_PACK_TYPE_MASK = 0x03
+
+# USB ids the Teensy RawHID examples enumerate with (C-based, then Arduino-based)
+RAWHID_IDS = [(0x16C0, 0x0480), (0x16C0, 0x0486)]
+# The RawHID interface's report descriptor starts with Usage Page 0xFFAB, Usage 0x0200.
+# This is how we tell it apart from the Teensy's other (serial emulation) hid interface.
+RAWHID_DESCRIPTOR_HEAD = '\x06\xab\xff\x0a\x00\x02'
+
+
+# Packs a list of commands into as few reports as possible, separating them with
+# newlines (the firmware parses the text of a report line by line). Returns the
+# list of report payloads. A command too long for one report gets one to itself.
+def PackCommands(cmds, size=HID_PACKET_SIZE) :
+    packets = []
+    cur = ''
+    for cmd in cmds :
+        if cur == '' :
+            cur = cmd
+        elif len(cur) + 1 + len(cmd) <= size :
+            cur = cur + '\n' + cmd
+        else :
+            packets.append(cur)
+            cur = cmd
+    if cur != '' :
+        packets.append(cur)
+    return packets
+
+
+# Returns a list of /dev/hidraw* nodes that look like a Teensy RawHID interface.
+def FindRawhidNodes() :
+    nodes = []
+    for sysdir in sorted(glob.glob('/sys/class/hidraw/hidraw*')) :
+        try :
+            with open(sysdir + '/device/uevent', 'r') as f :
+                uevent = f.read()
+        except IOError :
+            continue
+        # HID_ID=<bus>:<vendor>:<product>, all in hex
+        for line in uevent.splitlines() :
+            if line.startswith('HID_ID=') :
+                try :
+                    bus, vid, pid = [int(x, 16) for x in line[7:].split(':')]
+                except ValueError :
+                    break
+                if (vid, pid) in RAWHID_IDS :
+                    try :
+                        with open(sysdir + '/device/report_descriptor', 'rb') as f :
+                            if not f.read(len(RAWHID_DESCRIPTOR_HEAD)) == RAWHID_DESCRIPTOR_HEAD :
+                                break
+                    except IOError :
+                        pass    # can't tell; let the devid query sort it out.
+                    nodes.append('/dev/' + os.path.basename(sysdir))
+                break
+    return nodes
+
+
+class Hidraw() :
+
+    def __init__(self) :
+
+        self.open = False
+        self.fd = -1
+        self.buf = LineBuffer(HIDRAW_BUF_SIZE)
+        self.rxpend = ''            # partial report, if the descriptor isn't message-based (pty)
+        self.port = ''
+        self.portlist = []
+        self.devices = {}           # device name -> /dev/hidraw* path, filled by GetComPorts
+        self.report_id = True       # hidraw wants a leading report number on writes
+        self.devid = -1             # last device id reported in a RX_HEAD_DEVID packet
+        self.datafiles = [None, None, None]
+        self.data_to_console = [False, False, False]
+        self.data_callback = None   # if set, called with (ds_id, payload) for each data packet
+
+    def Init(self) :
+        print "hidraw interface active."
+
+
+    # Returns a list of device names (the I2C address each node reports), as
+    # strings, in the same form comm_rawhid's GetComPorts gives them.
+    def GetComPorts(self) :
+        self.portlist = []
+        self.devices = {}
+        for path in FindRawhidNodes() :
+            # don't steal the device out from under ourselves if it's already open.
+            if self.open and self.devices.get(self.port) == path :
+                continue
+            try :
+                fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+            except OSError as e :
+                print "Could not open %s: %s" % (path, e.strerror)
+                continue
+            name = self.QueryDevid(fd)
+            os.close(fd)
+            if name >= 0 :
+                self.devices['%X' % name] = path
+                self.portlist.append('%X' % name)
+        if self.open and self.port not in self.portlist :
+            self.portlist.append(self.port)
+        self.portlist.sort()
+        return self.portlist
+
+
+    # Sends the device id query on fd and returns the id the device reports,
+    # or -1 if it doesn't answer.
+    def QueryDevid(self, fd, report_id=True) :
+        query = chr(TX_HEAD_DEVID) * 3
+        try :
+            self._sendReport(fd, query, report_id)
+        except OSError :
+            return -1
+        deadline = time.time() + 10 * RX_TIMEOUT * 0.001
+        pend = ''
+        while time.time() < deadline :
+            pkt, pend = self._recvReport(fd, pend, RX_TIMEOUT)
+            if pkt is not None and ord(pkt[0]) == RX_HEAD_DEVID :
+                return ord(pkt[1])
+        return -1
+
+
+    # port here is a device name from GetComPorts, as in comm_rawhid.
+    # speed, extra and extra2 are retained for backwards-compatibility
+    def Open(self, port='0', speed='n/a', extra='', extra2='') :
+        if self.open :
+            self.Close()
+        if not port in self.devices :
+            self.GetComPorts()
+        if not port in self.devices :
+            print "No hidraw device named " + port
+            return 0
+        try :
+            fd = os.open(self.devices[port], os.O_RDWR | os.O_NONBLOCK)
+        except OSError as e :
+            print "Could not open %s: %s" % (self.devices[port], e.strerror)
+            return 0
+        self.Attach(fd, port)
+        print "'Opened device " + port
+        return 1
+
+    # Uses an already-open descriptor as the device. report_id should be False for
+    # stand-ins (socketpair, pty) that expect bare 64-byte reports.
+    def Attach(self, fd, port='0', report_id=True) :
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.fd = fd
+        self.port = port
+        self.report_id = report_id
+        self.buf.Clear()
+        self.rxpend = ''
+        self.open = True
+
+    def Close(self) :
+        if self.open :
+            os.close(self.fd)
+        self.fd = -1
+        self.open = False
+        for ds_id in range(0, 3) :
+            self.DataStreamStopSave(ds_id)
+
+    def Quit(self) :
+        self.Close()
+
+    def IsOpen(self) :
+        return self.open
+
+    # Dumps all input waiting on the device to the console.
+    def DumpToConsole(self) :
+        txt = self.Read()
+        if len(txt) > 0 :
+            print txt,
+
+    # Sends <data> to the device (if open). Like rawhid_listener, a command goes
+    # out as a single NUL-padded report.
+    def Write(self, data) :
+        if self.open :
+            if len(data) > HID_PACKET_SIZE :
+                print "Command too long for one packet; truncated: " + data
+            try :
+                self._sendReport(self.fd, data[:HID_PACKET_SIZE], self.report_id)
+            except OSError as e :
+                print "Send failed: " + e.strerror
+
+    # Sends a list of commands to the device, packed several to a report.
+    def WriteMany(self, cmds) :
+        for pkt in PackCommands(cmds) :
+            self.Write(pkt)
+
+    # Reads everything on the current buffer
+    def Read(self) :
+        self.Poll(0)
+        return self.buf.Read()
+
+    # a version of read that blocks until there is at least *something* to read.
+    def ReadBlocking(self, msec) :
+        if len(self.buf) == 0 :
+            self.Poll(msec)
+        return self.Read()
+
+    # Reads until the next newline
+    def ReadLn(self) :
+        txt = ''
+        for i in range(0, 50) :
+            if self.buf.HasLine() :
+                return self.buf.ReadLn()
+            self.Poll(50)
+        else :
+            print "Timeout waiting for readline!"
+        return txt
+
+    # Reads and handles every report waiting on the device, waiting up to msec
+    # for the first one to show up. Returns the number of reports handled.
+    def Poll(self, msec=0) :
+        count = 0
+        if not self.open :
+            return count
+        while True :
+            try :
+                pkt, self.rxpend = self._recvReport(self.fd, self.rxpend, msec if count == 0 else 0)
+            except OSError as e :
+                print "\nerror reading, device went offline: " + e.strerror
+                self.Close()
+                return count
+            if pkt is None :
+                return count
+            self.HandlePacket(pkt)
+            count += 1
+
+    # Decodes one 64-byte report from the device.
+    def HandlePacket(self, pkt) :
+        head = ord(pkt[0])
+        if head == RX_HEAD_DEVID :
+            self.devid = ord(pkt[1])
+        elif (head & RX_PACK_TYPE_MASK) == RX_PACK_TYPE_TEXT :
+            # might not be a complete string.
+            end = pkt.find('\0', 1)
+            if end < 0 :
+                end = HID_PACKET_SIZE
+            self.buf.Append(pkt[1:end])
+        else :
+            ds_id = (head & RX_PACK_TYPE_MASK) - 1
+            if self.data_to_console[ds_id] :
+                self.DumpPacket(pkt)
+            datalen = head >> 2     # read the actual packet length from the header.
+            if datalen < HID_PACKET_SIZE :
+                if self.datafiles[ds_id] :
+                    self.datafiles[ds_id].write(pkt[1:1 + datalen])
+                if self.data_callback is not None :
+                    self.data_callback(ds_id, pkt[1:1 + datalen])
+            else :
+                print "Error: got invalid packet length from header: %i" % datalen
+
+    def DumpPacket(self, pkt) :
+        print "\nrecv %d bytes:" % len(pkt)
+        for i in range(0, len(pkt), 16) :
+            print ' '.join(['%02X' % ord(c) for c in pkt[i:i+16]])
+
+    # scans a string for ads escape sequences and removes them. Not relevent for comm_hidraw.py
+    def AdsScan(self, str) :
+        return str
+
+    # not relevant here.
+    def GetAds(self) :
+        return []
+
+    # start saving a data stream to a given file. ds_id is 0, 1, or 2 and corresponds
+    # to the packet_type in rawhid_msg.h. The file is opened in append mode, as
+    # rawhid_listener does.
+    def DataStreamStartSave(self, ds_id, fname) :
+        if self.open :
+            self.DataStreamStopSave(ds_id)
+            self.datafiles[ds_id] = open(fname, "ab")
+
+    # stops saving a data stream to a file.
+    def DataStreamStopSave(self, ds_id) :
+        if self.datafiles[ds_id] :
+            self.datafiles[ds_id].close()
+            self.datafiles[ds_id] = None
+
+    # Writes data stream packets to the console.
+    def DataStreamToConsole(self, ds_id, enable) :
+        self.data_to_console[ds_id] = enable
+
+
+    # Writes one report to fd, padding data out to the full packet size.
+    def _sendReport(self, fd, data, report_id) :
+        pkt = data + '\0' * (HID_PACKET_SIZE - len(data))
+        if report_id :
+            pkt = '\0' + pkt      # report number; the Teensy doesn't use numbered reports
+        deadline = time.time() + TX_TIMEOUT * 0.001
+        while len(pkt) > 0 :
+            try :
+                n = os.write(fd, pkt)
+                pkt = pkt[n:]
+            except OSError as e :
+                if e.errno != errno.EAGAIN or time.time() > deadline :
+                    raise
+                select.select([], [fd], [], max(0, deadline - time.time()))
+
+    # Reads one report from fd, waiting up to msec for it. pend is whatever part of
+    # a report was left over from the last call (non-hidraw descriptors can split
+    # reports). Returns (report or None, new pend).
+    def _recvReport(self, fd, pend, msec) :
+        deadline = time.time() + msec * 0.001
+        while True :
+            try :
+                data = os.read(fd, HID_PACKET_SIZE - len(pend))
+                if data == '' :
+                    raise OSError(errno.ENODEV, 'end of file')
+                pend += data
+                if len(pend) == HID_PACKET_SIZE :
+                    return pend, ''
+                continue
+            except OSError as e :
+                if e.errno != errno.EAGAIN :
+                    raise
+            wait = deadline - time.time()
+            if wait <= 0 :
+                return None, pend
+            select.select([fd], [], [], wait)
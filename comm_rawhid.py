@@ -37,6 +37,9 @@
 
 from PyQt4 import uic, QtCore, QtGui
 import sys, time
+from ringbuffer import LineBuffer
+
+RAWHID_BUF_SIZE = 1 << 20     # bytes of unread text we'll hold on to from the listener
 
 
 class Rawhid() :
@@ -44,7 +47,7 @@ class Rawhid() :
     def __init__(self) :
         
         self.open = False
-        self.buf = ''
+        self.buf = LineBuffer(RAWHID_BUF_SIZE)
         self.portlist = []
         
     
@@ -62,7 +65,7 @@ class Rawhid() :
         
     #Slot that handles new data from the listener, buffering it internally.
     def readStdOutput(self):
-        self.buf = self.buf + str(self.proc.readAllStandardOutput())
+        self.buf.Append(self.proc.readAllStandardOutput().data())
         #print "StdOut hook.\n"# '" + self.buf + "'"
     
     
@@ -120,9 +123,8 @@ class Rawhid() :
     
     # Reads everything on the current buffer to the console
     def Read(self) :
-        txt = self.buf + str(self.proc.readAllStandardOutput())
-        self.buf = ''
-        return txt
+        self.buf.Append(self.proc.readAllStandardOutput().data())
+        return self.buf.Read()
     
     # a version of read that blocks until there is at least *something* to read.
     def ReadBlocking(self, msec) :
@@ -139,10 +141,9 @@ class Rawhid() :
             #print '"' + txt + '"',
             #if txt != "" :
             #    break
-            self.buf = self.buf + str(self.proc.readAllStandardOutput())
-            if self.buf.find('\n') >= 0 :
-                txt = self.buf[:self.buf.find('\n')]
-                self.buf = self.buf[self.buf.find('\n')+1:]
+            self.buf.Append(self.proc.readAllStandardOutput().data())
+            if self.buf.HasLine() :
+                txt = self.buf.ReadLn()
                 #print "Readline: '" + txt + "'"
                 return txt
             #time.sleep(0.05)     # more text will buffer automatically
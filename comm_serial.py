@@ -119,7 +119,7 @@ class Serobj() :
     # Reads everything on the current buffer to the console
     def Read(self) :
         if self.serobj.isOpen() :
-            txt = self.serobj.read(serobj.inWaiting())
+            txt = self.serobj.read(self.serobj.inWaiting())
             if self.escape == "":
                 return txt
             else :
@@ -150,7 +150,7 @@ class Serobj() :
         i = str.find(self.escape)
         while i >= 0 :
             if len(str) > i + self.escape_len :
-                self.ads_data.append(str[i+1:i+1+serobj.escape_len])
+                self.ads_data.append(str[i+1:i+1+self.escape_len])
                 str = str[:i] + str[i+1+self.escape_len:]
             i = str.find(self.escape)
         return str
@@ -0,0 +1,324 @@
+########################################################
+# Control Design GUI: comm_sim.py
+# A simulated IMC node that stands in for the comm transports.
+#
+# Ben Weiss, University of Washington
+# Summer 2014
+#
+# Simobj implements the same interface as Rawhid/Hidraw/Serobj, but instead of
+# talking to a Teensy it answers the firmware's command set itself:
+#   g<cmd> / s<cmd> <value>  get and set the parameters listed in machine.xml
+#   gd                       dump the control history (count line, then binary hist_data_t records)
+#   ss 1 / ss 0              start/stop the hist_data_t data stream (data stream 0)
+#   pcc, pcp t x v, pcs      clear, append to and start a custom path
+#   mode commands (i, cp...) are acknowledged with a debug line
+# and it prints "'"-prefixed debug lines now and then, like the firmware does.
+#
+# Everything runs off a clock object with time() and sleep() -- the time module
+# by default, or a SimClock for fully deterministic runs -- and a seeded random
+# generator, so runs are repeatable. Latency, jitter and packet loss can be
+# injected to see how the rest of the program copes.
+#
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+########################################################
+
+import time, math, random, heapq, struct
+import xml.etree.cElementTree as ET
+from ringbuffer import LineBuffer
+from comm_hidraw import PackCommands
+
+
+histStruct = struct.Struct("=LlfffflB")     # hist_data_t, as in scripts.py
+HIST_TICK = 0.00001         # s per unit of hist_data_t.time
+RECORDS_PER_PACKET = 2      # hist_data_t records the firmware packs into one data packet
+
+
+# A clock that only moves when told to, for deterministic simulations.
+class SimClock :
+    def __init__(self, start=0.0) :
+        self.now = start
+
+    def time(self) :
+        return self.now
+
+    def sleep(self, secs) :
+        self.now += max(0.0, secs)
+
+
+class Simobj() :
+
+    def __init__(self, machine_file='machine.xml', seed=0, clock=time,
+                 latency=0.0, jitter=0.0, loss=0.0,
+                 stream_rate=1000.0, history_len=1000, debug_period=5.0) :
+        self.clock = clock
+        self.rand = random.Random(seed)
+        self.latency = latency          # s added to every response
+        self.jitter = jitter            # up to this many more s, at random
+        self.loss = loss                # chance each packet (either direction) is lost
+        self.stream_rate = stream_rate  # hist_data_t records per second while streaming
+        self.history_len = history_len  # records returned by gd
+        self.debug_period = debug_period    # s between unsolicited debug lines (0 for none)
+
+        self.open = False
+        self.port = ''
+        self.devid = 1
+        self.buf = LineBuffer()
+        self.outq = []                  # heap of (due time, seq, text) waiting to "arrive"
+        self.seq = 0
+        self.datafiles = [None, None, None]
+        self.data_to_console = [False, False, False]
+        self.data_callback = None
+
+        # statistics
+        self.packets_in = 0
+        self.packets_out = 0
+        self.lost_in = 0
+        self.lost_out = 0
+
+        # device state
+        self.get_cmd = 'g'
+        self.set_cmd = 's'
+        self.debugstr = "'"
+        self.params = {}                # cmd -> value string
+        self.mode = 'i'
+        self.path = []                  # custom path: [(ms, pos, vel), ...]
+        self.streaming = False
+        self.stream_k = 0               # index of the next stream record
+        self.start = self.clock.time()
+        self.next_debug = self.start + debug_period
+        self.loadMachine(machine_file)
+
+    # reads the parameter list (and default values) from a machine file
+    def loadMachine(self, fname) :
+        root = ET.ElementTree(file=fname).getroot()
+        self.get_cmd = root.attrib.get('getparam', self.get_cmd)
+        self.set_cmd = root.attrib.get('setparam', self.set_cmd)
+        self.debugstr = root.attrib.get('debugstr', self.debugstr)
+        for child in root :
+            if child.tag == 'Parameters' :
+                for param in child :
+                    if 'cmd' in param.attrib :
+                        self.params[param.attrib['cmd']] = (param.text or '').strip()
+
+    def Init(self) :
+        print "Simulated IMC node active."
+
+    def GetComPorts(self) :
+        return ['%X' % self.devid]
+
+    def Open(self, port='1', speed='n/a', extra='', extra2='') :
+        self.port = port
+        self.open = True
+        self.buf.Clear()
+        self.outq = []
+        self.start = self.clock.time()
+        self.stream_k = 0
+        return 1
+
+    def Close(self) :
+        self.open = False
+        self.streaming = False
+        for ds_id in range(0, 3) :
+            self.DataStreamStopSave(ds_id)
+
+    def Quit(self) :
+        self.Close()
+
+    def IsOpen(self) :
+        return self.open
+
+    def DumpToConsole(self) :
+        txt = self.Read()
+        if len(txt) > 0 :
+            print txt,
+
+    # Each Write is one packet to the device. It may hold several newline-separated
+    # commands (see WriteMany).
+    def Write(self, data) :
+        if not self.open :
+            return
+        self.packets_in += 1
+        if self.rand.random() < self.loss :
+            self.lost_in += 1
+            return
+        for cmd in data.split('\n') :
+            if cmd.strip() != '' :
+                self.command(cmd.strip())
+
+    def WriteMany(self, cmds) :
+        for pkt in PackCommands(cmds) :
+            self.Write(pkt)
+
+    def Read(self) :
+        self.update()
+        return self.buf.Read()
+
+    def ReadBlocking(self, msec) :
+        self.update()
+        if len(self.buf) == 0 :
+            # wait for the next thing that's due, but no longer than msec
+            wait = msec * 0.001
+            if len(self.outq) > 0 :
+                wait = min(wait, max(0.0, self.outq[0][0] - self.clock.time()))
+            self.clock.sleep(wait)
+        return self.Read()
+
+    def ReadLn(self) :
+        for i in range(0, 50) :
+            self.update()
+            if self.buf.HasLine() :
+                return self.buf.ReadLn()
+            self.clock.sleep(0.05)
+        print "Timeout waiting for readline!"
+        return ''
+
+    def AdsScan(self, str) :
+        return str
+
+    def GetAds(self) :
+        return []
+
+    def DataStreamStartSave(self, ds_id, fname) :
+        if self.open :
+            self.DataStreamStopSave(ds_id)
+            self.datafiles[ds_id] = open(fname, "ab")
+
+    def DataStreamStopSave(self, ds_id) :
+        if self.datafiles[ds_id] :
+            self.datafiles[ds_id].close()
+            self.datafiles[ds_id] = None
+
+    def DataStreamToConsole(self, ds_id, enable) :
+        self.data_to_console[ds_id] = enable
+
+    # Device side --------------------------------------------------------
+
+    # handles one command from the host
+    def command(self, cmd) :
+        if cmd == 'gd' :
+            n = self.history_len
+            now = self.simTime()
+            k0 = max(0, int(now * self.stream_rate) - n)
+            self.send('%i\n' % n + ''.join([self.record(k) for k in range(k0, k0 + n)]))
+        elif cmd.startswith('ss ') :
+            self.streaming = cmd[3:].strip() == '1'
+            self.stream_k = int(self.simTime() * self.stream_rate)
+            self.debug('Streaming %s' % ('on' if self.streaming else 'off'))
+        elif cmd == 'pcc' :
+            self.path = []
+        elif cmd.startswith('pcp ') :
+            try :
+                t, x, v = cmd[4:].split()
+                self.path.append((int(t), float(x), float(v)))
+            except ValueError :
+                self.debug('Bad path point: ' + cmd)
+        elif cmd.startswith(self.get_cmd) and cmd[len(self.get_cmd):] in self.params :
+            self.send(self.params[cmd[len(self.get_cmd):]] + '\n')
+        elif cmd.startswith(self.set_cmd) and cmd[len(self.set_cmd):].split(' ')[0] in self.params :
+            name, sep, value = cmd[len(self.set_cmd):].partition(' ')
+            self.params[name] = value.strip()
+        else :
+            # everything else is a mode command as far as we're concerned
+            self.mode = cmd
+            self.debug('Mode: ' + cmd)
+
+    # queues text to arrive at the host after the simulated link delay
+    def send(self, txt) :
+        self.packets_out += 1
+        if self.rand.random() < self.loss :
+            self.lost_out += 1
+            return
+        due = self.clock.time() + self.latency + self.jitter * self.rand.random()
+        self.seq += 1
+        heapq.heappush(self.outq, (due, self.seq, txt))
+
+    def debug(self, txt) :
+        self.send(self.debugstr + txt + '\n')
+
+    def simTime(self) :
+        return self.clock.time() - self.start
+
+    # delivers whatever is due by now
+    def update(self) :
+        if not self.open :
+            return
+        now = self.clock.time()
+        if self.debug_period > 0 and now >= self.next_debug :
+            self.next_debug = now + self.debug_period
+            self.debug('Mode %s, t=%.3f' % (self.mode, self.simTime()))
+        if self.streaming :
+            self.stream()
+        while len(self.outq) > 0 and self.outq[0][0] <= now :
+            self.buf.Append(heapq.heappop(self.outq)[2])
+
+    # sends every stream record that has come due, a few to a packet
+    def stream(self) :
+        last = int(self.simTime() * self.stream_rate)
+        while self.stream_k + RECORDS_PER_PACKET <= last :
+            payload = ''.join([self.record(k) for k in range(self.stream_k, self.stream_k + RECORDS_PER_PACKET)])
+            self.stream_k += RECORDS_PER_PACKET
+            self.packets_out += 1
+            if self.rand.random() < self.loss :
+                self.lost_out += 1
+                continue
+            if self.datafiles[0] :
+                self.datafiles[0].write(payload)
+            if self.data_callback != None :
+                self.data_callback(0, payload)
+
+    # the k'th hist_data_t record of the simulated control loop, packed
+    def record(self, k) :
+        t = k / float(self.stream_rate)
+        pos, vel = self.target(t)
+        lag = 0.002
+        pos_lag, vel_lag = self.target(t - lag)
+        noise = math.sin(k * 12.9898) * 43758.5453
+        noise = (noise - math.floor(noise) - 0.5) * 2.0
+        position = int(round(pos_lag + noise))
+        try :
+            tics_per_step = float(self.params.get('q', '1'))
+        except ValueError :
+            tics_per_step = 1.0
+        return histStruct.pack(int(round(t / HIST_TICK)) & 0xFFFFFFFF, position,
+                               (pos - pos_lag) / max(1, self.stream_rate * lag),
+                               vel_lag, pos, vel,
+                               int(position / tics_per_step), 0)
+
+    # target position (tics) and velocity (tics/min) at time t
+    def target(self, t) :
+        if self.mode == 'pcs' and len(self.path) > 0 :
+            ms = t * 1000.0
+            x, v = self.path[-1][1], 0.0
+            for pt in self.path :
+                if pt[0] > ms :
+                    x, v = pt[1], pt[2]
+                    break
+            return x, v
+        try :
+            amp = float(self.params.get('pa', '2000'))
+            freq = float(self.params.get('pf', '1'))
+        except ValueError :
+            amp, freq = 2000.0, 1.0
+        w = 2 * math.pi * freq
+        return amp * math.sin(w * t), amp * w * math.cos(w * t) * 60.0
@@ -0,0 +1,530 @@
+########################################################
+# Control Design GUI: comm_thread.py
+# Runs the comm transport (Rawhid, Hidraw or Serobj) on its own I/O thread.
+#
+# Ben Weiss, University of Washington
+# Summer 2014
+#
+# CommThread owns the transport object: it is initialized, read and written
+# only from the I/O thread, which keeps reading from the device in the
+# background. Incoming text is split into lines and sorted into separate
+# queues for debug lines (those starting with the machine's debugstr), other
+# text lines and binary data stream packets. Callers either consume the queues,
+# register callbacks (which run on the I/O thread!), or use Request() to send a
+# command and get a Future for the line that answers it.
+#
+# Commands sent with WriteBatched() are held briefly and handed to the transport
+# together, so transports that can (Hidraw) pack several into one report.
+#
+# Download() is for commands like gd that answer with a count line and then
+# that many binary records: the records bypass the line framing and are copied
+# straight into one preallocated buffer.
+#
+# CommThread also exposes the same interface as the transports, so it can
+# stand in for them anywhere a "comm" object is used.
+#
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+########################################################
+
+import threading, collections, time, sys
+from ringbuffer import LineBuffer
+
+
+POLL_MS = 10                # how long the I/O thread waits for data before servicing calls again
+PARTIAL_FLUSH_MS = 50       # an unterminated line is handed out after this much quiet
+REQUEST_TIMEOUT = 2.5       # s, default time to wait for the answer to a Request()
+QUEUE_LEN = 10000           # max lines/packets held in each queue before the oldest are dropped
+BATCH_MS = 5                # batched writes go out at most this long after the first one is queued
+BATCH_BYTES = 16 * 64       # ...or as soon as this much is waiting
+DOWNLOAD_TIMEOUT = 2.5      # s, a Download() fails if the device goes quiet this long
+
+
+class CommTimeout(Exception) :
+    pass
+
+
+# A minimal future: the result of something that will finish on the I/O thread.
+class Future :
+
+    def __init__(self) :
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.result = None
+        self.error = None
+        self.callbacks = []
+
+    def Done(self) :
+        return self.event.is_set()
+
+    # Waits up to timeout seconds (forever if None) and returns the result, or
+    # raises the error the operation failed with.
+    def Result(self, timeout=None) :
+        if not self.event.wait(timeout) :
+            raise CommTimeout("Timed out waiting for the device.")
+        if self.error is not None :
+            raise self.error
+        return self.result
+
+    # Calls fn(future) once the future is done (right away if it already is).
+    # This happens on whichever thread finished it -- usually the I/O thread.
+    def AddCallback(self, fn) :
+        with self.lock :
+            if not self.event.is_set() :
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def SetResult(self, result) :
+        self.result = result
+        self._finish()
+
+    def SetError(self, error) :
+        self.error = error
+        self._finish()
+
+    def _finish(self) :
+        with self.lock :
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for fn in callbacks :
+            fn(self)
+
+
+class CommThread(threading.Thread) :
+
+    def __init__(self, transport, debugstr="'") :
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.transport = transport
+        self.debugstr = debugstr
+        self.quit = False
+        self.ready = threading.Event()
+
+        self.calls = collections.deque()        # (fn, args, future) to run on the I/O thread
+        self.requests = collections.deque()     # outstanding Request()s, oldest first
+        self.batch = []                 # commands waiting to go out together
+        self.batch_bytes = 0
+        self.batch_deadline = None
+        self.download = None            # the Download() in progress, if any
+
+        self.rx = LineBuffer()
+        self.last_rx = 0.0
+        self.midline = None             # queue an already-handed-out partial line belongs to
+
+        # received data, as (sequence number, item)
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.lines = collections.deque(maxlen=QUEUE_LEN)
+        self.debug = collections.deque(maxlen=QUEUE_LEN)
+        self.data = collections.deque(maxlen=QUEUE_LEN)
+        self.dropped = 0                # items pushed out of a full queue
+
+        self.line_callbacks = []
+        self.debug_callbacks = []
+        self.data_callbacks = []
+
+    # I/O thread main loop.
+    def run(self) :
+        self.transport.Init()
+        if hasattr(self.transport, 'data_callback') :
+            self.transport.data_callback = self._onData
+        self.ready.set()
+        while not self.quit :
+            self._runCalls()
+            self._checkRequests()
+            self._checkDownload()
+            if self.batch_deadline != None and time.time() >= self.batch_deadline :
+                self._flushBatch()
+            start = time.time()
+            txt = ''
+            if self.transport.IsOpen() :
+                try :
+                    txt = self.transport.ReadBlocking(POLL_MS)
+                except Exception as e :
+                    print "Comm read error: " + str(e)
+            if txt :
+                self._onText(txt)
+            else :
+                self._flushPartial()
+                # not every transport actually blocks in ReadBlocking
+                wait = POLL_MS * 0.001 - (time.time() - start)
+                if wait > 0 :
+                    time.sleep(wait)
+        self._runCalls()
+
+    # Transport-like interface --------------------------------------------
+
+    # Starts the I/O thread, which initializes the transport.
+    def Init(self) :
+        if not self.is_alive() :
+            self.start()
+        self.ready.wait()
+
+    def GetComPorts(self) :
+        return self.Call(self.transport.GetComPorts)
+
+    def Open(self, *args) :
+        return self.Call(self.transport.Open, *args)
+
+    def Close(self) :
+        self.Call(self.transport.Close)
+        self.Post(self._failRequests)
+        self.Post(self._failDownload, IOError("Device closed."))
+
+    def Quit(self) :
+        self.Call(self.transport.Quit)
+        self.quit = True
+        if self.is_alive() and threading.current_thread() is not self :
+            self.join(1.0)
+
+    def IsOpen(self) :
+        return self.transport.IsOpen()
+
+    # Prints everything received but not yet consumed to the console.
+    def DumpToConsole(self) :
+        txt = self.Read()
+        if len(txt) > 0 :
+            print txt,
+
+    # Sends <data> to the device. This doesn't wait for it to go out.
+    def Write(self, data) :
+        self.Post(self._write, data)
+
+    # Adds text of our own (script output, say) to the console output: it goes
+    # on the debug queue, in order with what the device sends, where nothing
+    # waiting for an answer with ReadLn() will take it.
+    def Echo(self, txt) :
+        if not txt.endswith('\n') :
+            txt += '\n'
+        self.Post(self._echo, txt)
+
+    # Returns all the text lines and debug lines received so far, in order.
+    def Read(self) :
+        with self.cond :
+            items = sorted(list(self.lines) + list(self.debug))
+            self.lines.clear()
+            self.debug.clear()
+        return ''.join([txt for seq, txt in items])
+
+    # a version of read that blocks until there is at least *something* to read.
+    def ReadBlocking(self, msec) :
+        with self.cond :
+            if len(self.lines) == 0 and len(self.debug) == 0 :
+                self.cond.wait(msec * 0.001)
+        return self.Read()
+
+    # Returns the next (non-debug) line of text, without its newline, or '' if
+    # none shows up in time.
+    def ReadLn(self, timeout=REQUEST_TIMEOUT) :
+        txt = self.GetLine(timeout)
+        if txt is None :
+            print "Timeout waiting for readline!"
+            return ''
+        return txt.rstrip('\n')
+
+    def AdsScan(self, str) :
+        return self.transport.AdsScan(str)
+
+    def GetAds(self) :
+        return self.Call(self.transport.GetAds)
+
+    def DataStreamStartSave(self, ds_id, fname) :
+        self.Call(self.transport.DataStreamStartSave, ds_id, fname)
+
+    def DataStreamStopSave(self, ds_id) :
+        self.Call(self.transport.DataStreamStopSave, ds_id)
+
+    def DataStreamToConsole(self, ds_id, enable) :
+        self.Call(self.transport.DataStreamToConsole, ds_id, enable)
+
+    # anything else (port, ser...) comes straight from the transport.
+    def __getattr__(self, name) :
+        if name == 'transport' :
+            raise AttributeError(name)
+        return getattr(self.transport, name)
+
+    # Asynchronous interface ----------------------------------------------
+
+    # Sets the prefix that marks a line as debug output.
+    def SetDebugStr(self, debugstr) :
+        self.debugstr = debugstr
+
+    # Sends cmd to the device and returns a Future for the first non-debug line
+    # that comes back after it (and after the answers to any earlier requests).
+    # The future fails with CommTimeout if nothing arrives within timeout seconds
+    # of the request reaching the front of the line.
+    def Request(self, cmd, timeout=REQUEST_TIMEOUT) :
+        f = Future()
+        self.Post(self._sendRequest, cmd, timeout, f)
+        return f
+
+    # Sends cmd to the device, which should answer with a line holding a record
+    # count, then that many records of record_size bytes each. Returns a Future
+    # for (count, bytearray of the records). Debug lines and other lines that
+    # arrive before the count line are handled as usual. progress(received bytes,
+    # total bytes, seconds so far) is called on the I/O thread as data comes in.
+    # The future fails with CommTimeout if the device goes quiet for timeout s.
+    def Download(self, cmd, record_size, progress=None, timeout=DOWNLOAD_TIMEOUT) :
+        f = Future()
+        self.Post(self._startDownload, cmd, record_size, progress, timeout, f)
+        return f
+
+    # Queues <data> to be sent along with any other commands written around the
+    # same time. It goes out within BATCH_MS, on Flush(), or ahead of the next
+    # Write()/Request(), whichever comes first.
+    def WriteBatched(self, data) :
+        self.Post(self._batchAdd, data)
+
+    # Sends any batched commands right away.
+    def Flush(self) :
+        self.Post(self._flushBatch)
+
+    # Runs fn(*args) on the I/O thread and returns a Future for its return value.
+    def Post(self, fn, *args) :
+        f = Future()
+        if not self.is_alive() or threading.current_thread() is self :
+            self._run(fn, args, f)
+        else :
+            self.calls.append((fn, args, f))
+        return f
+
+    # Runs fn(*args) on the I/O thread and waits for it to finish.
+    def Call(self, fn, *args) :
+        return self.Post(fn, *args).Result()
+
+    # The following return the next item from their queue, waiting up to timeout
+    # seconds for one (forever if None), or None if nothing showed up. Lines keep
+    # their newline (a line handed out before it was finished won't have one).
+    def GetLine(self, timeout=0) :
+        return self._get(self.lines, timeout)
+
+    def GetDebug(self, timeout=0) :
+        return self._get(self.debug, timeout)
+
+    # data stream packets are returned as (ds_id, payload)
+    def GetData(self, timeout=0) :
+        return self._get(self.data, timeout)
+
+    # Callbacks are called on the I/O thread with each item as it arrives. Items
+    # handed to callbacks still go on their queue as well.
+    def AddLineCallback(self, fn) :
+        self.line_callbacks.append(fn)
+
+    def AddDebugCallback(self, fn) :
+        self.debug_callbacks.append(fn)
+
+    def AddDataCallback(self, fn) :
+        self.data_callbacks.append(fn)
+
+    # I/O thread internals --------------------------------------------------
+
+    def _runCalls(self) :
+        while len(self.calls) > 0 :
+            fn, args, f = self.calls.popleft()
+            self._run(fn, args, f)
+
+    def _run(self, fn, args, f) :
+        try :
+            f.SetResult(fn(*args))
+        except Exception as e :
+            f.SetError(e)
+
+    def _write(self, data) :
+        self._flushBatch()
+        self.transport.Write(data)
+
+    def _batchAdd(self, data) :
+        if self.batch_deadline == None :
+            self.batch_deadline = time.time() + BATCH_MS * 0.001
+        self.batch.append(data)
+        self.batch_bytes += len(data) + 1
+        if self.batch_bytes >= BATCH_BYTES :
+            self._flushBatch()
+
+    def _flushBatch(self) :
+        if len(self.batch) > 0 :
+            if hasattr(self.transport, 'WriteMany') :
+                self.transport.WriteMany(self.batch)
+            else :
+                for data in self.batch :
+                    self.transport.Write(data)
+        self.batch = []
+        self.batch_bytes = 0
+        self.batch_deadline = None
+
+    def _sendRequest(self, cmd, timeout, f) :
+        self._flushBatch()
+        if not self.transport.IsOpen() :
+            f.SetError(IOError("Device not open."))
+            return
+        # the clock for a request starts once everything ahead of it is answered.
+        deadline = time.time() + timeout if len(self.requests) == 0 else None
+        self.requests.append([cmd, timeout, deadline, f])
+        self.transport.Write(cmd)
+
+    def _checkRequests(self) :
+        while len(self.requests) > 0 :
+            req = self.requests[0]
+            if req[2] is None :
+                req[2] = time.time() + req[1]
+            if time.time() < req[2] :
+                return
+            self.requests.popleft()
+            req[3].SetError(CommTimeout("No response to '%s'" % req[0]))
+
+    def _failRequests(self) :
+        while len(self.requests) > 0 :
+            self.requests.popleft()[3].SetError(IOError("Device closed."))
+
+    def _startDownload(self, cmd, record_size, progress, timeout, f) :
+        self._flushBatch()
+        if not self.transport.IsOpen() :
+            f.SetError(IOError("Device not open."))
+            return
+        self._failDownload(IOError("Superseded by '%s'" % cmd))
+        self.download = {'cmd' : cmd, 'size' : record_size, 'progress' : progress,
+                         'timeout' : timeout, 'future' : f, 'buf' : None, 'view' : None,
+                         'count' : 0, 'total' : 0, 'got' : 0, 'ahead' : len(self.requests),
+                         'start' : time.time(), 'last' : time.time()}
+        self.transport.Write(cmd)
+
+    def _checkDownload(self) :
+        d = self.download
+        if d is not None and time.time() - d['last'] > d['timeout'] :
+            self._failDownload(CommTimeout("'%s': got %i of %i bytes" % (d['cmd'], d['got'], d['total'])))
+
+    def _failDownload(self, error) :
+        if self.download is not None :
+            d = self.download
+            self.download = None
+            d['future'].SetError(error)
+
+    # Takes incoming bytes for the download in progress. Returns whatever is
+    # left over once it's complete (to be handled as normal text).
+    def _downloadText(self, txt) :
+        d = self.download
+        d['last'] = time.time()
+        if d['buf'] is None :
+            # still waiting for the count line
+            self.rx.Append(txt)
+            txt = ''
+            while self.rx.HasLine() :
+                line = self.rx.ReadLn()
+                # requests sent before the download get their answers first
+                d['ahead'] = min(d['ahead'], len(self.requests))
+                try :
+                    if self.debugstr != '' and line.startswith(self.debugstr) :
+                        raise ValueError
+                    if d['ahead'] > 0 :
+                        d['ahead'] -= 1
+                        raise ValueError
+                    count = int(line.strip())
+                except ValueError :
+                    self._onLine(line + '\n')
+                    continue
+                d['count'] = count
+                d['total'] = count * d['size']
+                d['buf'] = bytearray(d['total'])
+                d['view'] = memoryview(d['buf'])
+                txt = self.rx.Read()
+                break
+            if d['buf'] is None :
+                return ''
+        n = min(len(txt), d['total'] - d['got'])
+        d['view'][d['got']:d['got'] + n] = memoryview(txt)[:n]
+        d['got'] += n
+        if d['progress'] is not None :
+            d['progress'](d['got'], d['total'], time.time() - d['start'])
+        if d['got'] < d['total'] :
+            return ''
+        self.download = None
+        d['future'].SetResult((d['count'], d['buf']))
+        return txt[n:]
+
+    def _onText(self, txt) :
+        self.last_rx = time.time()
+        if self.download is not None :
+            txt = self._downloadText(txt)
+            if not txt :
+                return
+        self.rx.Append(txt)
+        while self.rx.HasLine() :
+            self._onLine(self.rx.ReadLn() + '\n')
+
+    # hands out an unterminated line once the device has gone quiet, unless a
+    # request or download is waiting on it (then we wait for the whole line).
+    def _flushPartial(self) :
+        if len(self.rx) > 0 and len(self.requests) == 0 and self.download is None and \
+                time.time() - self.last_rx > PARTIAL_FLUSH_MS * 0.001 :
+            self._onLine(self.rx.Read())
+
+    def _onLine(self, txt) :
+        # the rest of a line we already handed out part of goes where that did.
+        if self.midline is not None :
+            queue = self.midline
+        elif self.debugstr != '' and txt.startswith(self.debugstr) :
+            queue = self.debug
+        elif len(self.requests) > 0 :
+            self.requests.popleft()[3].SetResult(txt.rstrip('\r\n'))
+            if len(self.requests) > 0 :
+                self.requests[0][2] = time.time() + self.requests[0][1]
+            return
+        else :
+            queue = self.lines
+        self.midline = None if txt.endswith('\n') else queue
+        self._put(queue, txt)
+        for fn in (self.debug_callbacks if queue is self.debug else self.line_callbacks) :
+            fn(txt)
+
+    def _echo(self, txt) :
+        self._put(self.debug, txt)
+        for fn in self.debug_callbacks :
+            fn(txt)
+
+    def _onData(self, ds_id, payload) :
+        self._put(self.data, (ds_id, payload))
+        for fn in self.data_callbacks :
+            fn(ds_id, payload)
+
+    def _put(self, queue, item) :
+        with self.cond :
+            if len(queue) == queue.maxlen :
+                self.dropped += 1
+            self.seq += 1
+            queue.append((self.seq, item))
+            self.cond.notify_all()
+
+    def _get(self, queue, timeout) :
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond :
+            while len(queue) == 0 :
+                if deadline is None :
+                    self.cond.wait()
+                else :
+                    wait = deadline - time.time()
+                    if wait <= 0 :
+                        return None
+                    self.cond.wait(wait)
+            return queue.popleft()[1]
@@ -0,0 +1,157 @@
+########################################################
+# Control Design GUI: decimate.py
+# Min/max decimation so long captures plot (and zoom) quickly.
+#
+# Ben Weiss, University of Washington
+# Summer 2014
+#
+# A screen can only show one vertical line's worth of a trace per pixel column,
+# so instead of handing matplotlib every sample, each trace is reduced to the
+# min and max of the samples in each pixel column of the visible x range. That
+# looks the same as the full trace (every spike is still there) but is only a
+# couple thousand points however much data there is. It's recomputed whenever
+# the x limits change (zoom/pan), from the full-resolution data -- or, when
+# zoomed far out, from precomputed min/max pyramids so a whole hour-long capture
+# doesn't have to be scanned on every redraw.
+#
+# x must be sorted (time always is).
+#
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+########################################################
+
+import numpy as np
+
+
+LOD_FACTOR = 64             # samples per block at each level of the min/max pyramid
+MIN_COLUMNS = 100           # never decimate to fewer columns than this
+DEFAULT_COLUMNS = 1000      # columns to use before the axes know their size
+
+
+# Min/max envelopes of y(x) at any zoom level.
+class MinMaxLOD :
+
+    def __init__(self, x, y) :
+        self.x = np.ascontiguousarray(x)      # searched a lot, so worth one copy
+        self.y = np.asarray(y)
+        self.levels = None      # [(block size, x at block starts, block mins, block maxs), ...]
+
+    def __len__(self) :
+        return len(self.x)
+
+    # Returns (xs, ys) to draw for x0 <= x <= x1 at <columns> pixel columns: the
+    # raw samples if there are few enough, otherwise a min and a max per column.
+    def envelope(self, x0, x1, columns) :
+        columns = max(int(columns), MIN_COLUMNS)
+        # one sample either side of the range, so lines run off the edges
+        i0 = max(int(np.searchsorted(self.x, x0)) - 1, 0)
+        i1 = min(int(np.searchsorted(self.x, x1, 'right')) + 1, len(self.x))
+        if i1 - i0 <= 2 * columns :
+            return self.x[i0:i1], self.y[i0:i1]
+
+        # use the coarsest pyramid level that still has a few blocks per column
+        xs, mins, maxs = self.x[i0:i1], self.y[i0:i1], self.y[i0:i1]
+        per_column = (i1 - i0) / float(columns)
+        for size, lx, lmin, lmax in reversed(self._levels()) :
+            if size * 4 <= per_column :
+                j0 = max(int(np.searchsorted(lx, x0, 'right')) - 1, 0)
+                j1 = int(np.searchsorted(lx, x1, 'right'))
+                if j1 - j0 > columns :
+                    xs, mins, maxs = lx[j0:j1], lmin[j0:j1], lmax[j0:j1]
+                break
+
+        # split into columns of equal x width; skip empty ones
+        edges = np.searchsorted(xs, np.linspace(xs[0], xs[-1], columns + 1)[:-1])
+        edges = np.unique(edges)
+        lo = np.minimum.reduceat(mins, edges)
+        hi = np.maximum.reduceat(maxs, edges)
+        # (plus the last sample, so the line reaches the end of the data)
+        outx = np.empty(2 * len(edges) + 1, np.float64)
+        outx[:-1] = np.repeat(xs[edges], 2)
+        outx[-1] = self.x[i1 - 1]
+        outy = np.empty(2 * len(edges) + 1, np.float64)
+        outy[0:-1:2] = lo
+        outy[1:-1:2] = hi
+        outy[-1] = self.y[i1 - 1]
+        return outx, outy
+
+    # builds the pyramid now (on a loading thread, say) rather than the first
+    # time it's needed
+    def prepare(self) :
+        self._levels()
+        return self
+
+    # builds the pyramid the first time it's needed
+    def _levels(self) :
+        if self.levels is None :
+            self.levels = []
+            x, lo, hi, size = self.x, self.y, self.y, 1
+            while len(x) > LOD_FACTOR * MIN_COLUMNS :
+                starts = np.arange(0, len(x), LOD_FACTOR)
+                x = x[starts]
+                lo = np.minimum.reduceat(lo, starts)
+                hi = np.maximum.reduceat(hi, starts)
+                size *= LOD_FACTOR
+                self.levels.append((size, x, lo, hi))
+        return self.levels
+
+
+# A matplotlib line that shows a min/max decimated version of (x, y), redone
+# whenever the axes' x limits change. Keep a reference to it: matplotlib only
+# holds its callbacks weakly.
+class DecimatedLine :
+
+    def __init__(self, axes, x, y, *args, **kwargs) :
+        self.axes = axes
+        self.line = axes.plot([], [], *args, **kwargs)[0]
+        self.lod = None
+        self.setData(x, y)
+        self.cid = axes.callbacks.connect('xlim_changed', self.refresh)
+
+    # replaces the full-resolution data and shows all of it. The axes are
+    # rescaled to fit if autoscale is set (and autoscaling is on for them).
+    # x can also be a MinMaxLOD (and y None), to reuse one that's already built.
+    def setData(self, x, y, autoscale=True) :
+        self.lod = x if isinstance(x, MinMaxLOD) else MinMaxLOD(x, y)
+        if len(self.lod) > 0 :
+            self.show(self.lod.x[0], self.lod.x[-1])
+        else :
+            self.line.set_data([], [])
+        if autoscale :
+            self.axes.relim()
+            self.axes.autoscale_view()
+
+    # x limits changed
+    def refresh(self, axes=None) :
+        x0, x1 = self.axes.get_xlim()
+        self.show(min(x0, x1), max(x0, x1))
+
+    def show(self, x0, x1) :
+        if len(self.lod) == 0 :
+            return
+        columns = self.axes.bbox.width if self.axes.bbox.width > 1 else DEFAULT_COLUMNS
+        xs, ys = self.lod.envelope(x0, x1, columns)
+        self.line.set_data(xs, ys)
+
+    def disconnect(self) :
+        self.axes.callbacks.disconnect(self.cid)
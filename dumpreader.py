@@ -45,10 +45,18 @@ import sys
 import re
 import os
 import datetime
+import threading
+import traceback
 from PyQt4 import uic, QtCore, QtGui
 
 
 import plotgui
+import histdata
+import capfile
+import catalog
+import capcache
+import decimate
+import sqlite3
 
 
 histStruct = struct.Struct("=LlfffflB")
@@ -69,37 +77,78 @@ histStruct = struct.Struct("=LlfffflB")
 figwindows = []
 
 
+INDEX_POLL_MS = 250         # how often the list is brought up to date while captures are indexed
+CACHE_BYTES = 512 << 20     # memory for captures kept decoded, for flipping back and forth
+
+
+# one line about a catalog row
+def describe(row) :
+    if row['error'] != None :
+        return "%s: %s" % (row['name'], row['error'])
+    if not row['records'] :
+        return "%s: empty" % row['name']
+    return "%s: %i records, %.1f s at %.0f Hz, error %.2f RMS / %.2f max (tics)" % (
+        row['name'], row['records'], row['duration'], row['rate'], row['err_rms'], row['err_max'])
+
+
 def timeStamped(fname, fmt='%Y-%m-%d-%H-%M-%S_{fname}'):
     return datetime.datetime.now().strftime(fmt).format(fname=fname)
 
 
 def readDump(fname) :
     """plots a saved control history with matplotlib"""
-    # read back the history from file
-    ts = []
-    ps = []
-    vs = []
-    pos_error_derivs = []
-    cmd_vs = []
-    target_ps = []
-    target_vs = []
-    motor_ps = []
-    
-    with open(fname, "r") as fin :
-        fin.readline()      # read header line
-        for line in fin :
-            r = re.compile("[ \t\n\r,]+")
-            d = r.split(line)
-            if len(d) < 7 :
-                break       # we're done with the file
-            ts.append(float(d[0]) * 0.00001)
-            ps.append(int(d[1]))
-            #vs.append(d[2])
-            pos_error_derivs.append(float(d[2]))
-            cmd_vs.append(float(d[3]))
-            target_ps.append(float(d[4]))
-            target_vs.append(float(d[5]))
-            motor_ps.append(float(d[6]))
+    plotDump(dumpcache.get(fname))
+
+
+# Reads a saved control history (a .csv, or a .cap/.bin stream capture) and
+# makes the min/max decimations of each trace, ready for plotDump. This is what
+# dumpcache keeps.
+def loadDump(fname) :
+    if fname[-3:].lower() in ('cap', 'bin') :
+        recs = capfile.openCapture(fname)[:]
+    else :
+        recs = histdata.loadCsv(fname)
+    ts = recs['time'] * histdata.HIST_TICK
+    data = {}
+    for name in ('position', 'pos_error_deriv', 'cmd_velocity', 'target_pos', 'target_vel', 'motor_position') :
+        data[name] = decimate.MinMaxLOD(ts, recs[name]).prepare()
+    return data
+
+
+def makeWindows() :
+    if len(figwindows) == 0 :
+       figwindows.append(plotgui.PlotWindow())
+       figwindows[0].move(0,0)
+       figwindows.append(plotgui.PlotWindow())
+       figwindows[1].move(400, 0)
+       figwindows.append(plotgui.PlotWindow())
+       figwindows[2].move(800, 0)
+       figwindows.append(plotgui.PlotWindow())
+       figwindows[3].move(1200, 0)
+
+
+# A quick look at a capture from its catalog preview (see catalog.Catalog.preview),
+# to show while the whole thing loads. plotDump then replaces it.
+def plotPreview(preview) :
+    (ts, ps), (te, errs) = preview
+    makeWindows()
+    fig = figwindows[0].init_plot()
+    figwindows[0].plot(ts, ps, 'b-', label='Position')
+    fig.legend(loc=2)
+    fig.xaxis.label.set_text('Time (s)')
+    fig.yaxis.label.set_text('Position (encoder tics)')
+    fig.title.set_text('Position Tracking (loading...)')
+    figwindows[0].render_plot()
+    figwindows[0].show()
+
+
+def plotDump(data) :
+    ps = data['position']
+    pos_error_derivs = data['pos_error_deriv']
+    cmd_vs = data['cmd_velocity']
+    target_ps = data['target_pos']
+    target_vs = data['target_vel']
+    motor_ps = data['motor_position']
     
     # plot the data!
 ##    if len(figwindows) == 0 :
@@ -114,19 +163,11 @@ def readDump(fname) :
     
     
     # plot the data!
-    if len(figwindows) == 0 :
-       figwindows.append(plotgui.PlotWindow())
-       figwindows[0].move(0,0)
-       figwindows.append(plotgui.PlotWindow())
-       figwindows[1].move(400, 0)
-       figwindows.append(plotgui.PlotWindow())
-       figwindows[2].move(800, 0)
-       figwindows.append(plotgui.PlotWindow())
-       figwindows[3].move(1200, 0)
+    makeWindows()
     fig = figwindows[0].init_plot()
-    fig.plot(ts, ps, 'b-', label='Position')
+    figwindows[0].plot(ps, None, 'b-', label='Position')
     fig.hold(True)
-    fig.plot(ts, target_ps, 'r--', label='Target Position')
+    figwindows[0].plot(target_ps, None, 'r--', label='Target Position')
     fig.legend(loc=2)
     fig.xaxis.label.set_text('Time (s)')
     fig.yaxis.label.set_text('Position (encoder tics)')
@@ -140,8 +181,8 @@ def readDump(fname) :
     fig = figwindows[1].init_plot()
     #fig.plot(ts, vs, 'c-', label='Velocity')
     fig.hold(True)
-    fig.plot(ts, target_vs, 'r--', label='Target Velocity')
-    fig.plot(ts, cmd_vs, 'g-', label='Command Velocity')
+    figwindows[1].plot(target_vs, None, 'r--', label='Target Velocity')
+    figwindows[1].plot(cmd_vs, None, 'g-', label='Command Velocity')
     fig.legend(loc=2)
     fig.xaxis.label.set_text('Time (s)')
     fig.yaxis.label.set_text('Velocity (encoder tics/min)')
@@ -151,9 +192,9 @@ def readDump(fname) :
     figwindows[1].show()
     
     fig = figwindows[2].init_plot()
-    fig.plot(ts, ps, 'b-', label='Encoder Position')
+    figwindows[2].plot(ps, None, 'b-', label='Encoder Position')
     fig.hold(True)
-    fig.plot(ts, motor_ps, 'g-', label='Motor Step Position')
+    figwindows[2].plot(motor_ps, None, 'g-', label='Motor Step Position')
     fig.legend(loc=2)
     fig.xaxis.label.set_text('Time (s)')
     fig.yaxis.label.set_text('Position (encoder tics)')
@@ -163,29 +204,23 @@ def readDump(fname) :
     figwindows[2].show()
     
     fig = figwindows[3].init_plot()
-    fig.plot(ts, pos_error_derivs, 'b-', label='Position Error Derivative')
+    figwindows[3].plot(pos_error_derivs, None, 'b-', label='Position Error Derivative')
     fig.xaxis.label.set_text('Time (s)')
     fig.yaxis.label.set_text('Error change (tics/update)')
     fig.title.set_text('Position Error Derivative')
     
     figwindows[3].render_plot()
     figwindows[3].show()
-    
-    # also save off a copy of the machine at this time (so we know what was going on later)
-    mach.Machine.save(stamp + 'machine.xml')
 
 
-# defines 
+# captures recently shown (or about to be), as loadDump makes them
+dumpcache = capcache.CaptureCache(loadDump, CACHE_BYTES)
+
+
+# converts a binary dump from the old over-serial ADS stream (each hist_data_t
+# preceded by sep_chr) to csv.
 def convertBinaryDump(fname_in, fname_out, sep_chr="$") :
-    with open(fname_in, "rb") as fin, open(fname_out, "w") as fout :
-         c = ' '
-         while c != "" :
-            c = fin.read(1)
-            if c == sep_chr :
-                # next  bytes are a hist_struct
-                str = fin.read(histStruct.size)
-                d = histStruct.unpack(str)
-                fout.write("%f, %i, %f, %f, %f, %f, %i\n" % d)
+    return histdata.convertSeparatedDump(fname_in, fname_out, sep_chr)
                 
 def closeWindows() :
     for fig in figwindows :
@@ -204,26 +239,118 @@ class cDumpReader(QtGui.QMainWindow) :
         
         uic.loadUi("dumpreader.ui", self)
         
-        # load items into the list widget
-        
-        
-        for file in os.listdir('streams') :
-            if file[-3:].lower() == 'csv' :
-                listItem = QtGui.QListWidgetItem(file[:-4], self.listWidget)
+        # load items into the list widget, from the catalog of the streams
+        # directory. Files that are new or have changed since it was last opened
+        # are indexed on a worker thread, and show up as they are.
+        self.catalog = catalog.Catalog('streams')
+        self.pending = self.catalog.stale()
+        self.indexed = 0        # (counted up by the index thread)
+        self.listed = 0
+        self.closing = threading.Event()
+        self.refreshList()
         
         self.listWidget.currentItemChanged.connect(self.listWidget_Changed)
         #self.listWidget.connect(self.listWidget, QtCore.SIGNAL("selectionChanged(QItemSelection&, QItemSelection&)"),
         #                self.listWidget_Changed)
+        self.filterEdit.textChanged.connect(self.refreshList)
+        
+        self.indexThread = threading.Thread(target=self.indexAll, name='catalog index')
+        self.indexThread.daemon = True
+        self.indexTimer = QtCore.QTimer()
+        self.indexTimer.timeout.connect(self.checkIndex)
+        if len(self.pending) > 0 :
+            self.indexThread.start()
+            self.indexTimer.start(INDEX_POLL_MS)
         
         self.show()
+    
+    # fills the list with the catalog entries that pass the filter
+    def refreshList(self, text=None) :
+        current = self.listWidget.currentItem()
+        current = str(current.text()) if current != None else None
+        try :
+            rows = self.catalog.find(str(self.filterEdit.text()))
+        except (ValueError, sqlite3.Error) as e :
+            self.statusbar.showMessage("Bad filter: %s" % e)
+            return
+        self.listWidget.blockSignals(True)
+        self.listWidget.clear()
+        for row in rows :
+            listItem = QtGui.QListWidgetItem(row['name'], self.listWidget)
+            listItem.setToolTip(describe(row))
+            if row['name'] == current :
+                self.listWidget.setCurrentItem(listItem)
+        self.listWidget.blockSignals(False)
+        self.showStatus()
+    
+    # (on the index thread) indexes the stale captures. It has a Catalog of its
+    # own, since an SQLite connection can only be used on the thread that made it.
+    def indexAll(self) :
+        cat = catalog.Catalog(self.catalog.dirname)
+        try :
+            for name in self.pending :
+                if self.closing.is_set() :
+                    break
+                try :
+                    cat.index(name)
+                except Exception :
+                    traceback.print_exc()   # (gone since stale() found it, say)
+                self.indexed += 1
+        finally :
+            cat.close()
+    
+    # (on the GUI thread) shows whatever's been indexed since last time
+    def checkIndex(self) :
+        if not self.indexThread.is_alive() :
+            self.indexTimer.stop()
+            self.pending = []
+        elif self.indexed == self.listed :
+            return
+        self.listed = self.indexed
+        self.refreshList()
+    
+    def showStatus(self) :
+        if len(self.pending) > 0 :
+            self.statusbar.showMessage("Indexing: %i of %i files left" % (len(self.pending) - self.indexed,
+                                                                         len(self.pending)))
+            return
+        item = self.listWidget.currentItem()
+        row = self.catalog.get(str(item.text())) if item != None else None
+        self.statusbar.showMessage(describe(row) if row != None else "%i captures" % self.listWidget.count())
 
     def closeEvent(self, event) :
+        self.closing.set()
         closeWindows()
         app.quit()
         event.accept()
     
     def listWidget_Changed(self, selected, deselected) :
-        readDump(os.getcwd() + '/streams/' + selected.text() + '.csv')
+        if selected == None :
+            return
+        self.showStatus()
+        # a capture that isn't loaded yet gets its catalog preview first; the
+        # load waits until that's on the screen
+        if not self.path(selected) in dumpcache :
+            preview = self.catalog.preview(str(selected.text()))
+            if preview != None and len(preview[0][0]) > 0 :
+                plotPreview(preview)
+                QtCore.QTimer.singleShot(0, self.showCurrent)
+                return
+        self.showCurrent()
+    
+    def showCurrent(self) :
+        selected = self.listWidget.currentItem()
+        if selected == None :
+            return
+        readDump(self.path(selected))
+        
+        # and get the ones either side ready
+        row = self.listWidget.row(selected)
+        dumpcache.prefetch([self.path(self.listWidget.item(i)) for i in (row + 1, row - 1)
+                            if i >= 0 and i < self.listWidget.count()])
+    
+    def path(self, item) :
+        return os.getcwd() + '/streams/' + str(item.text())
         
 
 app = None
@@ -238,7 +365,11 @@ def start_gui() :
 
 
 if __name__ == "__main__" :
-    if len(sys.argv) > 2 :
+    if len(sys.argv) > 1 and sys.argv[1] == '--batch' :
+        # convert/summarize many captures at once; see batch.py
+        import batch
+        sys.exit(batch.main(sys.argv[2:]))
+    elif len(sys.argv) > 2 :
         convertBinaryDump(sys.argv[1], sys.argv[2], "$")
     elif len(sys.argv) > 1 :
          app = QtGui.QApplication(sys.argv)
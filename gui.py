@@ -38,15 +38,18 @@
 
 from PyQt4 import uic, QtCore, QtGui
 from qonelinetextedit import *
+from qconsole import *
 import sys
 
 from comm import *
 import machineInterface as mach
 import scripts
+import autopoller
 
 BAUDRATE = 119200   # Built to work with a Teensy, which is baudrate-agnostic
 ADS_ESCAPE = ""    # Escape character to use with an alternate data stream (see scripts.py, comm.py). Disabled because it doesn't work with the datarate I need.
 ADS_FIELDLEN = 28   # length of alternate data streams (bytes)
+CONSOLE_FRAME_MS = 33   # device output is added to the console at most this often
 
 # structure to hold information about tabs and their widgets
 class TabContents :
@@ -66,6 +69,9 @@ class cMainGui(QtGui.QMainWindow) :
     tabData = []        # list of TabContents classes
     actionButtons = []
     onlineWidgets = []  # list of widgets we can only use when online (disable otherwise)
+
+    consoleReady = QtCore.pyqtSignal()      # new device output is waiting for the console
+    getAllDone = QtCore.pyqtSignal(object, object, object)     # a Get All's (text fields, values, failed)
     
     
     def __init__(self, parent=None):
@@ -77,16 +83,32 @@ class cMainGui(QtGui.QMainWindow) :
 
         uic.loadUi("gui.ui", self)
 
-        # add the Send button to the online widgets list
+        # add the Send and Get All buttons to the online widgets list
         self.onlineWidgets.append(self.bSend)
-
-        # add a timer for keeping track of the serial port
-        self.tSerialListener = QtCore.QTimer()
-        self.tSerialListener.timeout.connect(self.serialTimer)
-        self.tSerialListener.setInterval(50)
-        self.tSerialListener.start()
+        self.onlineWidgets.append(self.bGetAll)
+
+        # device output that isn't the answer to a request goes to the console.
+        # The comm thread tells us when there's some; we pick it up (and whatever
+        # else arrives in the meantime) on the next frame.
+        self.console = QConsole()
+        self.dConsole = QtGui.QDockWidget("Console", self)
+        self.dConsole.setObjectName("dConsole")
+        self.dConsole.setWidget(self.console)
+        self.addDockWidget(QtCore.Qt.BottomDockWidgetArea, self.dConsole)
+        self.console_pending = False
+        self.consoleReady.connect(self.consoleSchedule)
+        comm.AddLineCallback(self.consoleNotify)
+        comm.AddDebugCallback(self.consoleNotify)
         
-        # add a timer for updating fields marked "auto"
+        # fields marked "auto" are read by the poller's thread, which signals us
+        # with each new value.
+        self.autoFields = {}    # Param -> text field
+        self.poller = autopoller.AutoPoller(self)
+        self.poller.valueUpdated.connect(self.autoValueUpdated)
+        self.poller.start()
+        self.getAllDone.connect(self.getAllFinished)
+
+        # add a timer for updating the Set button texts
         self.tAutoTimer = QtCore.QTimer()
         self.tAutoTimer.timeout.connect(self.autoTimer)
         self.tAutoTimer.setInterval(200)
@@ -101,11 +123,10 @@ class cMainGui(QtGui.QMainWindow) :
         # populate the list of ports
         self.bPort_click(True);
         
-        #self.delayedcalls = []      # list of functions to call on the next tSerialListener loop (needed because rawhid doesn't receive new data during an event)
-        
         self.show()
 
     def closeEvent(self, event) :
+        self.poller.stop()
         scripts.plotter.closeWindows()
         comm.Quit()
         app.quit()
@@ -297,6 +318,7 @@ class cMainGui(QtGui.QMainWindow) :
         self.bLoadSettings.clicked[bool].connect(self.bLoadSettings_click)
         self.bSaveSettings.clicked[bool].connect(self.bSaveSettings_click)
         self.bApplySettings.clicked[bool].connect(self.bApplySettings_click)
+        self.bGetAll.clicked[bool].connect(self.bGetAll_click)
         self.bPort.clicked[bool].connect(self.bPort_click)
         self.bConnect.clicked[bool].connect(self.bConnect_click)
         self.bSend.clicked[bool].connect(self.bSend_click)
@@ -319,16 +341,48 @@ class cMainGui(QtGui.QMainWindow) :
         if fname != "" :
            mach.machine.save(fname)
     
+    # sends only the parameters whose values differ from what the device has.
     def bApplySettings_click(self) :
         if comm.IsOpen() :
+            sent = 0
             for tab in self.tabData :
                 for tProp in tab.tPropList :
                     if not tProp.isHidden() :
-                        if tProp.machine_paramLink.readOnly != "1" :
+                        if not tProp.machine_paramLink.isReadOnly() :
                             if not tProp.machine_paramLink.setValidValue(tProp.toPlainText()) :
                                 tProp.setPlainText(str(tProp.machine_paramLink.value))
-                            tProp.machine_paramLink.setToDevice()
+                            if tProp.machine_paramLink.isDirty() :
+                                tProp.machine_paramLink.setToDevice(True)
+                                sent += 1
+            comm.Flush()
+            self.statusBar().showMessage('Applied %i changed parameters.' % sent)
             
+
+    # reads every parameter shown from the device in one pipelined batch. This
+    # doesn't wait for the answers: getAllFinished shows them once they're in.
+    def bGetAll_click(self) :
+        if comm.IsOpen() :
+            tProps = []
+            for tab in self.tabData :
+                for tProp in tab.tPropList :
+                    if not tProp.isHidden() :
+                        tProps.append(tProp)
+            params = mach.machine.useCached([tProp.machine_paramLink for tProp in tProps])
+            self.statusBar().showMessage('Reading %i parameters...' % len(params))
+            mach.machine.readFromDeviceLater(params, lambda values, failed : self.getAllDone.emit(tProps, values, failed))
+
+    # Called (through a queued signal) with the answers to a Get All.
+    def getAllFinished(self, tProps, values, failed) :
+        for param, value in values.items() :
+            param.value = value
+            param.confirm()
+        for tProp in tProps :
+            if not tProp.machine_paramLink in failed :
+                tProp.setPlainText(str(tProp.machine_paramLink.value))
+        if len(failed) > 0 :
+            self.statusBar().showMessage('Read Error on %i of %i parameters!' % (len(failed), len(tProps)))
+        else :
+            self.statusBar().showMessage('Ready')
     
     def bPort_click(self, pressed):
         # populate the list of ports
@@ -359,6 +413,8 @@ class cMainGui(QtGui.QMainWindow) :
             if 0 == comm.Open(str(self.cPort.currentText()), BAUDRATE, ADS_ESCAPE, ADS_FIELDLEN) :
                 self.statusBar().showMessage('Error connecting to ' + str(self.cPort.currentText()))
             else :
+                # we don't know what the device has until we read or write it.
+                mach.machine.params.forgetDeviceValues()
                 # change this to disconnect
                 self.bConnect.setText('Disconnect')
                 self.statusBar().showMessage('Connected.')
@@ -370,6 +426,9 @@ class cMainGui(QtGui.QMainWindow) :
         if comm.IsOpen() :
             try :
                 comm.Write(str(self.tCommand.toPlainText()))
+                # a typed command can change anything (a set, a mode change...),
+                # so what we knew about the device's values is out of date
+                mach.machine.params.forgetDeviceValues()
                 self.statusBar().showMessage('Ready')
             except comm.ser.SerialException as e :
                 print(str(e))
@@ -383,8 +442,10 @@ class cMainGui(QtGui.QMainWindow) :
     def bAction_Clicked(self) :
         self.sender().machine_cmdLink.doAction()
 
+    # Ctrl+Click skips the shadow cache and always asks the device.
     def bGetParam_Clicked(self) :
-        if self.sender().machine_paramLink.getFromDevice() :
+        force = QtGui.QApplication.keyboardModifiers() == QtCore.Qt.ControlModifier
+        if self.sender().machine_paramLink.getFromDevice(force=force) :
             # It worked! Update the text box
             self.sender().textField_Link.setPlainText(str(self.sender().machine_paramLink.value))
             self.statusBar().showMessage('Ready')
@@ -418,7 +479,11 @@ class cMainGui(QtGui.QMainWindow) :
             self.sender().textField_Link.old_palette = self.sender().textField_Link.palette()
             p.setColor(QtGui.QPalette.Active, QtGui.QPalette.Base, QtCore.Qt.yellow)
             self.sender().bSet_Link.setText("Reset")
+            self.autoFields[self.sender().machine_paramLink] = self.sender().textField_Link
+            self.poller.add(self.sender().machine_paramLink)
         else :
+            self.poller.remove(self.sender().machine_paramLink)
+            self.autoFields.pop(self.sender().machine_paramLink, None)
             p = self.sender().textField_Link.old_palette
             if self.ctrl_down :
                 self.sender().bSet_Link.setText("Res")
@@ -438,15 +503,33 @@ class cMainGui(QtGui.QMainWindow) :
             print("Could not parse value!")
             self.statusBar().showMessage('Parse Error!')
 
-    # This routine runs every 50 ms and checks for new input from the serial port.
-    # this is not a respone from a command, but debug input or something.
-    def serialTimer(self) :
-        #while len(self.delayedcalls) > 0 :
-        #    self.delayedcalls.pop()()       # execute the delayed call
-        comm.DumpToConsole()
-
-    # This routine runs every 200 ms and updates all fields with their "auto"
-    # buttons toggled.
+    # Called on the comm thread for each line of unsolicited input (debug output or
+    # something). Only the first line since the last pump needs to wake us up.
+    def consoleNotify(self, txt) :
+        if not self.console_pending :
+            self.console_pending = True
+            self.consoleReady.emit()
+
+    def consoleSchedule(self) :
+        QtCore.QTimer.singleShot(CONSOLE_FRAME_MS, self.consolePump)
+
+    # Moves everything that has arrived into the console in one go.
+    def consolePump(self) :
+        self.console_pending = False
+        txt = comm.Read()
+        if len(txt) > 0 :
+            self.console.appendText(txt)
+
+    # Called (through a queued signal) when the poller has read a new value for
+    # a parameter marked "auto".
+    def autoValueUpdated(self, param, value) :
+        param.value = value
+        param.confirm()
+        if param in self.autoFields :
+            self.autoFields[param].setPlainText(str(param.value))
+
+    # This routine runs every 200 ms and updates the Set button texts when
+    # Ctrl is pressed or released.
     def autoTimer(self) :
         # check to see if we need to update Set button tetxt
         if self.ctrl_down and QtGui.QApplication.keyboardModifiers() != QtCore.Qt.ControlModifier :
@@ -460,16 +543,11 @@ class cMainGui(QtGui.QMainWindow) :
         else :
             update_texts = False
         
-        # update param values and Set button texts
-        if comm.IsOpen() :
+        # update Set button texts (Auto fields are handled by the poller)
+        if update_texts :
             for tab in self.tabData :
                 for bAuto in tab.bAutoList :
-                    if bAuto.isChecked() :
-                        if bAuto.machine_paramLink.getFromDevice(True) :
-                            # It worked! Update the text box
-                            bAuto.textField_Link.setPlainText(str(bAuto.machine_paramLink.value))
-                    elif update_texts :
-                        # also update the Set button texts
+                    if not bAuto.isChecked() :
                         bAuto.bSet_Link.setText(newtext)
 
 app = None
@@ -0,0 +1,193 @@
+########################################################
+# Control Design GUI: histcodec.py
+# Compact column codecs for hist_data_t captures.
+#
+# Ben Weiss, University of Washington
+# Summer 2014
+#
+# Integer columns (time, position, motor_position) change slowly from record to
+# record, so each is stored as the difference from the previous record, zigzag
+# mapped (so small negative steps stay small) and written as a varint -- usually
+# one byte instead of four. Float columns are byte-shuffled (all the first bytes,
+# then all the second bytes...), which lines up the slowly changing sign and
+# exponent bytes. Either way the result then goes through zlib, or lzma if it's
+# installed. Every step is done with array operations on a whole column at once.
+#
+# These plug into capfile.CODECS, so they're used both when archiving old .bin
+# files (run this file: histcodec.py capture.bin capture.cap [codec]) and when
+# stopStreaming writes a new capture.
+#
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+########################################################
+
+import sys, zlib
+import numpy as np
+
+try :
+    import lzma                         # Python 3, or the backports.lzma package
+except ImportError :
+    try :
+        from backports import lzma
+    except ImportError :
+        lzma = None
+
+
+ZLIB_LEVEL = 6
+VARINT_MAX = 10             # bytes in the longest varint (64 bits / 7)
+
+
+# Zigzag maps signed to unsigned so small magnitudes stay small: 0, -1, 1, -2... -> 0, 1, 2, 3...
+def zigzag(d) :
+    d = d.astype(np.int64)
+    return ((d << 1) ^ (d >> 63)).view(np.uint64)
+
+def unzigzag(z) :
+    z = z.view(np.uint64)
+    return ((z >> np.uint64(1)).view(np.int64)) ^ -((z & np.uint64(1)).view(np.int64))
+
+
+# LEB128 varints: 7 bits per byte, low bits first, high bit set on all but the last byte.
+def varintEncode(v) :
+    v = v.view(np.uint64)
+    nbytes = np.ones(len(v), np.int64)
+    for k in range(1, VARINT_MAX) :
+        nbytes += v >= np.uint64(1) << np.uint64(7 * k)
+    width = int(nbytes.max()) if len(v) > 0 else 1
+    groups = np.empty((len(v), width), np.uint8)
+    for k in range(0, width) :
+        groups[:, k] = (v >> np.uint64(7 * k)) & np.uint64(0x7f)
+    k = np.arange(width)
+    groups |= np.where(k < (nbytes - 1)[:, None], 0x80, 0).astype(np.uint8)
+    return groups[k < nbytes[:, None]].tostring()
+
+def varintDecode(data, n) :
+    b = np.frombuffer(data, np.uint8)
+    last = (b & 0x80) == 0
+    if last.sum() != n or (len(b) > 0 and not last[-1]) :
+        raise ValueError("corrupt varint block")
+    if n == 0 :
+        return np.zeros(0, np.uint64)
+    starts = np.flatnonzero(np.concatenate(([True], last[:-1])))
+    which = np.cumsum(last) - last         # value each byte belongs to
+    shift = (np.arange(len(b)) - starts[which]) * 7
+    parts = (b & 0x7f).astype(np.uint64) << shift.astype(np.uint64)
+    return np.bitwise_or.reduceat(parts, starts)
+
+
+# Shuffles the bytes of a column: byte 0 of every value, then byte 1, ...
+def shuffle(col) :
+    size = col.dtype.itemsize
+    return np.ascontiguousarray(col).view(np.uint8).reshape(len(col), size).T.tostring()
+
+def unshuffle(data, dtype, n) :
+    size = np.dtype(dtype).itemsize
+    b = np.frombuffer(data, np.uint8, n * size).reshape(size, n)
+    return np.ascontiguousarray(b.T).view(dtype).reshape(n)
+
+
+# a column before compression: delta/zigzag/varint for integers, shuffled bytes otherwise
+def packColumn(col) :
+    if col.dtype.kind in 'iu' and col.dtype.itemsize > 1 :
+        x = col.astype(np.int64)
+        return varintEncode(zigzag(np.diff(x, prepend=0)))
+    return shuffle(col)
+
+def unpackColumn(data, dtype, n) :
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu' and dtype.itemsize > 1 :
+        return np.cumsum(unzigzag(varintDecode(data, n))).astype(dtype)
+    return unshuffle(data, dtype, n)
+
+
+# capfile-style (encode, decode) pairs
+def _zlibCodec() :
+    return (lambda col : zlib.compress(packColumn(col), ZLIB_LEVEL),
+            lambda data, dtype, n : unpackColumn(zlib.decompress(data), dtype, n))
+
+def _lzmaCodec() :
+    return (lambda col : lzma.compress(packColumn(col)),
+            lambda data, dtype, n : unpackColumn(lzma.decompress(data), dtype, n))
+
+CODECS = {'delta-zlib' : _zlibCodec()}
+if lzma != None :
+    CODECS['delta-lzma'] = _lzmaCodec()
+
+
+# Keeps track of how much a codec is saving, and how fast it's going.
+class CodecStats :
+
+    def __init__(self) :
+        self.raw_bytes = 0          # everything encoded or decoded, before...
+        self.encoded_bytes = 0      # ...and after encoding
+        self.encode_bytes = 0       # raw bytes encoded, and how long it took
+        self.encode_time = 0.0
+        self.decode_bytes = 0       # raw bytes decoded, and how long it took
+        self.decode_time = 0.0
+
+    def addEncode(self, raw, encoded, secs) :
+        self.raw_bytes += raw
+        self.encoded_bytes += encoded
+        self.encode_bytes += raw
+        self.encode_time += secs
+
+    def addDecode(self, raw, encoded, secs) :
+        self.raw_bytes += raw
+        self.encoded_bytes += encoded
+        self.decode_bytes += raw
+        self.decode_time += secs
+
+    # raw size / encoded size
+    def ratio(self) :
+        return self.raw_bytes / float(max(self.encoded_bytes, 1))
+
+    # MB/s of raw data
+    def encodeRate(self) :
+        return self.encode_bytes / max(self.encode_time, 1e-9) / 1e6
+
+    def decodeRate(self) :
+        return self.decode_bytes / max(self.decode_time, 1e-9) / 1e6
+
+    def report(self) :
+        txt = "%.1f MB <-> %.1f MB (%.1fx)" % (self.raw_bytes / 1e6, self.encoded_bytes / 1e6, self.ratio())
+        if self.encode_time > 0 :
+            txt += ", encoded at %.0f MB/s" % self.encodeRate()
+        if self.decode_time > 0 :
+            txt += ", decoded at %.0f MB/s" % self.decodeRate()
+        return txt
+
+
+if __name__ == "__main__" :
+    import capfile, histdata
+    if len(sys.argv) < 3 :
+        print "usage: histcodec.py capture.bin capture.cap [%s]" % '|'.join(sorted(capfile.CODECS))
+        sys.exit(1)
+    w = capfile.CaptureWriter(sys.argv[2], codec=sys.argv[3] if len(sys.argv) > 3 else capfile.DEFAULT_CODEC)
+    for recs in histdata.iterRawRecords(sys.argv[1]) :
+        w.append(recs)
+    w.close()
+    print "Wrote %i records: %s" % (len(w), w.stats.report())
+    # read it all back, to check it and time the decoding
+    cap = capfile.CaptureFile(sys.argv[2])
+    ok = np.array_equal(cap[:], np.concatenate(list(histdata.iterRawRecords(sys.argv[1]))))
+    print "Read back %s: %s" % ("OK" if ok else "WITH ERRORS", cap.stats.report())
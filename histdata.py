@@ -0,0 +1,473 @@
+########################################################
+# Control Design GUI: histdata.py
+# Fast readers and converters for hist_data_t records.
+#
+# Ben Weiss, University of Washington
+# Summer 2014
+#
+# hist_data_t records are read straight into a NumPy structured array (HIST_DTYPE
+# matches histStruct, "=LlfffflB", byte for byte), a large chunk at a time, and
+# each chunk is formatted to text with a single string operation instead of one
+# struct.unpack and one write per record. Only one chunk is ever in memory, so
+# multi-GB dumps convert in bounded memory.
+#
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+########################################################
+
+import itertools, re, os, math, bisect
+import numpy as np
+
+
+# hist_data_t, as sent by the Teensy (little-endian, packed)
+HIST_DTYPE = np.dtype([('time', '<u4'),             # *10us
+                       ('position', '<i4'),         # tics
+                       ('pos_error_deriv', '<f4'),  # tics/update
+                       ('cmd_velocity', '<f4'),     # tics/min
+                       ('target_pos', '<f4'),       # tics
+                       ('target_vel', '<f4'),       # tics/min
+                       ('motor_position', '<i4'),   # tics
+                       ('flags', 'u1')])
+HIST_TICK = 0.00001         # s per unit of hist_data_t.time
+HIST_FIELDS = HIST_DTYPE.names
+
+CHUNK_RECORDS = 1 << 16     # records converted per chunk (~2 MB of binary)
+
+# csv layout written for RawHID stream dumps (all fields)
+STREAM_CSV_HEADER = "Time (*10us), Position (tics), Position Error Derivative (tics), Cmd Vel (tics/min), Target Pos (tics), Target Vel (tics), Motor Position (tics), Flags\n"
+STREAM_CSV_FORMAT = "%f, %i, %f, %f, %f, %f, %i, %i\n"
+# csv layout of the older dumps and control history downloads (no flags column)
+HISTORY_CSV_HEADER = "Time(s*1e5), Position (tics), Velocity (tics/min), Command Velocity (tics/min), Target Position (tics), Target Velocity (tics/min), Motor Position (tics)\n"
+HISTORY_CSV_FORMAT = "%f, %i, %f, %f, %f, %f, %i\n"
+SIDECAR_EXT = '.npy'        # binary copy of a parsed csv, kept alongside it
+
+
+# Yields successive chunks (structured arrays of HIST_DTYPE) of a RawHID binary
+# stream dump -- back-to-back hist_data_t records with no separators. A partial
+# record at the end of the file is ignored.
+def iterRawRecords(fname, chunk=CHUNK_RECORDS) :
+    with open(fname, "rb") as fin :
+        while True :
+            buf = fin.read(chunk * HIST_DTYPE.itemsize)
+            n = len(buf) // HIST_DTYPE.itemsize
+            if n == 0 :
+                break
+            yield np.frombuffer(buf, HIST_DTYPE, n)
+
+
+# Yields successive chunks of a dump from the old over-serial ADS stream, where
+# each hist_data_t is preceded by a separator character. Bytes are skipped up to
+# the next separator whenever the stream is out of step, exactly as the old
+# byte-at-a-time reader did, but runs of well-formed records (the usual case) are
+# picked out with a single strided view.
+def iterSeparatedRecords(fname, sep_chr="$", chunk=CHUNK_RECORDS) :
+    stride = HIST_DTYPE.itemsize + 1
+    sep = ord(sep_chr)
+    with open(fname, "rb") as fin :
+        left = ''
+        while True :
+            more = fin.read(chunk * stride)
+            buf = left + more
+            p = 0
+            out = []
+            while True :
+                if p < len(buf) and ord(buf[p]) != sep :
+                    p = buf.find(sep_chr, p)
+                    if p < 0 :
+                        p = len(buf)
+                m = (len(buf) - p) // stride
+                if m == 0 :
+                    break
+                rows = np.frombuffer(buf, np.uint8, m * stride, p).reshape(m, stride)
+                bad = np.flatnonzero(rows[:, 0] != sep)
+                run = bad[0] if len(bad) > 0 else m
+                out.append(rows[:run, 1:])
+                p += run * stride
+            if len(out) > 0 :
+                recs = np.concatenate(out)
+                yield np.ascontiguousarray(recs).view(HIST_DTYPE).reshape(len(recs))
+            left = buf[p:]
+            if len(more) == 0 :
+                break
+
+
+# Formats a chunk of records as text, one line per record. fmt holds one
+# %-conversion per field (extra fields at the end of each record are dropped).
+# The text is identical to formatting each record with fmt % record.
+def formatRecords(recs, fmt=STREAM_CSV_FORMAT) :
+    parts = _CONVERSION.split(fmt)
+    convs = parts[1::2]
+    if len(recs) == 0 :
+        return ''
+    if '%' not in ''.join(parts[0::2]) and len(convs) <= len(HIST_FIELDS) :
+        cols = []
+        for i in range(0, len(convs)) :
+            cols.append(_literal(parts[2 * i], len(recs)))
+            if convs[i] == 'f' :
+                col = _formatFixed(recs[HIST_FIELDS[i]])
+            else :
+                col = _formatInt(recs[HIST_FIELDS[i]])
+            if col is None :
+                break
+            cols.append(col)
+        else :
+            cols.append(_literal(parts[-1], len(recs)))
+            text = np.hstack(cols).ravel()
+            return text[text != 0].tostring()
+
+    # something the fast path can't handle (nan/inf, huge values, other conversions)
+    if len(convs) < len(HIST_FIELDS) :
+        recs = recs[list(HIST_FIELDS[:len(convs)])]
+    return (fmt * len(recs)) % tuple(itertools.chain.from_iterable(recs.tolist()))
+
+
+# Text is built up as a 2D array of ASCII codes, one row per record and a few
+# columns per field. Unused leading positions are left as 0 and squeezed out at
+# the end, which is how variable-width numbers come out of fixed-width columns.
+_CONVERSION = re.compile(r'%([dif])')
+
+
+def _literal(txt, n) :
+    return np.tile(np.fromstring(txt, np.uint8), (n, 1))
+
+
+# decimal digits of the non-negative int64 array v, right aligned in width
+# columns. Leading zeros are blanked (but a lone 0 is kept) unless pad is set.
+# Digits are produced two at a time from a lookup table.
+def _digits(v, width, pad=False) :
+    npairs = (width + 1) // 2
+    out = np.empty((len(v), npairs), '<u2')
+    rest = v
+    for j in range(npairs - 1, -1, -1) :
+        rest, pair = np.divmod(rest, 100)
+        out[:, j] = _DIGIT_PAIRS.take(pair)
+    out = out.view(np.uint8)[:, 2 * npairs - width:]
+    if not pad :
+        ndigits = np.searchsorted(_POWERS_OF_TEN, v, 'right') + 1
+        out *= np.arange(width) >= (width - ndigits)[:, None]
+    return out
+
+_DIGIT_PAIRS = np.array([(48 + i // 10) | (48 + i % 10) << 8 for i in range(0, 100)], '<u2')
+_POWERS_OF_TEN = 10 ** np.arange(1, 19, dtype=np.int64)
+
+
+def _sign(neg) :
+    return np.where(neg, ord('-'), 0).astype(np.uint8)[:, None]
+
+
+# %i of an integer column
+def _formatInt(col) :
+    if col.dtype.kind not in 'iu' :
+        return None
+    v = col.astype(np.int64)
+    a = np.abs(v)
+    return np.hstack([_sign(v < 0), _digits(a, len(str(a.max())))])
+
+
+# %f of a column: the value rounded (half to even, on its exact binary value, as
+# Python does) to 6 decimal places. For float32 that's done exactly in integer
+# arithmetic: x = m * 2**(e - 24), so x * 10**6 = m * 15625 * 2**(e - 18).
+def _formatFixed(col) :
+    if col.dtype.kind in 'iu' :
+        v = col.astype(np.int64)
+        neg = v < 0
+        q = np.abs(v) * 1000000
+    elif col.dtype == np.float32 :
+        x = col.astype(np.float64)
+        if not np.all(np.isfinite(x)) or np.abs(x).max() >= 2.0 ** 41 :
+            return None
+        neg = np.signbit(x)
+        f, e = np.frexp(np.abs(x))
+        p = (f * (1 << 24)).astype(np.int64) * 15625
+        s = 18 - e.astype(np.int64)
+        q = p << np.maximum(-s, 0)
+        s = np.clip(s, 0, 62)
+        down = p >> s
+        rem = p - (down << s)
+        half = (np.int64(1) << np.maximum(s - 1, 0)) * (s > 0)
+        up = (s > 0) & ((rem > half) | ((rem == half) & (down & 1 == 1)))
+        q = np.where(s > 0, down + up, q)
+    else :
+        return None
+    whole = q // 1000000
+    return np.hstack([_sign(neg), _digits(whole, len(str(whole.max()))),
+                      _literal('.', len(q)), _digits(q % 1000000, 6, True)])
+
+
+# Writes every chunk from chunks to fout. Returns the number of records written.
+def writeCsv(chunks, fout, fmt=STREAM_CSV_FORMAT) :
+    total = 0
+    for recs in chunks :
+        fout.write(formatRecords(recs, fmt))
+        total += len(recs)
+    return total
+
+
+# Converts a RawHID binary stream dump to csv. Returns the number of records.
+def convertRawDump(fname_in, fname_out, header=STREAM_CSV_HEADER, fmt=STREAM_CSV_FORMAT) :
+    with open(fname_out, "w") as fout :
+        fout.write(header)
+        return writeCsv(iterRawRecords(fname_in), fout, fmt)
+
+
+# Converts a separated (old ADS stream) dump to csv. Returns the number of records.
+def convertSeparatedDump(fname_in, fname_out, sep_chr="$", header=HISTORY_CSV_HEADER, fmt=HISTORY_CSV_FORMAT) :
+    with open(fname_out, "w") as fout :
+        fout.write(header)
+        return writeCsv(iterSeparatedRecords(fname_in, sep_chr), fout, fmt)
+
+
+# Loads a history csv (stream conversions, ctrlHistory downloads, converted dumps)
+# into an array of HIST_DTYPE records; flags are 0 for files without that column.
+# The text is parsed a chunk of lines at a time straight into a float array. The
+# first line must be the header, and a malformed row raises ValueError naming the
+# line. The parsed records are saved next to the csv (fname + SIDECAR_EXT), and
+# later loads of an unchanged file just map that instead.
+def loadCsv(fname, sidecar=True) :
+    side = fname + SIDECAR_EXT
+    if sidecar and os.path.exists(side) and os.path.getmtime(side) >= os.path.getmtime(fname) :
+        try :
+            recs = np.load(side, mmap_mode='r')
+            if recs.dtype == HIST_DTYPE :
+                return recs
+        except (IOError, ValueError) :
+            pass        # unreadable; parse the csv again
+    
+    chunks = []
+    with open(fname, "r") as fin :
+        header = fin.readline()
+        if not header.startswith('Time') :
+            raise ValueError("%s: not a history csv (header is %r)" % (fname, header[:40]))
+        ncols = len(header.split(','))
+        if not ncols in (7, 8) :
+            raise ValueError("%s: expected 7 or 8 columns, header has %i" % (fname, ncols))
+        lineno = 2
+        while True :
+            lines = list(itertools.islice(fin, CHUNK_RECORDS))
+            if len(lines) == 0 :
+                break
+            chunks.append(_parseCsvLines(lines, ncols, fname, lineno))
+            lineno += len(lines)
+    
+    recs = np.zeros(sum([len(c) for c in chunks]), HIST_DTYPE)
+    i = 0
+    for c in chunks :
+        for j in range(0, ncols) :
+            recs[HIST_FIELDS[j]][i:i + len(c)] = c[:, j]
+        i += len(c)
+    
+    if sidecar :
+        try :
+            np.save(side, recs)
+        except (IOError, OSError) :
+            pass        # read-only directory, etc; we just won't have a cache
+    return recs
+
+
+# parses a list of csv lines (starting at line number lineno) into an n x ncols
+# float array. Blank lines are skipped.
+def _parseCsvLines(lines, ncols, fname, lineno) :
+    rows = [l for l in lines if l.strip() != '']
+    nrows = len(rows)
+    text = ''.join(rows)
+    vals = np.fromstring(text.replace('\n', ','), np.float64, sep=',')
+    if len(vals) == nrows * ncols and text.count(',') == nrows * (ncols - 1) :
+        return vals.reshape(nrows, ncols)
+    # something's wrong; find the row and say which
+    for i in range(0, len(lines)) :
+        if lines[i].strip() == '' :
+            continue
+        fields = lines[i].split(',')
+        try :
+            if len(fields) != ncols :
+                raise ValueError("%i columns, expected %i" % (len(fields), ncols))
+            [float(f) for f in fields]
+        except ValueError as e :
+            raise ValueError("%s line %i: malformed row (%s): %r" % (fname, lineno + i, e, lines[i].rstrip()))
+    raise ValueError("%s lines %i-%i: malformed rows" % (fname, lineno, lineno + len(lines) - 1))
+
+
+# Random access to a RawHID stream capture (streams/*.bin) without reading it.
+# The file is memory-mapped as an array of hist_data_t records, so opening is
+# instant whatever its size, and only the pages that are actually looked at are
+# read from disk. Columns and slices are views into the map; nothing is copied
+# until it's used. The time field is assumed to increase through the capture
+# (it wraps after ~11.9 hours of device uptime).
+class CaptureReader :
+
+    def __init__(self, fname) :
+        self.fname = fname
+        n = os.path.getsize(fname) // HIST_DTYPE.itemsize
+        if n > 0 :
+            self.recs = np.memmap(fname, HIST_DTYPE, 'r', shape=(n,))
+        else :
+            self.recs = np.zeros(0, HIST_DTYPE)     # can't map an empty file
+
+    def __len__(self) :
+        return len(self.recs)
+
+    # capture['position'] -> that channel for every record;
+    # capture[i:j] -> records i to j
+    def __getitem__(self, key) :
+        return self.recs[key]
+
+    def channel(self, name, start=0, stop=None) :
+        return self.recs[name][start:stop]
+
+    # record times in seconds. This one has to be computed, so it's a copy.
+    def seconds(self, start=0, stop=None) :
+        return self.recs['time'][start:stop] * HIST_TICK
+
+    # index of the first record at or after t seconds (binary search; only a
+    # few dozen records are touched)
+    def indexAt(self, t) :
+        return bisect.bisect_left(self.recs['time'], int(math.ceil(t / HIST_TICK)))
+
+    # records from t0 up to (not including) t1 seconds
+    def timeSlice(self, t0, t1) :
+        return self.recs[self.indexAt(t0):self.indexAt(t1)]
+
+    # time span of the capture, in seconds
+    def timeRange(self) :
+        if len(self.recs) == 0 :
+            return (0.0, 0.0)
+        return (self.recs['time'][0] * HIST_TICK, self.recs['time'][-1] * HIST_TICK)
+
+    def close(self) :
+        self.recs = np.zeros(0, HIST_DTYPE)
+
+
+# Follows a stream capture that is still being written (by the rawhid listener or
+# a transport's data stream). Each read() returns just the whole records that
+# have arrived since the last one; a trailing partial record is kept until the
+# rest of it shows up.
+class TailReader :
+
+    def __init__(self, fname) :
+        self.fname = fname
+        self.fin = None
+        self.offset = 0         # bytes of the file consumed so far
+        self.partial = ''
+
+    def read(self) :
+        if self.fin is None :
+            try :
+                self.fin = open(self.fname, "rb")
+            except IOError :
+                return np.zeros(0, HIST_DTYPE)      # not created yet
+        self.fin.seek(self.offset)      # (clears EOF, so newly appended data is seen)
+        data = self.fin.read()
+        self.offset += len(data)
+        if self.partial :
+            data = self.partial + data
+        n = len(data) // HIST_DTYPE.itemsize
+        self.partial = data[n * HIST_DTYPE.itemsize:]
+        return np.frombuffer(data, HIST_DTYPE, n)
+
+    def close(self) :
+        if self.fin is not None :
+            self.fin.close()
+            self.fin = None
+
+
+# Fixed-size ring of the most recent hist_data_t records, for strip charts.
+# Storage is allocated once. Every record is written twice, capacity apart, so
+# the newest records are always one contiguous slice: views for plotting never
+# need to be copied or reallocated. Records pushed out of the ring are handed to
+# spill.append() if a spill (e.g. a capfile.CaptureWriter) is given; otherwise
+# they're just counted.
+class HistRing :
+
+    def __init__(self, capacity, spill=None, dtype=HIST_DTYPE) :
+        self.capacity = capacity
+        self.spill = spill
+        self.recs = np.zeros(2 * capacity, dtype)
+        self.ts = np.zeros(2 * capacity)        # record times in s, for plotting
+        self.head = 0           # index of the oldest record (< capacity)
+        self.count = 0
+        self.appended = 0       # records ever appended
+        self.overwritten = 0    # records pushed out by newer ones
+        self.spilled = 0        # ...of which were handed to spill
+        self.dropped = 0        # records never stored (one append bigger than the ring)
+
+    def __len__(self) :
+        return self.count
+
+    def append(self, recs) :
+        m = len(recs)
+        self.appended += m
+        if m > self.capacity :
+            # only the newest <capacity> can be kept
+            self._evict(self.count)
+            if self.spill != None :
+                self.spill.append(recs[:m - self.capacity])
+                self.spilled += m - self.capacity
+                self.overwritten += m - self.capacity
+            else :
+                self.dropped += m - self.capacity
+            recs = recs[m - self.capacity:]
+            m = self.capacity
+        if self.count + m > self.capacity :
+            self._evict(self.count + m - self.capacity)
+
+        # write, and mirror the part on each side of <capacity>
+        w = (self.head + self.count) % self.capacity
+        self.recs[w:w + m] = recs
+        self.ts[w:w + m] = recs['time'] * HIST_TICK
+        a = min(w + m, self.capacity)
+        self.recs[w + self.capacity:a + self.capacity] = self.recs[w:a]
+        self.ts[w + self.capacity:a + self.capacity] = self.ts[w:a]
+        if w + m > self.capacity :
+            self.recs[0:w + m - self.capacity] = self.recs[self.capacity:w + m]
+            self.ts[0:w + m - self.capacity] = self.ts[self.capacity:w + m]
+        self.count += m
+
+    # the records in the ring, oldest first (a view), and their times in s
+    def view(self) :
+        return self.recs[self.head:self.head + self.count]
+
+    def seconds(self) :
+        return self.ts[self.head:self.head + self.count]
+
+    # (records, times in s) for just the last <secs> seconds, as views
+    def window(self, secs) :
+        ts = self.seconds()
+        if len(ts) == 0 :
+            return self.view(), ts
+        i = int(np.searchsorted(ts, ts[-1] - secs))
+        return self.view()[i:], ts[i:]
+
+    def clear(self) :
+        self._evict(self.count)
+        self.head = 0
+
+    # drops the oldest n records (handing them to spill first)
+    def _evict(self, n) :
+        if n <= 0 :
+            return
+        if self.spill != None :
+            self.spill.append(self.recs[self.head:self.head + n].copy())
+            self.spilled += n
+        self.overwritten += n
+        self.head = (self.head + n) % self.capacity
+        self.count -= n
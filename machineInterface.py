@@ -45,9 +45,19 @@ import xml.etree.cElementTree as ET
 from comm import *
 import time
 import re
+import threading
 import scripts
 
 
+# Values of non-volatile parameters read from or written to the device are
+# served from the shadow copy (Param.device_value) instead of asking the device
+# again, until a mode command or reconnect invalidates them, or they get older
+# than this (seconds) as a safety net.
+SHADOW_MAX_AGE = 60.0
+
+DEFAULT_POLL_RATE = 5.0     # Hz, how often "Auto" parameters are read unless they say otherwise
+
+
 machine = None
 
 
@@ -64,7 +74,7 @@ class Machine :
         self.get_cmd = ''
         self.set_cmd = ''
         self.cmds = []
-        self.params = []
+        self.params = ParamRegistry()
         self.tabs = []
     
         self.xmltree = ET.ElementTree(file=fname)
@@ -90,7 +100,7 @@ class Machine :
             elif child.tag == 'Parameters' :
                 for param in child :
                     p = Param(param)
-                    self.params.append(p)
+                    self.params.add(p)
                     try :
                         self.tabs.index(p.tab)
                     except ValueError :
@@ -109,13 +119,101 @@ class Machine :
             if child.tag == 'Parameters' :
                 for vparam in child :
                     if vparam.attrib.has_key('name') :
-                        for param in self.params :
-                            if param.name.lower() == vparam.attrib['name'].lower() :
-                                param.value = vparam.text
-                                param.default_value = vparam.text
+                        param = self.params.byName(vparam.attrib['name'])
+                        if param != None :
+                            param.value = vparam.text
+                            param.default_value = vparam.text
+
+    # Reads every parameter in params (all of them by default) from the device.
+    # Rather than waiting for each answer before asking for the next value, all
+    # the get commands go out back-to-back and the answers are matched up with
+    # them in order as they come back (debug lines are skipped by comm). Values
+    # in the shadow cache are used without asking unless force is set. Returns
+    # the list of params that timed out or couldn't be parsed.
+    def getAllFromDevice(self, params=None, quiet=False, force=False) :
+        if params == None :
+            params = self.params
+        if not comm.IsOpen() :
+            return list(params)
+        if not force :
+            params = self.useCached(params)
+        values, failed = self.readFromDevice(params, quiet)
+        for p in params :
+            if p in values :
+                p.value = values[p]
+                p.confirm()
+        return failed
+
+    # The reading half of getAllFromDevice: returns ({param : value read}, [params
+    # that timed out or couldn't be parsed]) without changing the params, so it
+    # can be used off the GUI thread (see autopoller.py).
+    def readFromDevice(self, params, quiet=False) :
+        if not quiet :
+            print ">" + ", ".join([self.get_cmd + p.cmd for p in params])
+        requests = [(p, comm.Request(self.get_cmd + p.cmd)) for p in params]
+        values = {}
+        failed = []
+        for p, f in requests :
+            try :
+                values[p] = p.parse(f.Result(), quiet)
+            except (CommTimeout, IOError) :
+                if not quiet :
+                    print "No return for " + p.name + "!"
+                failed.append(p)
+            except ValueError :
+                failed.append(p)
+        return values, failed
+
+    # Like readFromDevice, but doesn't wait for the answers: done(values, failed)
+    # is called once they're all in (or have failed). That's on the comm thread,
+    # so a GUI should hand the results to its own thread (with a signal) before
+    # putting them in the params.
+    def readFromDeviceLater(self, params, done, quiet=False) :
+        params = list(params)
+        if not quiet :
+            print ">" + ", ".join([self.get_cmd + p.cmd for p in params])
+        values = {}
+        failed = []
+        lock = threading.Lock()
+        def answered(p, f) :
+            value = None
+            try :
+                value = p.parse(f.Result(0), quiet)
+                ok = True
+            except (CommTimeout, IOError, ValueError) :
+                ok = False
+            with lock :
+                if ok :
+                    values[p] = value
+                else :
+                    failed.append(p)
+                last = len(values) + len(failed) == len(params)
+            if last :
+                done(values, failed)
+        if len(params) == 0 :
+            done(values, failed)
+        for p in params :
+            comm.Request(self.get_cmd + p.cmd).AddCallback(lambda f, p=p : answered(p, f))
+
+    # Sets the params (of those given) that are in the shadow cache from it, and
+    # returns the rest -- the ones that have to be asked for.
+    def useCached(self, params) :
+        for p in params :
+            if p.isCached() :
+                p.value = p.device_value
+        return [p for p in params if not p.isCached()]
 
     # saves back the Machine structure to the xml file
     def save(self, fname) :
+        self.updatexml()
+        self.xmltree.write(fname)
+
+    # returns the Machine structure as an xml string (as save would write it)
+    def toxml(self) :
+        self.updatexml()
+        return ET.tostring(self.xmltree.getroot())
+
+    def updatexml(self) :
         root = self.xmltree.getroot()
         root.set('name', self.name)
         root.set('debugstr', self.debugstr)
@@ -126,8 +224,6 @@ class Machine :
         for param in self.params :
             param.updatexml()
 
-        self.xmltree.write(fname)
-
 
 
 class Command :
@@ -164,11 +260,64 @@ class Command :
         if comm.IsOpen() :
             print ">" + self.cmd
             comm.Write(self.cmd)
+            # a mode change can change parameters behind our back.
+            if self.cmd != '' and machine != None :
+                machine.params.forgetDeviceValues()
             if self.action != '' and self.action != None :
                 exec self.action
 
 
 
+# Indexed collection of a machine's Params. Iterates (and indexes) like the plain
+# list it replaces, in the order the parameters appear in the xml file.
+class ParamRegistry :
+
+    def __init__(self) :
+        self.params = []
+        self.names = {}     # lower-case name -> Param
+        self.cmds = {}      # cmd -> Param
+        self.tabs = {}      # lower-case tab name -> [Param, ...]
+
+    def add(self, param) :
+        self.params.append(param)
+        self.names[param.name.lower()] = param
+        self.cmds[param.cmd] = param
+        self.tabs.setdefault(param.tab.lower(), []).append(param)
+
+    def __iter__(self) :
+        return iter(self.params)
+
+    def __len__(self) :
+        return len(self.params)
+
+    def __getitem__(self, i) :
+        return self.params[i]
+
+    # The lookups return None (or an empty list) if there's no match.
+    def byName(self, name) :
+        return self.names.get(name.lower())
+
+    def byCmd(self, cmd) :
+        return self.cmds.get(cmd)
+
+    def byTab(self, tab) :
+        return self.tabs.get(tab.lower(), [])
+
+    # Returns the writable params whose value differs from what the device last
+    # confirmed (or that we've never read or written).
+    def dirty(self) :
+        return [p for p in self.params if not p.isReadOnly() and p.isDirty()]
+
+    # Forgets everything we knew about the values on the device, e.g. after
+    # (re)connecting or changing modes, so the next read goes to the device and
+    # the next apply sends everything.
+    def forgetDeviceValues(self) :
+        for p in self.params :
+            p.device_value = None
+            p.device_time = 0
+
+
+
 class Param :
     
 
@@ -179,6 +328,10 @@ class Param :
         self.datatype = 'Int'
         self.value = 0
         self.default_value = 0
+        self.device_value = None    # the last value read from or written to the device
+        self.device_time = 0        # ...and when (time.time())
+        self.volatile = False       # True for values that change on their own (never cached)
+        self.pollRate = DEFAULT_POLL_RATE   # Hz, when polled with the GUI's Auto button
         self.tab = ''
         self.xmlnode = None
 
@@ -198,8 +351,16 @@ class Param :
             self.datatype = xmlnode.attrib['type']
         if xmlnode.attrib.has_key('tab') :
             self.tab = xmlnode.attrib['tab']
+        self.volatile = False
+        if xmlnode.attrib.has_key('volatile') :
+            self.volatile = xmlnode.attrib['volatile'] == "1"
+        self.pollRate = DEFAULT_POLL_RATE
+        if xmlnode.attrib.has_key('pollrate') :
+            self.pollRate = float(xmlnode.attrib['pollrate'])
         self.value = xmlnode.text
         self.default_value = xmlnode.text
+        self.device_value = None
+        self.device_time = 0
 
     def updatexml(self) :
         if self.xmlnode != None :
@@ -208,47 +369,76 @@ class Param :
             self.xmlnode.set('readonly', str(self.readOnly))
             self.xmlnode.set('type', self.datatype)
             self.xmlnode.set('tab', self.tab)
+            # these two are only written when they aren't the defaults, so a save
+            # doesn't add them to every parameter in the file
+            self.setOptional('volatile', "1", self.volatile)
+            self.setOptional('pollrate', '%g' % self.pollRate, self.pollRate != DEFAULT_POLL_RATE)
             self.xmlnode.text = str(self.value)
 
-    # Queries the device for the value of this parameter and updates self.value
-    def getFromDevice(self, quiet=False) :
+    # sets xml attribute attr to text if used is True, otherwise leaves it out
+    def setOptional(self, attr, text, used) :
+        if used :
+            self.xmlnode.set(attr, text)
+        elif self.xmlnode.attrib.has_key(attr) :
+            del self.xmlnode.attrib[attr]
+
+    # Queries the device for the value of this parameter and updates self.value.
+    # Non-volatile values are served from the shadow cache unless force is set.
+    def getFromDevice(self, quiet=False, force=False) :
         if comm.IsOpen() :
+            if not force and self.isCached() :
+                self.value = self.device_value
+                return True
             if not quiet :
                 print ">" + machine.get_cmd + self.cmd
-            comm.Write(machine.get_cmd + self.cmd)
-            for i in range(0,15) :   # read a few lines in case there's other dribble
-                line = comm.ReadLn()
-                #print '"' + line + '"'
-                if '' == line :
-                   print "No return!"
-                   return True
-                if line[0] != machine.debugstr :
-                    r = re.compile("[ \t\n\r]+")
-                    data = r.split(line)[0]
-                    # cast data to the right form
-                    try :
-                        if self.datatype.lower() == "int" :
-                            self.value = int(data)
-                        elif self.datatype.lower() == "uint" :
-                            self.value = int(data)
-                        elif self.datatype.lower() == "float" :
-                            self.value = float(data)
-                        else :  # assumed to be string, keep the whole line, sans white-space
-                            self.value = line.strip()
-                        return True
-                    except ValueError :
-                        if not quiet :
-                            print("Error parseing response from chip! Tried to parse '%s' and failed. Whole line: %s" % (data, line))
-                        return False
-                else :
-                    print line,
+            try :
+                line = comm.Request(machine.get_cmd + self.cmd).Result()
+            except (CommTimeout, IOError) :
+                print "No return!"
+                return False
+            return self.parseResponse(line, quiet)
         return False
 
-    # Sets the value to the device
-    def setToDevice(self) :
+    # Parses a line the device sent in response to a get command into self.value.
+    # Returns True if it parsed.
+    def parseResponse(self, line, quiet=False) :
+        try :
+            self.value = self.parse(line, quiet)
+        except ValueError :
+            return False
+        self.confirm()
+        return True
+
+    # Returns the value in a line the device sent in response to a get command,
+    # cast to this parameter's type; raises ValueError if it doesn't parse.
+    def parse(self, line, quiet=False) :
+        r = re.compile("[ \t\n\r]+")
+        data = r.split(line.strip())[0]
+        # cast data to the right form
+        try :
+            if self.datatype.lower() == "int" :
+                return int(data)
+            elif self.datatype.lower() == "uint" :
+                return int(data)
+            elif self.datatype.lower() == "float" :
+                return float(data)
+            else :  # assumed to be string, keep the whole line, sans white-space
+                return line.strip()
+        except ValueError :
+            if not quiet :
+                print("Error parseing response from chip! Tried to parse '%s' and failed. Whole line: %s" % (data, line))
+            raise
+
+    # Sets the value to the device. If batched, the command may be packed in with
+    # other batched writes (see comm.WriteBatched); call comm.Flush() when done.
+    def setToDevice(self, batched=False) :
         if comm.IsOpen() :
             print ">" + machine.set_cmd + self.cmd + ' ' + str(self.value)
-            comm.Write(machine.set_cmd + self.cmd + ' ' + str(self.value))
+            if batched :
+                comm.WriteBatched(machine.set_cmd + self.cmd + ' ' + str(self.value))
+            else :
+                comm.Write(machine.set_cmd + self.cmd + ' ' + str(self.value))
+            self.confirm()
     
     # Restores the value to default and sets the value to the device.
     def restoreDefault(self) :
@@ -256,6 +446,39 @@ class Param :
         if comm.IsOpen() :
             print ">" + machine.set_cmd + self.cmd + ' ' + str(self.value)
             comm.Write(machine.set_cmd + self.cmd + ' ' + str(self.value))
+            self.confirm()
+
+    # Records that the device now has self.value.
+    def confirm(self) :
+        self.device_value = self.value
+        self.device_time = time.time()
+
+    # Returns True if the shadow copy of the device's value can be used instead
+    # of asking the device.
+    def isCached(self) :
+        return not self.volatile and self.device_value != None and \
+            time.time() - self.device_time < SHADOW_MAX_AGE
+
+    def isReadOnly(self) :
+        return self.readOnly == "1" or self.readOnly == True
+
+    # Returns True if value isn't known to match what's on the device.
+    def isDirty(self) :
+        if self.device_value == None :
+            return True
+        return self.normalized(self.value) != self.normalized(self.device_value)
+
+    # Returns v cast to this parameter's type (so "1.0" and 1.0 compare equal),
+    # or as a stripped string if it doesn't parse.
+    def normalized(self, v) :
+        try :
+            if self.datatype.lower() == "uint" or self.datatype.lower() == "int" :
+                return int(v)
+            elif self.datatype.lower() == "float" :
+                return float(v)
+        except (ValueError, TypeError) :
+            pass
+        return str(v).strip()
 
     # Validates the value newvalue, and if it is OK, stores it locally.
     # Returns True for successful parse and store, False otherwise
@@ -279,6 +502,7 @@ class Param :
 def loadMachine(fname) :
     global machine
     machine = Machine(fname)
+    comm.SetDebugStr(machine.debugstr)
 
 if __name__ == "__main__" :
     loadMachine('machine.xml')
@@ -0,0 +1,278 @@
+########################################################
+# Control Design GUI: metrics.py
+# Tracking performance numbers for a capture.
+#
+# Ben Weiss, University of Washington
+# Summer 2014
+#
+# For a control history or stream capture this works out
+#   - the tracking error (target_pos - position): mean, RMS and max
+#   - the fraction of records where the error is over the fault threshold (the
+#     "Fault Threshold (tics)" machine parameter)
+#   - for each move to a new target that's then held (step paths, custom paths
+#     with pauses...): the overshoot past the target, and the settling time --
+#     from the move to when the error last comes inside SETTLE_BAND tics. A move
+#     whose error is still outside the band when the target next changes is
+#     counted as not settled.
+# Continuously moving targets (sines, ramps) have no held targets, so they only
+# get the error numbers.
+#
+# Everything is done with array operations on a chunk of records at a time, and
+# a TrackingMetrics carries what it needs from one chunk to the next, so a
+# capture of any length can be fed through in pieces. The running totals can be
+# read out at any point.
+#
+#   m = TrackingMetrics(fault_threshold)
+#   for recs in chunks : moves = m.add(recs)    # the moves completed in this chunk
+#   print(report(m.result()))
+#
+# or just captureMetrics(fname) for a .cap/.bin/.csv file, or run this file on
+# some: metrics.py capture...
+#
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+########################################################
+
+import sys, os, time
+import numpy as np
+
+import histdata
+import capfile
+
+
+FAULT_THRESHOLD = 10.0      # tics; machine.xml's default "Fault Threshold (tics)"
+FAULT_PARAM = 'kt'          # ...and its command
+SETTLE_BAND = 2.0           # tics either side of the target that count as settled
+MIN_HOLD = 10               # records a target has to be held for to count as a move
+MIN_STEP = 1.0              # tics; smaller moves than this are just holding still
+
+# one row per completed move
+MOVE_DTYPE = np.dtype([('start', 'f8'),         # s, when the target changed
+                       ('target', 'f8'),        # tics
+                       ('step', 'f8'),          # tics, from where the position was
+                       ('overshoot', 'f8'),     # tics past the target (0 if none)
+                       ('settling', 'f8'),      # s (nan if it didn't settle)
+                       ('records', 'i8')])      # records the target was held for
+
+
+class TrackingMetrics :
+
+    def __init__(self, fault_threshold=FAULT_THRESHOLD, settle_band=SETTLE_BAND,
+                 min_hold=MIN_HOLD, min_step=MIN_STEP) :
+        self.fault_threshold = fault_threshold
+        self.settle_band = settle_band
+        self.min_hold = min_hold
+        self.min_step = min_step
+        self.n = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.maxabs = 0.0
+        self.faults = 0
+        self.t0 = None
+        self.t1 = None
+        self.moves = []             # MOVE_DTYPE arrays, a chunk's worth each
+        self.seg = None             # the target segment still going at the end of the last chunk:
+                                    # [target, start t, start position, records, max over, last t out of band (or -inf), last t]
+
+    # Adds a chunk of HIST_DTYPE records (anything with the time, position and
+    # target_pos channels). Returns the moves finished by this chunk.
+    def add(self, recs) :
+        return self.addArrays(recs['time'] * histdata.HIST_TICK, recs['position'], recs['target_pos'])
+
+    # the same, from times (s), positions and targets (tics)
+    def addArrays(self, ts, ps, targets) :
+        n = len(ts)
+        if n == 0 :
+            return np.zeros(0, MOVE_DTYPE)
+        ts = np.asarray(ts, np.float64)
+        ps = np.asarray(ps, np.float64)
+        targets = np.asarray(targets, np.float64)
+        err = targets - ps
+        abserr = np.abs(err)
+        self.n += n
+        self.sum += err.sum()
+        self.sumsq += np.dot(err, err)
+        self.maxabs = max(self.maxabs, abserr.max())
+        self.faults += np.count_nonzero(abserr > self.fault_threshold)
+        if self.t0 == None :
+            self.t0 = ts[0]
+        self.t1 = ts[-1]
+
+        # split the chunk where the target changes
+        change = np.empty(n, bool)
+        change[0] = self.seg == None or targets[0] != self.seg[0]
+        change[1:] = targets[1:] != targets[:-1]
+        starts = np.flatnonzero(change)
+        if len(starts) == 0 or starts[0] != 0 :
+            starts = np.concatenate(([0], starts))      # (the first part continues self.seg)
+        lens = np.diff(np.append(starts, n))
+        tgt = targets[starts]
+        p0 = ps[starts]
+        if not change[0] :
+            p0[0] = self.seg[2]
+        direction = np.sign(tgt - p0)[np.repeat(np.arange(len(starts)), lens)]
+        over = np.maximum.reduceat((ps - targets) * direction, starts)
+        # time of the last record outside the band in each part (or -inf)
+        tout = np.maximum.reduceat(np.where(abserr > self.settle_band, ts, -np.inf), starts)
+        tlast = ts[np.append(starts[1:], n) - 1]
+
+        # the first part may carry on from the last chunk
+        segs = [tgt, ts[starts], p0, lens.astype(np.int64), over, tout, tlast]
+        if not change[0] :
+            prev = self.seg
+            segs[1][0] = prev[1]
+            segs[3][0] += prev[3]
+            segs[4][0] = max(over[0], prev[4])
+            segs[5][0] = max(tout[0], prev[5])
+        elif self.seg != None :
+            # the carried segment ended right at the chunk boundary
+            segs = [np.concatenate(([self.seg[i]], segs[i])) for i in range(0, 7)]
+
+        # the last part stays open; the rest are finished
+        self.seg = [s[-1] for s in segs]
+        done = [s[:-1] for s in segs]
+        moves = self._moves(*done)
+        if len(moves) > 0 :
+            self.moves.append(moves)
+        return moves
+
+    # MOVE_DTYPE rows for the finished segments that count as moves
+    def _moves(self, tgt, tstart, p0, count, over, tout, tlast) :
+        step = tgt - p0
+        keep = (count >= self.min_hold) & (np.abs(step) >= self.min_step)
+        moves = np.zeros(np.count_nonzero(keep), MOVE_DTYPE)
+        moves['start'] = tstart[keep]
+        moves['target'] = tgt[keep]
+        moves['step'] = step[keep]
+        moves['overshoot'] = np.maximum(over[keep], 0.0)
+        moves['records'] = count[keep]
+        # settled once the error's in the band for good; not if it's out at the end
+        tout, tlast, tstart = tout[keep], tlast[keep], tstart[keep]
+        settling = np.where(np.isinf(tout), 0.0, tout - tstart)
+        moves['settling'] = np.where(tout >= tlast, np.nan, settling)
+        return moves
+
+    # every move so far, including the one still going at the end of the data
+    def allMoves(self) :
+        moves = list(self.moves)
+        if self.seg != None :
+            moves.append(self._moves(*[np.array([v]) for v in self.seg]))
+        if len(moves) == 0 :
+            return np.zeros(0, MOVE_DTYPE)
+        return np.concatenate(moves)
+
+    # the numbers so far, as a dict (see report)
+    def result(self) :
+        moves = self.allMoves()
+        settled = moves['settling'][~np.isnan(moves['settling'])]
+        big = np.abs(moves['step']) > 0
+        pct = 100.0 * moves['overshoot'][big] / np.abs(moves['step'][big])
+        n = max(self.n, 1)
+        return {'records' : self.n,
+                'duration' : (self.t1 - self.t0) if self.n > 0 else 0.0,
+                'err_mean' : self.sum / n,
+                'err_rms' : np.sqrt(self.sumsq / n),
+                'err_max' : self.maxabs,
+                'fault_threshold' : self.fault_threshold,
+                'fault_fraction' : self.faults / float(n),
+                'moves' : len(moves),
+                'unsettled' : len(moves) - len(settled),
+                'overshoot_max' : moves['overshoot'].max() if len(moves) > 0 else 0.0,
+                'overshoot_pct_max' : pct.max() if len(pct) > 0 else 0.0,
+                'settling_mean' : settled.mean() if len(settled) > 0 else float('nan'),
+                'settling_max' : settled.max() if len(settled) > 0 else float('nan')}
+
+
+# metrics for one array of records
+def trackingMetrics(recs, fault_threshold=FAULT_THRESHOLD, **kwargs) :
+    m = TrackingMetrics(fault_threshold, **kwargs)
+    m.add(recs)
+    return m.result()
+
+
+# The fault threshold in a machine xml (as saved with captures), or the default.
+def faultThreshold(machine_xml) :
+    import catalog
+    for cmd, name, value in catalog.machineParams(machine_xml or '') :
+        if cmd == FAULT_PARAM :
+            try :
+                return float(value)
+            except ValueError :
+                break
+    return FAULT_THRESHOLD
+
+
+# Yields the records of a capture file (.cap, .bin or history .csv) a chunk at a time.
+def iterChunks(fname) :
+    ext = os.path.splitext(fname)[1].lower()
+    if ext == '.bin' :
+        for recs in histdata.iterRawRecords(fname) :
+            yield recs
+    elif ext == capfile.CAPTURE_EXT :
+        cap = capfile.CaptureFile(fname)
+        try :
+            for start in range(0, len(cap), capfile.CHUNK_RECORDS) :
+                yield cap.records(start, start + capfile.CHUNK_RECORDS)
+        finally :
+            cap.close()
+    else :
+        yield histdata.loadCsv(fname)
+
+
+# Metrics for a capture file, worked through a chunk at a time. The fault
+# threshold comes from the capture's own machine snapshot (.cap files) unless
+# it's given. progress(m), if given, is called after each chunk.
+def captureMetrics(fname, fault_threshold=None, progress=None, **kwargs) :
+    if fault_threshold == None :
+        fault_threshold = FAULT_THRESHOLD
+        if fname.lower().endswith(capfile.CAPTURE_EXT) :
+            cap = capfile.CaptureFile(fname)
+            fault_threshold = faultThreshold(cap.machine)
+            cap.close()
+    m = TrackingMetrics(fault_threshold, **kwargs)
+    for recs in iterChunks(fname) :
+        m.add(recs)
+        if progress != None :
+            progress(m)
+    return m.result()
+
+
+def report(r) :
+    lines = ["%i records over %.2f s" % (r['records'], r['duration']),
+             "Tracking error: %.3f mean, %.3f RMS, %.3f max (tics)" % (r['err_mean'], r['err_rms'], r['err_max']),
+             "Over fault threshold (%g tics): %.3f%% of records" % (r['fault_threshold'], 100.0 * r['fault_fraction'])]
+    if r['moves'] > 0 :
+        lines.append("%i moves: overshoot up to %.2f tics (%.1f%%); settling %.4f s mean, %.4f s max; %i didn't settle" % (
+                     r['moves'], r['overshoot_max'], r['overshoot_pct_max'], r['settling_mean'], r['settling_max'],
+                     r['unsettled']))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__" :
+    if len(sys.argv) < 2 :
+        print("usage: metrics.py capture...")
+        sys.exit(1)
+    for fname in sys.argv[1:] :
+        start = time.time()
+        r = captureMetrics(fname)
+        print("%s (%.2f s):\n%s\n" % (fname, time.time() - start, report(r)))
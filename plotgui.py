@@ -46,10 +46,22 @@ from matplotlib.backends.backend_qt4agg import (
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
+from decimate import DecimatedLine
+
+
+RESCALE_ROOM = 0.2      # fraction of the data's span added when live data outgrows the axes
+RESCALE_SHRINK = 0.5    # live axes are tightened when the data covers less than this much of them
+
 
 class PlotWindow(QMainWindow):
     def __init__(self, parent=None):
         QMainWindow.__init__(self, parent)
+        self.axes = None
+        self.lines = []     # DecimatedLines on the current plot
+        self.used = []      # ...and those plotted since the last init_plot
+        self.live = False   # lines are being updated continuously (blitted)
+        self.live_span = None   # ...showing this much of x, if set
+        self.background = None
         #self.x, self.y = self.get_data()
         self.create_main_frame()
         #self.init_plot()
@@ -66,6 +78,7 @@ class PlotWindow(QMainWindow):
         self.mpl_toolbar = NavigationToolbar(self.canvas, self.main_frame)
 
         self.canvas.mpl_connect('key_press_event', self.on_key_press)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
 
         vbox = QVBoxLayout()
         vbox.addWidget(self.canvas)  # the matplotlib canvas
@@ -74,15 +87,108 @@ class PlotWindow(QMainWindow):
         self.setCentralWidget(self.main_frame)
 
     # returns an axes object, from which we can call "plot" and all the normal figure stuff.
+    # The axes (and lines, see plot) are kept from one plot to the next rather
+    # than being rebuilt.
     def init_plot(self):
-        self.fig.clear()
-        self.axes = self.fig.add_subplot(111)
+        if self.axes is None :
+            self.axes = self.fig.add_subplot(111)
+        self.used = []
         
         return self.axes
+    
+    # like axes.plot(x, y, ...), but draws a min/max decimated version of the
+    # data that's redone on zoom/pan, so huge datasets stay responsive. If the
+    # last plot had a line with the same label, that line is given the new data
+    # instead of making another.
+    def plot(self, x, y, *args, **kwargs) :
+        label = kwargs.get('label')
+        for line in self.lines :
+            if label != None and line.line.get_label() == label and not line in self.used :
+                line.setData(x, y)
+                break
+        else :
+            line = DecimatedLine(self.axes, x, y, *args, **kwargs)
+            line.line.set_animated(self.live)
+            self.lines.append(line)     # (matplotlib only keeps a weak reference)
+        self.used.append(line)
+        return line
         
-    # renders the plot to the screen.
+    # renders the plot to the screen. Lines from the last plot that weren't
+    # plotted again since init_plot are removed.
     def render_plot(self) :
+        stale = [line for line in self.lines if not line in self.used]
+        for line in stale :
+            line.disconnect()
+            line.line.remove()
+        self.lines = list(self.used)
+        if len(stale) > 0 and self.axes.legend_ is not None :
+            # the legend was made before the old lines came off
+            self.axes.legend(loc=self.axes.legend_._loc)
+        self.canvas.draw()
+    
+    # In live mode the lines are animated: the rest of the figure is drawn once
+    # and kept as a bitmap, and update_plot just blits the lines over it. If
+    # span (in x units) is given, the x axis follows the last span of the data.
+    def set_live(self, live, span=None) :
+        self.live = live
+        self.live_span = span
+        self.background = None
+        for line in self.lines :
+            line.line.set_animated(live)
         self.canvas.draw()
+    
+    # redraws after the lines' data has changed. The axes are only rescaled (and
+    # the whole figure redrawn) when the data has gone outside them.
+    def update_plot(self) :
+        if self.rescale() or not self.live or self.background is None :
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_lines()
+        self.canvas.blit(self.axes.bbox)
+    
+    # Fits the axes limits to the lines' data, with some room so a changing
+    # trace doesn't need it every frame. Returns True if the limits changed.
+    # A limit is only moved when the data goes outside it, or (in live mode)
+    # when the data has shrunk to less than RESCALE_SHRINK of the range; and in
+    # live mode with a span, x is [last x - span, last x + room], moved on
+    # whenever the data reaches the right-hand edge.
+    def rescale(self) :
+        changed = False
+        for axis, get_lim, set_lim in (('x', self.axes.get_xlim, self.axes.set_xlim),
+                                       ('y', self.axes.get_ylim, self.axes.set_ylim)) :
+            vals = [line.line.get_xdata() if axis == 'x' else line.line.get_ydata() for line in self.lines]
+            vals = [v for v in vals if len(v) > 0]
+            if len(vals) == 0 :
+                continue
+            lo = min([np.min(v) for v in vals])
+            hi = max([np.max(v) for v in vals])
+            lim0, lim1 = get_lim()
+            if axis == 'x' and self.live and self.live_span != None :
+                room = RESCALE_ROOM * self.live_span
+                if hi > lim1 or hi < lim1 - 2 * room :
+                    set_lim(hi - self.live_span, hi + room)
+                    changed = True
+                continue
+            room = RESCALE_ROOM * max(hi - lo, 1e-9)
+            if lo < lim0 or hi > lim1 :
+                set_lim(min(lim0, lo - room) if lo < lim0 else lim0,
+                        max(lim1, hi + room) if hi > lim1 else lim1)
+                changed = True
+            elif self.live and (hi - lo) < RESCALE_SHRINK * (lim1 - lim0) :
+                set_lim(lo - room, hi + room)
+                changed = True
+        return changed
+    
+    def draw_lines(self) :
+        for line in self.lines :
+            self.axes.draw_artist(line.line)
+    
+    # after every full draw in live mode, keep the background and put the lines on it
+    def on_draw(self, event) :
+        if self.live and self.axes is not None :
+            self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+            self.draw_lines()
 
     def on_key_press(self, event):
         print('you pressed', event.key)
@@ -0,0 +1,183 @@
+########################################################
+# Control Design GUI: postproc.py
+# Packs finished stream captures in the background.
+#
+# Ben Weiss, University of Washington
+# Summer 2014
+#
+# When streaming stops, the raw .bin has to be packed into a .cap (and maybe
+# converted to csv) before it's plotted. For a long capture that takes a while,
+# so a StreamJob does it on a worker thread while the GUI -- and the comm thread
+# -- carry on. The heavy lifting (numpy, zlib, file I/O) releases the GIL, so the
+# rest of the program barely notices. The GUI polls the job for progress, can
+# cancel it, and when it's done maps the result: a copy of the records in a
+# temporary .npy file, so plotting doesn't have to decode the whole capture
+# again. The .cap is what's kept; the GUI discard()s the result once it's
+# plotted.
+#
+# The .bin is only removed once the .cap has been opened again and found to hold
+# every record in it; otherwise it's kept. A cancelled job leaves the .bin where
+# it was and removes anything half-written.
+#
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+########################################################
+
+import os, threading, traceback, tempfile, atexit
+import numpy as np
+import histdata
+import capfile
+
+
+# job states
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+
+class JobCancelled(Exception) :
+    pass
+
+
+# result files that couldn't be removed yet (still mapped, on Windows)
+_leftovers = []
+
+# removes a file, or puts it on _leftovers if that can't be done yet
+def _remove(fname) :
+    if fname == None or not os.path.exists(fname) :
+        return
+    try :
+        os.remove(fname)
+    except OSError :
+        _leftovers.append(fname)
+
+def _removeLeftovers() :
+    for fname in list(_leftovers) :
+        _leftovers.remove(fname)
+        _remove(fname)
+
+atexit.register(_removeLeftovers)
+
+
+# Packs binfname into capfname (plus csvfname, if given) on a worker thread.
+# Everything the GUI reads (state, done, total, error) is set by the worker and
+# only read elsewhere, so no locking is needed.
+class StreamJob :
+
+    def __init__(self, binfname, capfname, machine='', info=None, csvfname=None) :
+        self.binfname = binfname
+        self.capfname = capfname
+        self.csvfname = csvfname
+        self.resultfname = None     # the temporary result file, once there is one
+        self.machine = machine
+        self.info = info
+        self.state = JOB_RUNNING
+        self.done = 0           # records processed so far...
+        self.total = os.path.getsize(binfname) // histdata.HIST_DTYPE.itemsize    # ...out of this many
+        self.error = None
+        self.kept = False       # the .bin was kept, as the .cap didn't check out
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='StreamJob ' + os.path.basename(binfname))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def cancel(self) :
+        self.cancelled.set()
+
+    def running(self) :
+        return self.state == JOB_RUNNING
+
+    # fraction done, 0..1
+    def progress(self) :
+        return self.done / float(max(self.total, 1))
+
+    # waits up to timeout seconds (forever if None); returns True if the job has finished
+    def wait(self, timeout=None) :
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    # the records, mapped from the result file (only once the job is done)
+    def result(self) :
+        if self.state != JOB_DONE :
+            raise RuntimeError("stream job is %s" % self.state)
+        return np.load(self.resultfname, mmap_mode='r')
+    
+    # removes the result file; call once the records from result() are plotted
+    def discard(self) :
+        _removeLeftovers()      # (anything from earlier jobs that's free by now)
+        _remove(self.resultfname)
+        self.resultfname = None
+
+    def run(self) :
+        fcsv = None
+        try :
+            fd, self.resultfname = tempfile.mkstemp(histdata.SIDECAR_EXT, 'stream-')
+            os.close(fd)
+            out = np.lib.format.open_memmap(self.resultfname, 'w+', histdata.HIST_DTYPE, (self.total,))
+            w = capfile.CaptureWriter(self.capfname, self.machine, self.info)
+            try :
+                if self.csvfname != None :
+                    fcsv = open(self.csvfname, "w")
+                    fcsv.write(histdata.STREAM_CSV_HEADER)
+                for recs in histdata.iterRawRecords(self.binfname) :
+                    if self.cancelled.is_set() :
+                        raise JobCancelled()
+                    if self.done + len(recs) > self.total :
+                        break       # (the file grew; it shouldn't have)
+                    w.append(recs)
+                    out[self.done:self.done + len(recs)] = recs
+                    if fcsv != None :
+                        histdata.writeCsv([recs], fcsv)
+                    self.done += len(recs)
+            finally :
+                w.close()
+                if fcsv != None :
+                    fcsv.close()
+            out.flush()
+            del out
+            if capfile.packedComplete(self.capfname, self.binfname) :
+                os.remove(self.binfname)
+            else :
+                self.kept = True
+            self.state = JOB_DONE
+        except JobCancelled :
+            self._cleanUp()
+            self.state = JOB_CANCELLED
+        except Exception as e :
+            traceback.print_exc()
+            self._cleanUp()
+            self.error = e
+            self.state = JOB_FAILED
+
+    # removes whatever was written, leaving just the .bin
+    def _cleanUp(self) :
+        for fname in (self.capfname, self.csvfname) :
+            if fname != None and os.path.exists(fname) :
+                try :
+                    os.remove(fname)
+                except OSError :
+                    pass        # still open somewhere (Windows); not worth failing over
+        _remove(self.resultfname)
+        self.resultfname = None
+
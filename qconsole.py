@@ -0,0 +1,47 @@
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from PyQt4 import QtCore, QtGui
+
+CONSOLE_MAX_LINES = 5000    # scrollback kept in the console
+
+# Read-only text console with bounded scrollback. Text is appended in whole
+# chunks (not necessarily ending on a line boundary), so callers can batch up
+# everything that arrived since the last frame into one append.
+class QConsole(QtGui.QPlainTextEdit):
+    def __init__(self, parent=None) :
+        QtGui.QPlainTextEdit.__init__(self, parent)
+        self.setReadOnly(True)
+        self.setMaximumBlockCount(CONSOLE_MAX_LINES)
+        self.setLineWrapMode(QtGui.QPlainTextEdit.NoWrap)
+        font = QtGui.QFont("Courier")
+        font.setStyleHint(QtGui.QFont.TypeWriter)
+        self.setFont(font)
+
+    def appendText(self, txt) :
+        bar = self.verticalScrollBar()
+        follow = bar.value() == bar.maximum()     # only scroll along if we're at the bottom already
+        cursor = QtGui.QTextCursor(self.document())
+        cursor.movePosition(QtGui.QTextCursor.End)
+        cursor.insertText(txt)
+        if follow :
+            bar.setValue(bar.maximum())
@@ -0,0 +1,126 @@
+########################################################
+# Control Design GUI: ringbuffer.py
+# Fixed-size byte ring buffer with an incremental newline index, used by the
+# comm modules to frame the device's text stream into lines.
+#
+# Ben Weiss, University of Washington
+# Summer 2014
+#
+# Incoming text is copied once into a preallocated bytearray. Newlines are
+# located as each chunk arrives (only the new bytes are scanned), so handing
+# out a line only copies that line -- never the rest of the buffer. If the
+# reader falls behind, the oldest bytes are discarded and counted rather than
+# letting the buffer grow without bound.
+#
+# The MIT License (MIT)
+# 
+# Copyright (c) 2014 Ben Weiss
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+########################################################
+
+import collections
+
+
+class LineBuffer :
+
+    def __init__(self, size=1 << 20) :
+        self.size = size
+        self.data = bytearray(size)
+        self.head = 0           # absolute offset of the oldest unread byte
+        self.tail = 0           # absolute offset one past the newest byte
+        self.newlines = collections.deque()     # absolute offsets of unread '\n's
+        self.dropped = 0        # bytes discarded because the buffer was full
+        self.overflows = 0      # number of times that happened
+
+    def __len__(self) :
+        return self.tail - self.head
+
+    # Adds data (a str or bytearray) to the end of the buffer. If there isn't room,
+    # the oldest unread data is discarded to make space.
+    def Append(self, data) :
+        n = len(data)
+        if n == 0 :
+            return
+        src = memoryview(data)
+        if n > self.size :
+            # only the newest <size> bytes can possibly fit.
+            skip = n - self.size
+            self._drop(len(self) + skip)
+            self.Clear()
+            self.head = self.tail = self.tail + skip
+            src = src[skip:]
+            data = data[skip:]
+            n = self.size
+        elif len(self) + n > self.size :
+            self._drop(len(self) + n - self.size)
+            self.head += len(self) + n - self.size
+            while len(self.newlines) > 0 and self.newlines[0] < self.head :
+                self.newlines.popleft()
+
+        # copy into the ring, in two pieces if it wraps around the end.
+        pos = self.tail % self.size
+        first = min(n, self.size - pos)
+        self.data[pos:pos + first] = src[:first]
+        if first < n :
+            self.data[0:n - first] = src[first:]
+
+        # index the new newlines
+        i = data.find('\n')
+        while i >= 0 :
+            self.newlines.append(self.tail + i)
+            i = data.find('\n', i + 1)
+        self.tail += n
+
+    # Returns True if there is at least one complete line waiting.
+    def HasLine(self) :
+        return len(self.newlines) > 0
+
+    # Returns the next complete line without its trailing newline, or None if
+    # there isn't one yet.
+    def ReadLn(self) :
+        if len(self.newlines) == 0 :
+            return None
+        nl = self.newlines.popleft()
+        txt = self._get(self.head, nl)
+        self.head = nl + 1
+        return txt
+
+    # Returns everything in the buffer (complete lines or not) and empties it.
+    def Read(self) :
+        txt = self._get(self.head, self.tail)
+        self.Clear()
+        return txt
+
+    def Clear(self) :
+        self.head = self.tail
+        self.newlines.clear()
+
+    # copies out the bytes between absolute offsets start and end as a str.
+    def _get(self, start, end) :
+        a = start % self.size
+        n = end - start
+        if a + n <= self.size :
+            return str(self.data[a:a + n])
+        return str(self.data[a:]) + str(self.data[:a + n - self.size])
+
+    def _drop(self, n) :
+        self.dropped += n
+        self.overflows += 1
@@ -46,9 +46,15 @@ import struct
 import sip
 from PyQt4 import QtCore, QtGui
 import sys
+import os
 import re
 import datetime
 import machineInterface as mach
+import histdata
+import capfile
+import decimate
+import postproc
+import metrics
 
 
 import plotgui
@@ -68,6 +74,11 @@ histStruct = struct.Struct("=LlfffflB")
 ##} hist_data_t;
 
 DS_STREAM_HIST = 0           # data stream used for history downloading
+STREAM_CSV = False           # also convert each stream capture to .csv when it's stopped
+STREAM_FRAME_MS = 100        # how often the live plot picks up new data while streaming
+LIVE_SECONDS = 30.0          # the live plot shows this many seconds of the most recent data
+LIVE_MAX_RATE = 10000        # records/s the live plot's (fixed size) buffer is sized for
+JOB_POLL_MS = 200            # how often background work (packing a capture, a history download) is checked
 
 
 
@@ -110,17 +121,7 @@ def convertBinaryDump(fname_in, fname_out) :
     """Converts a RawHID binary file dump into csv format. This is NOT the
     same as converting a binary dump from the old over-serial ADS stream because
     it does not use separator characters."""
-    with open(fname_in, "rb") as fin, open(fname_out, "w") as fout :
-        # print out the header
-        fout.write("Time (*10us), Position (tics), Position Error Derivative (tics), Cmd Vel (tics/min), Target Pos (tics), Target Vel (tics), Motor Position (tics), Flags\n")
-        while True :
-            chunk = fin.read(histStruct.size)
-            if len(chunk) < histStruct.size :
-                break
-            else :
-                # parse out a hist struct
-                d = histStruct.unpack(chunk)
-                fout.write("%f, %i, %f, %f, %f, %f, %i, %i\n" % d)
+    return histdata.convertRawDump(fname_in, fname_out)
 
 # Plotting Class - plots single plots and data streams.
 # The next few script functions implement streaming data plotting, using the 
@@ -131,12 +132,15 @@ class Plotter :
     
     # Storage class for keeping track of line traces
     class Trace :
-        def __init__(self, fig, x, y, color, legend) :
+        def __init__(self, figwindow, x, y, color, legend, ychan=None) :
             self.x = x
             self.y = y
-            self.line2d = fig.plot(self.x, self.y, color, label=legend)
+            self.ychan = ychan      # Plotter attribute y comes from, for live updates
+            self.dline = figwindow.plot(self.x, self.y, color, label=legend)
+            self.line2d = [self.dline.line]
         def update(self) :
-            self.line2d[0].set_data(self.x, self.y)
+            # (PlotWindow.update_plot rescales the axes if need be)
+            self.dline.setData(self.x, self.y, False)
     
     def __init__(self) :
         self.ts = []
@@ -147,95 +151,151 @@ class Plotter :
         self.target_vs = []
         self.motor_ps = []
         self.stream_fname = ''
+        self.download = None        # Future for the history download in progress
+        self.download_start = 0
+        self.download_got = (0, 0)  # (bytes so far, of this many), set by the comm thread
+        self.download_shown = 0
+        self.downloadTimer = None
         
         # Figure windows (plotgui:FigureWindow objects)
         self.figwindows = []
+        self.traces = []
         
         self.streaming = False
+        self.tail = None            # histdata.TailReader following the stream capture
+        self.live = None            # histdata.HistRing of the latest records (made when first needed)
+        self.liveTimer = None
+        self.jobs = []              # postproc.StreamJobs packing finished captures
+        self.jobTimer = None
+        self.job_shown = 0
+        self.metrics = None         # metrics.TrackingMetrics.result() for the data last read
     
     def readCtrlHistory(self) :
-        """read back the control history and plot with matplotlib"""
-        # read back the history
-        comm.Write("gd")         # read back command
-        buf = ''
-        total = 0
-        time.sleep(0.1)
-        for i in range(0,100) :
-            buf += comm.ReadBlocking(50)
-            if len(buf) > 10 and total == 0:
-                #try :
-                print("Getting " + buf.splitlines()[0] + " datapoints")
-                total = int(buf.splitlines()[0])
-                buf = buf[len(buf.splitlines()[0])+1:]    # get rid of the first line
-                #except ValueError :
-                #    total = 10000   # go until we're sure we're done...
-            if 0 < total and len(buf) >= total * histStruct.size :# and comm.serobj.inWaiting() == 0 :
-                break
-            time.sleep(0.03)
-            print '.',
-        else :
-            print("Wanted %i bytes; got %i. Failing!" %(total * histStruct.size, len(buf)))
+        """read back the control history and plot with matplotlib. The download
+        happens on the comm thread; checkDownload shows it when it's done."""
+        # read back the history. The records come straight into one buffer.
+        self.download_shown = -1
+        self.download_got = (0, 0)
+        self.download_start = time.time()
+        self.download = comm.Download("gd", histdata.HIST_DTYPE.itemsize, self.downloadProgress)
+        if self.downloadTimer == None :
+            self.downloadTimer = QtCore.QTimer()
+            self.downloadTimer.timeout.connect(self.checkDownload)
+            self.downloadTimer.start(JOB_POLL_MS)
+
+    # (called on the comm thread) notes how far the history download has got
+    def downloadProgress(self, got, total, secs) :
+        self.download_got = (got, total)
+
+    # shows progress of the history download, and the history once it's all here
+    def checkDownload(self) :
+        got, total = self.download_got
+        if total > 0 :
+            if self.download_shown < 0 :
+                print("Getting %i datapoints" % (total / histdata.HIST_DTYPE.itemsize))
+                self.download_shown = 0
+            while self.download_shown < 10 * got / total :
+                print '.',
+                self.download_shown += 1
+        if self.download == None or not self.download.Done() :
+            return
+        f = self.download
+        self.download = None
+        self.downloadTimer.stop()
+        self.downloadTimer = None
+        try :
+            count, buf = f.Result(0)
+        except (CommTimeout, IOError) as e :
+            print("History download failed: " + str(e))
             return
-        print len(buf) / histStruct.size, "datapoints read."
+        secs = max(time.time() - self.download_start, 1e-6)
+        print("\n%i datapoints read in %.2f s (%.1f kB/s)." % (count, secs, len(buf) / secs / 1000.0))
+        self.showHistory(np.frombuffer(buf, histdata.HIST_DTYPE))
+
+    def showHistory(self, recs) :
+        """saves and plots a downloaded control history"""
     
-        # parse out the structures
-        self.ts = []
-        self.ps = []
-        self.vs = []
-        self.pos_error_derivs = []
-        self.cmd_vs = []
-        self.target_ps = []
-        self.target_vs = []
-        self.motor_ps = []
+        # save and unpack the records
         stamp = timeStamped("")
         with open("dumps/" + stamp + 'ctrlHistory.csv', "w") as fout :
-            fout.write("Time(s*1e5), Position (tics), Velocity (tics/min), Command Velocity (tics/min), Target Position (tics), Target Velocity (tics/min), Motor Position (tics)\n")
-            for i in range(0, total * histStruct.size, histStruct.size) :
-                d = histStruct.unpack_from(buf, i)
-                fout.write("%f, %i, %f, %f, %f, %f, %i\n" % d)
-                self.ts.append(d[0] * 0.00001)
-                self.ps.append(d[1])
-                #vs.append(d[2])
-                self.pos_error_derivs.append(d[2])
-                self.cmd_vs.append(d[3])
-                self.target_ps.append(d[4])
-                self.target_vs.append(d[5])
-                self.motor_ps.append(d[6])
+            fout.write(histdata.HISTORY_CSV_HEADER)
+            histdata.writeCsv([recs], fout, histdata.HISTORY_CSV_FORMAT)
+        self.ts = recs['time'] * histdata.HIST_TICK
+        self.ps = recs['position']
+        self.vs = []
+        self.pos_error_derivs = recs['pos_error_deriv']
+        self.cmd_vs = recs['cmd_velocity']
+        self.target_ps = recs['target_pos']
+        self.target_vs = recs['target_vel']
+        self.motor_ps = recs['motor_position']
         
         self.plotData()
+        self.showMetrics()
         
         # also save off a copy of the machine at this time (so we know what was going on later)
         mach.machine.save("dumps/" + stamp + 'machine.xml')
 
     def readHistFromFile(self, csvfname) :
         # read back the history from file
-        self.ts = []
-        self.ps = []
+        recs = histdata.loadCsv(csvfname)
+        self.ts = recs['time'] * histdata.HIST_TICK
+        self.ps = recs['position']
+        self.pos_error_derivs = recs['pos_error_deriv']
+        self.cmd_vs = recs['cmd_velocity']
+        self.target_ps = recs['target_pos']
+        self.target_vs = recs['target_vel']
+        self.motor_ps = recs['motor_position']
         self.vs = []
-        self.pos_error_derivs = []
-        self.cmd_vs = []
-        self.target_ps = []
-        self.target_vs = []
-        self.motor_ps = []
         
-        with open(csvfname, "r") as fin :
-            fin.readline()      # read header line
-            for line in fin :
-                r = re.compile("[ \t\n\r,]+")
-                d = r.split(line)
-                if len(d) < 7 :
-                    break       # we're done with the file
-                self.ts.append(float(d[0]) * 0.00001)
-                self.ps.append(int(d[1]))
-                #vs.append(d[2])
-                self.pos_error_derivs.append(float(d[2]))
-                self.cmd_vs.append(float(d[3]))
-                self.target_ps.append(float(d[4]))
-                self.target_vs.append(float(d[5]))
-                self.motor_ps.append(float(d[6]))
+        self.plotData()
+        self.showMetrics()
+
+    def readHistFromCapture(self, fname) :
+        """Shows a stream capture (.cap, or a raw .bin) directly, without converting it to csv first."""
+        cap = capfile.openCapture(fname)
+        self.ts = cap.seconds()
+        self.ps = cap['position']
+        self.vs = []
+        self.pos_error_derivs = cap['pos_error_deriv']
+        self.cmd_vs = cap['cmd_velocity']
+        self.target_ps = cap['target_pos']
+        self.target_vs = cap['target_vel']
+        self.motor_ps = cap['motor_position']
+        
+        self.plotData()
+        self.showMetrics()
+                
+    def readHistFromRecords(self, recs) :
+        """Shows an array of histdata.HIST_DTYPE records."""
+        self.ts = recs['time'] * histdata.HIST_TICK
+        self.ps = recs['position']
+        self.vs = []
+        self.pos_error_derivs = recs['pos_error_deriv']
+        self.cmd_vs = recs['cmd_velocity']
+        self.target_ps = recs['target_pos']
+        self.target_vs = recs['target_vel']
+        self.motor_ps = recs['motor_position']
         
         self.plotData()
+        self.showMetrics()
                 
+    def showMetrics(self) :
+        """Shows tracking performance numbers (see metrics.py) for the data last
+        read in the console; they're also kept in self.metrics."""
+        threshold = metrics.FAULT_THRESHOLD
+        param = mach.machine.params.byCmd(metrics.FAULT_PARAM) if mach.machine != None else None
+        if param != None :
+            try :
+                threshold = float(param.value)
+            except (TypeError, ValueError) :
+                pass
+        m = metrics.TrackingMetrics(threshold)
+        for i in range(0, len(self.ts), histdata.CHUNK_RECORDS) :
+            j = i + histdata.CHUNK_RECORDS
+            m.addArrays(self.ts[i:j], self.ps[i:j], self.target_ps[i:j])
+        self.metrics = m.result()
+        comm.Echo(metrics.report(self.metrics))
+    
     def plotData(self) :
         """Plots the data generated using readCtrlHistory and/or streaming and stored in the class's data arrays"""
         
@@ -253,9 +313,9 @@ class Plotter :
         self.traces = []
         
         fig = self.figwindows[0].init_plot()
-        self.traces.append(self.Trace(fig, self.ts, self.ps, 'b-','Position'))
+        self.traces.append(self.Trace(self.figwindows[0], self.ts, self.ps, 'b-','Position', 'ps'))
         fig.hold(True)
-        self.traces.append(self.Trace(fig, self.ts, self.target_ps, 'r--','Target Position'))
+        self.traces.append(self.Trace(self.figwindows[0], self.ts, self.target_ps, 'r--','Target Position', 'target_ps'))
         fig.legend(loc=2)
         fig.xaxis.label.set_text('Time (s)')
         fig.yaxis.label.set_text('Position (encoder tics)')
@@ -269,8 +329,8 @@ class Plotter :
         fig = self.figwindows[1].init_plot()
         #fig.plot(ts, vs, 'c-', label='Velocity')
         fig.hold(True)
-        self.traces.append(self.Trace(fig, self.ts, self.target_vs, 'r--','Target Velocity'))
-        self.traces.append(self.Trace(fig, self.ts, self.cmd_vs, 'g-', 'Command Velocity'))
+        self.traces.append(self.Trace(self.figwindows[1], self.ts, self.target_vs, 'r--','Target Velocity', 'target_vs'))
+        self.traces.append(self.Trace(self.figwindows[1], self.ts, self.cmd_vs, 'g-', 'Command Velocity', 'cmd_vs'))
         fig.legend(loc=2)
         fig.xaxis.label.set_text('Time (s)')
         fig.yaxis.label.set_text('Velocity (encoder tics/min)')
@@ -280,9 +340,9 @@ class Plotter :
         self.figwindows[1].show()
         
         fig = self.figwindows[2].init_plot()
-        self.traces.append(self.Trace(fig, self.ts, self.ps, 'b-', 'Encoder Position'))
+        self.traces.append(self.Trace(self.figwindows[2], self.ts, self.ps, 'b-', 'Encoder Position', 'ps'))
         fig.hold(True)
-        self.traces.append(self.Trace(fig, self.ts, self.motor_ps, 'g-', 'Motor Step Position'))
+        self.traces.append(self.Trace(self.figwindows[2], self.ts, self.motor_ps, 'g-', 'Motor Step Position', 'motor_ps'))
         fig.legend(loc=2)
         fig.xaxis.label.set_text('Time (s)')
         fig.yaxis.label.set_text('Position (encoder tics)')
@@ -292,7 +352,7 @@ class Plotter :
         self.figwindows[2].show()
         
         fig = self.figwindows[3].init_plot()
-        self.traces.append(self.Trace(fig, self.ts, self.pos_error_derivs, 'b-', 'Position Error Derivative'))
+        self.traces.append(self.Trace(self.figwindows[3], self.ts, self.pos_error_derivs, 'b-', 'Position Error Derivative', 'pos_error_derivs'))
         fig.xaxis.label.set_text('Time (s)')
         fig.yaxis.label.set_text('Error change (tics/update)')
         fig.title.set_text('Position Error Derivative')
@@ -303,7 +363,7 @@ class Plotter :
     
     def closeWindows(self) :
         if self.streaming :
-            self.stopStreamPlot()
+            self.stopLivePlot()
         for fig in self.figwindows :
             fig.hide()
             fig.close()
@@ -384,36 +444,132 @@ class Plotter :
     def startStreaming(self) :
         """Starts streaming collection of data from the device, saved to a time-stamped
         .bin file in the streams directory using the RawHID USB mode. This works better
-        than the old plotter.startStreamPlot mode, which used the serial console."""
+        than the old plotter.startStreamPlot mode, which used the serial console.
+        stopStreaming packs it into a .cap file along with the machine settings."""
         # tell the rawhid interface program to start saving out data streams
         self.streaming = True
         fbase = "streams/" + timeStamped(comm.port)
         self.stream_fname = fbase + "stream.bin"
         comm.DataStreamStartSave(DS_STREAM_HIST, self.stream_fname)
         
-        # also save off a copy of the machine at this time (so we know what was going on later)
-        mach.machine.save(fbase + 'machine.xml')
+        # also keep a copy of the machine at this time (so we know what was going on later)
+        self.stream_machine = mach.machine.toxml()
+        self.stream_info = {'port' : str(comm.port), 'started' : timeStamped('')[:-1]}
         
-        # tell the device to start streaming
+        # tell the device to start streaming, and watch the data come in
         comm.Write("ss 1")
+        self.startLivePlot()
+
+    # Live plotting: while streaming, the capture file is followed with a
+    # TailReader and each frame adds just the newly arrived records to a
+    # fixed-size ring (self.live), whose last LIVE_SECONDS are plotted. Older
+    # data is only in the capture file, so memory use stays flat however long
+    # the stream runs.
+    def startLivePlot(self) :
+        self.tail = histdata.TailReader(self.stream_fname)
+        if self.live == None :
+            self.live = histdata.HistRing(int(LIVE_SECONDS * LIVE_MAX_RATE))
+        self.live.clear()
+        self.setLiveData()
+        self.plotData()
+        for fw in self.figwindows :
+            fw.set_live(True, LIVE_SECONDS)
+        self.liveTimer = QtCore.QTimer()
+        self.liveTimer.timeout.connect(self.updateLivePlot)
+        self.liveTimer.start(STREAM_FRAME_MS)
+
+    def stopLivePlot(self) :
+        if self.liveTimer != None :
+            self.liveTimer.stop()
+            self.liveTimer = None
+        for fw in self.figwindows :
+            fw.set_live(False)
+        if self.tail != None :
+            self.tail.close()
+            self.tail = None
+
+    def updateLivePlot(self) :
+        recs = self.tail.read()
+        if len(recs) == 0 :
+            return
+        self.live.append(recs)
+        self.setLiveData()
+        
+        for tr in self.traces :
+            tr.x = self.ts
+            tr.y = getattr(self, tr.ychan)
+            tr.update()
+        for fw in self.figwindows :
+            fw.update_plot()
+
+    # points the plotted arrays at the latest live records (views; no copying)
+    def setLiveData(self) :
+        live, self.ts = self.live.window(LIVE_SECONDS)
+        self.ps = live['position']
+        self.vs = []
+        self.pos_error_derivs = live['pos_error_deriv']
+        self.cmd_vs = live['cmd_velocity']
+        self.target_ps = live['target_pos']
+        self.target_vs = live['target_vel']
+        self.motor_ps = live['motor_position']
 
     def stopStreaming(self) :
         """Stops streaming collection of data from the device being saved to the .bin
-        file, converts the .bin to .csv, and shows the results."""
+        file, packs the .bin into a .cap capture file, shows the results, and (if 
+        STREAM_CSV is set) also converts the .bin to .csv. The packing happens in the
+        background; cancelProcessing stops it."""
         # disable streaming
         comm.Write("ss 0")
+        self.stopLivePlot()
         
         # tell the rawhid proxy to stop saving the data stream
         comm.DataStreamStopSave(DS_STREAM_HIST)
         
         self.streaming = False
         
-        # convert the .bin to .csv
-        newname = self.stream_fname[:-3] + 'csv'
-        convertBinaryDump(self.stream_fname, newname)
-        
-        # display the data
-        self.readHistFromFile(newname)
+        # pack it, with the machine snapshot, into a single capture file (and
+        # maybe a csv). That's done in the background so the device can still be
+        # commanded meanwhile; the data is shown when it's finished.
+        capname = self.stream_fname[:-4] + capfile.CAPTURE_EXT
+        csvname = self.stream_fname[:-3] + 'csv' if STREAM_CSV else None
+        job = postproc.StreamJob(self.stream_fname, capname, self.stream_machine, self.stream_info, csvname)
+        print("Packing %i records into %s..." % (job.total, capname))
+        self.jobs.append(job)
+        self.job_shown = 0
+        if self.jobTimer == None :
+            self.jobTimer = QtCore.QTimer()
+            self.jobTimer.timeout.connect(self.checkJobs)
+            self.jobTimer.start(JOB_POLL_MS)
+    
+    def cancelProcessing(self) :
+        """Stops packing stream captures. The .bin files are left as they were (they
+        can be opened with readHistFromCapture, or converted later)."""
+        for job in self.jobs :
+            job.cancel()
+    
+    # shows progress of the stream jobs, and plots each one's data when it's done
+    def checkJobs(self) :
+        for job in list(self.jobs) :
+            if job.running() :
+                if job is self.jobs[-1] :
+                    while self.job_shown < 10 * job.progress() :
+                        print '.',
+                        self.job_shown += 1
+                continue
+            self.jobs.remove(job)
+            if job.state == postproc.JOB_DONE :
+                print("\nPacked %s." % job.capfname)
+                if job.kept :
+                    print("It doesn't match the stream, though, so %s was kept." % job.binfname)
+                self.readHistFromRecords(job.result())
+                job.discard()
+            elif job.state == postproc.JOB_CANCELLED :
+                print("\nCancelled; the stream is still in %s." % job.binfname)
+            else :
+                print("\nPacking %s failed (%s); the stream is still in %s." % (job.capfname, job.error, job.binfname))
+        if len(self.jobs) == 0 and self.jobTimer != None :
+            self.jobTimer.stop()
+            self.jobTimer = None
         
     
                 